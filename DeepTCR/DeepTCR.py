@@ -5,6 +5,7 @@ from DeepTCR.functions.utils_u import *
 from DeepTCR.functions.utils_s import *
 from DeepTCR.functions.act_fun import *
 from DeepTCR.functions.plot_func import *
+from DeepTCR.functions.pool_manager import *
 import seaborn as sns
 import colorsys
 from scipy.cluster.hierarchy import linkage,fcluster,dendrogram, leaves_list
@@ -22,12 +23,15 @@ import pickle
 import matplotlib.pyplot as plt
 from sklearn.metrics import roc_curve, roc_auc_score
 import shutil
+import time
+from collections import OrderedDict
 import warnings
 from scipy.stats import spearmanr,gaussian_kde
 
 class DeepTCR_base(object):
 
-    def __init__(self,Name,max_length=40,device=0):
+    def __init__(self,Name,max_length=40,device=0,compact=False,use_tf_data=False,prefetch=2,length_bucketing=False,trace_epoch=None,model_cache_mb=1024,
+                 prediction_cache=False,prediction_cache_mb=1024):
         """
         Initialize Training Object.
 
@@ -47,6 +51,53 @@ class DeepTCR_base(object):
             This selects which GPU the user wants to put the graph
             and train on.
 
+        compact: bool
+            When set to True, the repertoire arrays are held in a compact layout
+            (uint8 residue codes, int16 gene codes, uint8 HLA multi-hot and interned
+            string columns). This reduces memory use on large cohorts and the arrays
+            are cast back to the expected types when fed to the network.
+
+        use_tf_data: bool
+            When set to True, training batches are prepared on a background thread
+            while the current batch runs on the device. Batch order and seeding are the
+            same as without it.
+
+        prefetch: int
+            Number of batches to prepare ahead of the graph when use_tf_data is True.
+
+        length_bucketing: bool
+            When set to True, the supervised sequence and repertoire models accept sequences
+            trimmed of trailing padding. Batches of the sequence classifier are drawn from groups of
+            similar CDR3 length and every batch is cut to the narrowest width that leaves the
+            max-pooled convolutional features unchanged, which saves convolution work on short CDR3s.
+            The VAE always uses the full max_length since its decoder reconstructs every position.
+
+        trace_epoch: int
+            Every training run records a per-epoch history (time spent batching, in forward/backward passes
+            and in evaluation, examples/sec, peak memory and losses/accuracies) to history.pkl/history.csv in
+            its models/model_<i> directory. When trace_epoch is set, the first training step of that epoch is
+            also traced and saved there as a chrome://tracing timeline (timeline_epoch_<e>.json).
+
+        model_cache_mb: float
+            Trained models restored for inference (Sequence_Inference, Sample_Inference) are kept loaded
+            on this object so repeated calls only read each checkpoint once. Once their variables take up
+            more than this many MB, the least recently used models are released. Set to None for no limit.
+            A model that is retrained is reloaded on its next use.
+
+        prediction_cache: bool or str
+            When set to True (or to a directory, which can be shared by several objects scoring with the same
+            trained models), the outputs of Sequence_Inference are memoized on disk (<Name>/prediction_cache by
+            default) per model and per encoded input (sequences, genes and HLA), so sequences scored before are
+            returned without running tensorflow. Models are identified by the hash of their checkpoint and
+            model_type.pkl, so a retrained model does not reuse old outputs. Hit/miss counts are returned by
+            self.prediction_cache.stats(). Writes to the cache are serialized with a file lock, so a shared
+            directory can be used by several processes at once; sharing a directory requires fcntl (not
+            available on Windows).
+
+        prediction_cache_mb: float
+            Once the prediction cache takes up more than this many MB on disk, the outputs of the least recently
+            used models (and then the oldest outputs) are removed. Set to None for no limit.
+
         Returns
         ---------------------------------------
 
@@ -69,6 +120,22 @@ class DeepTCR_base(object):
         self.regression = False
         self.use_w = False
         self.ind = None
+        self.compact = compact
+        self.use_tf_data = use_tf_data
+        self.prefetch = prefetch
+        self.length_bucketing = length_bucketing
+        self.trace_epoch = trace_epoch
+        self.train_examples_per_sec = None
+        self.history = None
+        self.model_cache = Model_Cache(model_cache_mb)
+        self.data_store = None
+        self.prediction_cache = None
+        if prediction_cache is not False:
+            shared = prediction_cache is not True
+            if prediction_cache is True:
+                prediction_cache = os.path.join(Name,'prediction_cache')
+            self.prediction_cache = Prediction_Cache(prediction_cache,prediction_cache_mb,shared=shared)
+        self.tf_threads = None
 
         #Create dataframes for assigning AA to ints
         aa_idx, aa_mat = make_aa_df()
@@ -87,11 +154,11 @@ class DeepTCR_base(object):
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-    def Get_Data(self,directory,Load_Prev_Data=False,classes=None,type_of_data_cut='Fraction_Response',data_cut=1.0,n_jobs=40,
+    def Get_Data(self,directory,Load_Prev_Data=False,classes=None,type_of_data_cut='Fraction_Response',data_cut=1.0,n_jobs=None,
                     aa_column_alpha = None,aa_column_beta = None, count_column = None,sep='\t',aggregate_by_aa=True,
                     v_alpha_column=None,j_alpha_column=None,
                     v_beta_column=None,j_beta_column=None,d_beta_column=None,
-                 p=None,hla=None,use_hla_supertype=False,keep_non_supertype_alleles=False):
+                 p=None,hla=None,use_hla_supertype=False,keep_non_supertype_alleles=False,use_parse_cache=False,fast_parse=True):
         """
         Get Data for DeepTCR
 
@@ -103,9 +170,12 @@ class DeepTCR_base(object):
             Path to directory with folders with tsv files are present
             for analysis. Folders names become labels for files within them. If the directory contains
             the TCRSeq files not organized into classes/labels, DeepTCR will load all files within that directory.
+            Files compressed with gzip (.gz), bzip2 (.bz2) or zstandard (.zst, requires the zstandard package)
+            are decompressed on the fly while being parsed.
 
         Load_Prev_Data: bool
-            Loads Previous Data.
+            Loads Previous Data. Data is stored as a directory of .npy files (<Name>/<Name>_Data)
+            that are memory-mapped on load, so arrays are only read from disk when accessed.
 
         classes: list
             Optional selection of input of which sub-directories to use for analysis.
@@ -135,7 +205,8 @@ class DeepTCR_base(object):
             Value  associated with type_of_data_cut parameter.
 
         n_jobs: int
-            Number of processes to use for parallelized operations.
+            Number of processes to use for parallelized operations. Default uses all available cores.
+            The worker pool is created once and re-used across calls.
 
         aa_column_alpha: int
             Column where alpha chain amino acid data is stored. (0-indexed)
@@ -199,6 +270,18 @@ class DeepTCR_base(object):
             (i.e. HLA-C alleles or certain HLA-A or HLA-B alleles) or discard them for the analysis. In order to keep these alleles,
             one should set this parameter to True. Default is False and non HLA-A or B alleles will be discarded.
 
+        use_parse_cache: bool
+            When set to True, the parsed output of each file is cached under <Name>/parse_cache, keyed on the file
+            path, size, modification time and the parsing parameters. On subsequent calls, only new or changed files
+            are re-parsed. The cache holds a second (pickled) copy of the parsed data, so it takes up about as much
+            disk space as the parsed repertoires. When a file changes or is parsed with other parameters, its
+            previous entry is replaced; entries of files not read by a call are kept. Delete the directory to
+            clear the cache.
+
+        fast_parse: bool
+            When set to True, only the requested columns are read from each file, with counts parsed as numbers and
+            gene columns as categoricals. Per-file parse times are stored in self.parse_times.
+
         Returns
 
         self.alpha_sequences: ndarray
@@ -264,9 +347,6 @@ class DeepTCR_base(object):
             self.lb.fit(classes)
             self.classes = self.lb.classes_
 
-            if p is None:
-                p = Pool(n_jobs)
-
             if sep == '\t':
                 ext = '*.tsv'
             elif sep == ',':
@@ -276,93 +356,106 @@ class DeepTCR_base(object):
                 return
 
             #Get data from tcr-seq files
-            alpha_sequences = []
-            beta_sequences = []
-            v_beta = []
-            d_beta = []
-            j_beta = []
-            v_alpha = []
-            j_alpha = []
-            label_id = []
-            file_id = []
-            freq = []
-            counts=[]
-            file_list = []
-            seq_index = []
-            print('Loading Data...')
+            cache_dir = os.path.join(self.Name,'parse_cache')
+            cache_used = set()
+            parse_times = []
+            if use_parse_cache is True and not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            files_read = []
+            files_class = []
             for type in self.classes:
-                if data_in_dirs:
-                    files_read = glob.glob(os.path.join(directory, type, ext))
+                for e in [ext]+[ext+c for c in compression_ext]:
+                    if data_in_dirs:
+                        files_temp = glob.glob(os.path.join(directory, type, e))
+                    else:
+                        files_temp = glob.glob(os.path.join(directory,e))
+                    files_read += files_temp
+                    files_class += [type]*len(files_temp)
+
+            args = []
+            for file in files_read:
+                a = (type_of_data_cut,data_cut,aa_column_alpha,aa_column_beta,count_column,sep,self.max_length,
+                     aggregate_by_aa,v_beta_column,d_beta_column,j_beta_column,v_alpha_column,j_alpha_column,fast_parse)
+                if use_parse_cache is True:
+                    cache_file = os.path.join(cache_dir,Parse_Cache_Key(file,a)+'.pkl')
+                    cache_used.add(os.path.basename(cache_file))
                 else:
-                    files_read = glob.glob(os.path.join(directory,ext))
-                num_ins = len(files_read)
-                args = list(zip(files_read,
-                                [type_of_data_cut] * num_ins,
-                                [data_cut] * num_ins,
-                                [aa_column_alpha] * num_ins,
-                                [aa_column_beta] * num_ins,
-                                [count_column] * num_ins,
-                                [sep] * num_ins,
-                                [self.max_length]*num_ins,
-                                [aggregate_by_aa]*num_ins,
-                                [v_beta_column]*num_ins,
-                                [d_beta_column]*num_ins,
-                                [j_beta_column]*num_ins,
-                                [v_alpha_column]*num_ins,
-                                [j_alpha_column]*num_ins))
-
-                DF = p.starmap(Get_DF_Data, args)
-
-                DF_temp = []
-                files_read_temp = []
-                for df,file in zip(DF,files_read):
-                    if df.empty is False:
-                        DF_temp.append(df)
-                        files_read_temp.append(file)
-
-                DF = DF_temp
-                files_read = files_read_temp
-
-                for df, file in zip(DF, files_read):
-                    if aa_column_alpha is not None:
-                        alpha_sequences += df['alpha'].tolist()
-                    if aa_column_beta is not None:
-                        beta_sequences += df['beta'].tolist()
-
-                    if v_alpha_column is not None:
-                        v_alpha += df['v_alpha'].tolist()
-
-                    if j_alpha_column is not None:
-                        j_alpha += df['j_alpha'].tolist()
-
-                    if v_beta_column is not None:
-                        v_beta += df['v_beta'].tolist()
-
-                    if d_beta_column is not None:
-                        d_beta += df['d_beta'].tolist()
-
-                    if j_beta_column is not None:
-                        j_beta += df['j_beta'].tolist()
-
-                    label_id += [type] * len(df)
-                    file_id += [file.split('/')[-1]] * len(df)
-                    file_list.append(file.split('/')[-1])
-                    freq += df['Frequency'].tolist()
-                    counts += df['counts'].tolist()
-                    seq_index += df.index.tolist()
-
-            alpha_sequences = np.asarray(alpha_sequences)
-            beta_sequences = np.asarray(beta_sequences)
-            v_beta = np.asarray(v_beta)
-            d_beta = np.asarray(d_beta)
-            j_beta = np.asarray(j_beta)
-            v_alpha = np.asarray(v_alpha)
-            j_alpha = np.asarray(j_alpha)
-            label_id = np.asarray(label_id)
-            file_id = np.asarray(file_id)
-            freq = np.asarray(freq)
-            counts = np.asarray(counts)
-            seq_index = np.asarray(seq_index)
+                    cache_file = None
+                args.append((cache_file,file)+a)
+
+            #one work queue over all classes, largest files first, completed out of order
+            order = np.argsort([-os.path.getsize(f) for f in files_read],kind='stable')
+            DF = [None]*len(files_read)
+            print('Loading Data...')
+            start = time.time()
+            n_rows = 0
+            n_done = 0
+            for i,(df,t,cached) in Pool_Imap_Unordered(Get_DF_Data_Cached,[args[i] for i in order],p=p,n_jobs=n_jobs):
+                DF[order[i]] = df
+                parse_times.append([files_read[order[i]],t,len(df),cached])
+                n_done += 1
+                n_rows += len(df)
+                elapsed = max(time.time()-start,1e-6)
+                print('\r{}/{} files, {:.1f} files/s, {:.0f} rows/s'.format(n_done,len(files_read),n_done/elapsed,n_rows/elapsed),end='')
+            print('')
+
+            #keep files in class/directory order and fill preallocated arrays
+            keep = [i for i in range(len(DF)) if DF[i].empty is False]
+            offsets = np.concatenate([[0],np.cumsum([len(DF[i]) for i in keep])]).astype(int)
+            num_seq = offsets[-1]
+
+            columns = OrderedDict()
+            for col,use in [('alpha',aa_column_alpha),('beta',aa_column_beta),('v_beta',v_beta_column),
+                            ('d_beta',d_beta_column),('j_beta',j_beta_column),('v_alpha',v_alpha_column),
+                            ('j_alpha',j_alpha_column)]:
+                if use is not None:
+                    columns[col] = np.empty(num_seq,dtype=object)
+            label_id = np.empty(num_seq,dtype=object)
+            file_id = np.empty(num_seq,dtype=object)
+            freq = np.zeros(num_seq)
+            counts = np.zeros(num_seq,dtype=int)
+            seq_index = np.zeros(num_seq,dtype=int)
+            file_list = []
+
+            for ii,i in enumerate(keep):
+                df = DF[i]
+                sl = slice(offsets[ii],offsets[ii+1])
+                for col in columns:
+                    columns[col][sl] = df[col].tolist()
+                label_id[sl] = files_class[i]
+                #compressed files keep the id of their uncompressed name
+                file = Strip_Compression_Ext(files_read[i])
+                file_id[sl] = file.split('/')[-1]
+                file_list.append(file.split('/')[-1])
+                freq[sl] = df['Frequency'].tolist()
+                counts[sl] = df['counts'].tolist()
+                seq_index[sl] = df.index.tolist()
+
+            empty = np.asarray([])
+            alpha_sequences = columns['alpha'].astype(str) if 'alpha' in columns else empty
+            beta_sequences = columns['beta'].astype(str) if 'beta' in columns else empty
+            v_beta = columns['v_beta'].astype(str) if 'v_beta' in columns else empty
+            d_beta = columns['d_beta'].astype(str) if 'd_beta' in columns else empty
+            j_beta = columns['j_beta'].astype(str) if 'j_beta' in columns else empty
+            v_alpha = columns['v_alpha'].astype(str) if 'v_alpha' in columns else empty
+            j_alpha = columns['j_alpha'].astype(str) if 'j_alpha' in columns else empty
+            label_id = label_id.astype(str)
+            file_id = file_id.astype(str)
+
+            if use_parse_cache is True:
+                #drop outdated entries of the files read here (file changed or parsed with other parameters);
+                #entries of other files are kept for other calls sharing this Name
+                paths_used = set([f.split('_')[0] for f in cache_used])
+                for f in os.listdir(cache_dir):
+                    if (f.split('_')[0] in paths_used) and (f not in cache_used):
+                        os.remove(os.path.join(cache_dir,f))
+
+            self.parse_times = pd.DataFrame(parse_times,columns=['File','Seconds','Rows','Cached'])
+            print('{} files parsed in {:.1f}s, {} files loaded from cache'.format(
+                np.sum(~self.parse_times['Cached']),np.sum(self.parse_times['Seconds'][~self.parse_times['Cached']]),
+                np.sum(self.parse_times['Cached'])))
+            print('Worker utilization: {:.0%}'.format(Pool_Utilization(reset=True)['utilization']))
 
             Y = self.lb.transform(label_id)
             OH = OneHotEncoder(sparse=False,categories='auto')
@@ -371,22 +464,13 @@ class DeepTCR_base(object):
             print('Embedding Sequences...')
             #transform sequences into numerical space
             if aa_column_alpha is not None:
-                args = list(zip(alpha_sequences, [self.aa_idx] * len(alpha_sequences), [self.max_length] * len(alpha_sequences)))
-                result = p.starmap(Embed_Seq_Num, args)
-                sequences_num = np.vstack(result)
+                sequences_num = Embed_Seq_Num_Batch(alpha_sequences, self.aa_idx, self.max_length)
                 X_Seq_alpha = np.expand_dims(sequences_num, 1)
 
             if aa_column_beta is not None:
-                args = list(zip(beta_sequences, [self.aa_idx] * len(beta_sequences),  [self.max_length] * len(beta_sequences)))
-                result = p.starmap(Embed_Seq_Num, args)
-                sequences_num = np.vstack(result)
+                sequences_num = Embed_Seq_Num_Batch(beta_sequences, self.aa_idx, self.max_length)
                 X_Seq_beta = np.expand_dims(sequences_num, 1)
 
-
-            if p is None:
-                p.close()
-                p.join()
-
             if self.use_alpha is False:
                 X_Seq_alpha = np.zeros(shape=[len(label_id)])
                 alpha_sequences = np.asarray([None]*len(label_id))
@@ -462,9 +546,12 @@ class DeepTCR_base(object):
                 self.lb_hla = MultiLabelBinarizer()
                 hla_data_num = self.lb_hla.fit_transform(hla_data)
 
-                hla_data_seq_num = np.zeros(shape=[file_id.shape[0],hla_data_num.shape[1]])
-                for file,h in zip(file_list,hla_data_num):
-                    hla_data_seq_num[file_id==file] = h
+                #broadcast per-file hla to sequences through the sample index
+                file_index = group_index(file_id)
+                hla_sample = np.zeros(shape=[len(file_index.groups),hla_data_num.shape[1]])
+                _,idx_1,idx_2 = np.intersect1d(file_index.groups,file_list,return_indices=True)
+                hla_sample[idx_1] = hla_data_num[idx_2]
+                hla_data_seq_num = hla_sample[file_index.codes]
                 hla_data_seq_num = hla_data_seq_num.astype(int)
                 hla_data_seq = np.asarray(self.lb_hla.inverse_transform(hla_data_seq_num))
 
@@ -501,26 +588,72 @@ class DeepTCR_base(object):
                 hla_data_seq = np.asarray(['None']*len(file_id))
                 hla_data_seq_num = np.asarray(['None']*len(file_id))
 
-            with open(os.path.join(self.Name,self.Name) + '_Data.pkl', 'wb') as f:
-                pickle.dump([X_Seq_alpha,X_Seq_beta,Y, alpha_sequences,beta_sequences, label_id, file_id, freq,counts,seq_index,
-                             self.lb,file_list,self.use_alpha,self.use_beta,
-                             self.lb_v_beta, self.lb_d_beta, self.lb_j_beta,self.lb_v_alpha,self.lb_j_alpha,
-                             v_beta, d_beta,j_beta,v_alpha,j_alpha,
-                             v_beta_num, d_beta_num, j_beta_num,v_alpha_num,j_alpha_num,
-                             self.use_v_beta,self.use_d_beta,self.use_j_beta,self.use_v_alpha,self.use_j_alpha,
-                             self.lb_hla, hla_data, hla_data_num,hla_data_seq,hla_data_seq_num,
-                             self.use_hla,self.use_hla_sup,self.keep_non_supertype_alleles],f,protocol=4)
-
         else:
-            with open(os.path.join(self.Name,self.Name) + '_Data.pkl', 'rb') as f:
-                X_Seq_alpha,X_Seq_beta,Y, alpha_sequences,beta_sequences, label_id, file_id, freq,counts,seq_index,\
-                self.lb,file_list,self.use_alpha,self.use_beta,\
-                    self.lb_v_beta, self.lb_d_beta, self.lb_j_beta,self.lb_v_alpha,self.lb_j_alpha,\
-                    v_beta, d_beta,j_beta,v_alpha,j_alpha,\
-                    v_beta_num, d_beta_num, j_beta_num,v_alpha_num,j_alpha_num,\
-                    self.use_v_beta,self.use_d_beta,self.use_j_beta,self.use_v_alpha,self.use_j_alpha,\
-                    self.lb_hla, hla_data,hla_data_num,hla_data_seq,hla_data_seq_num,\
-                self.use_hla,self.use_hla_sup,self.keep_non_supertype_alleles = pickle.load(f)
+            store = os.path.join(self.Name,self.Name) + '_Data'
+            if os.path.exists(os.path.join(store,'meta.pkl')):
+                arrays,meta = Load_Data_Store(store)
+                X_Seq_alpha,X_Seq_beta,Y,alpha_sequences,beta_sequences,label_id,file_id,freq,counts,seq_index,\
+                    file_list,v_beta,d_beta,j_beta,v_alpha,j_alpha,\
+                    v_beta_num,d_beta_num,j_beta_num,v_alpha_num,j_alpha_num,\
+                    hla_data,hla_data_num,hla_data_seq,hla_data_seq_num = arrays.values()
+                self.lb = meta['lb']
+                self.use_alpha,self.use_beta = meta['use_alpha'],meta['use_beta']
+                self.lb_v_beta,self.lb_d_beta,self.lb_j_beta = meta['lb_v_beta'],meta['lb_d_beta'],meta['lb_j_beta']
+                self.lb_v_alpha,self.lb_j_alpha = meta['lb_v_alpha'],meta['lb_j_alpha']
+                self.use_v_beta,self.use_d_beta,self.use_j_beta = meta['use_v_beta'],meta['use_d_beta'],meta['use_j_beta']
+                self.use_v_alpha,self.use_j_alpha = meta['use_v_alpha'],meta['use_j_alpha']
+                self.lb_hla = meta['lb_hla']
+                self.use_hla,self.use_hla_sup = meta['use_hla'],meta['use_hla_sup']
+                self.keep_non_supertype_alleles = meta['keep_non_supertype_alleles']
+            else:
+                #legacy single-file cache
+                with open(os.path.join(self.Name,self.Name) + '_Data.pkl', 'rb') as f:
+                    X_Seq_alpha,X_Seq_beta,Y, alpha_sequences,beta_sequences, label_id, file_id, freq,counts,seq_index,\
+                    self.lb,file_list,self.use_alpha,self.use_beta,\
+                        self.lb_v_beta, self.lb_d_beta, self.lb_j_beta,self.lb_v_alpha,self.lb_j_alpha,\
+                        v_beta, d_beta,j_beta,v_alpha,j_alpha,\
+                        v_beta_num, d_beta_num, j_beta_num,v_alpha_num,j_alpha_num,\
+                        self.use_v_beta,self.use_d_beta,self.use_j_beta,self.use_v_alpha,self.use_j_alpha,\
+                        self.lb_hla, hla_data,hla_data_num,hla_data_seq,hla_data_seq_num,\
+                    self.use_hla,self.use_hla_sup,self.keep_non_supertype_alleles = pickle.load(f)
+
+        if self.compact is True:
+            X_Seq_alpha = Compact_Seq(X_Seq_alpha)
+            X_Seq_beta = Compact_Seq(X_Seq_beta)
+            v_beta_num = Compact_Codes(v_beta_num)
+            d_beta_num = Compact_Codes(d_beta_num)
+            j_beta_num = Compact_Codes(j_beta_num)
+            v_alpha_num = Compact_Codes(v_alpha_num)
+            j_alpha_num = Compact_Codes(j_alpha_num)
+            hla_data_seq_num = Compact_Multi_Hot(hla_data_seq_num)
+            alpha_sequences = Intern_Array(alpha_sequences)
+            beta_sequences = Intern_Array(beta_sequences)
+            label_id = Intern_Array(label_id)
+            file_id = Intern_Array(file_id)
+            v_beta = Intern_Array(v_beta)
+            d_beta = Intern_Array(d_beta)
+            j_beta = Intern_Array(j_beta)
+            v_alpha = Intern_Array(v_alpha)
+            j_alpha = Intern_Array(j_alpha)
+
+        if Load_Prev_Data is False:
+            arrays = OrderedDict([('X_Seq_alpha',X_Seq_alpha),('X_Seq_beta',X_Seq_beta),('Y',Y),
+                                  ('alpha_sequences',alpha_sequences),('beta_sequences',beta_sequences),
+                                  ('label_id',label_id),('file_id',file_id),('freq',freq),('counts',counts),
+                                  ('seq_index',seq_index),('file_list',file_list),
+                                  ('v_beta',v_beta),('d_beta',d_beta),('j_beta',j_beta),('v_alpha',v_alpha),('j_alpha',j_alpha),
+                                  ('v_beta_num',v_beta_num),('d_beta_num',d_beta_num),('j_beta_num',j_beta_num),
+                                  ('v_alpha_num',v_alpha_num),('j_alpha_num',j_alpha_num),
+                                  ('hla_data',hla_data),('hla_data_num',hla_data_num),
+                                  ('hla_data_seq',hla_data_seq),('hla_data_seq_num',hla_data_seq_num)])
+            meta = {'lb':self.lb,'use_alpha':self.use_alpha,'use_beta':self.use_beta,
+                    'lb_v_beta':self.lb_v_beta,'lb_d_beta':self.lb_d_beta,'lb_j_beta':self.lb_j_beta,
+                    'lb_v_alpha':self.lb_v_alpha,'lb_j_alpha':self.lb_j_alpha,
+                    'use_v_beta':self.use_v_beta,'use_d_beta':self.use_d_beta,'use_j_beta':self.use_j_beta,
+                    'use_v_alpha':self.use_v_alpha,'use_j_alpha':self.use_j_alpha,
+                    'lb_hla':self.lb_hla,'use_hla':self.use_hla,'use_hla_sup':self.use_hla_sup,
+                    'keep_non_supertype_alleles':self.keep_non_supertype_alleles}
+            Save_Data_Store(os.path.join(self.Name,self.Name) + '_Data',arrays,meta)
 
         self.X_Seq_alpha = X_Seq_alpha
         self.X_Seq_beta = X_Seq_beta
@@ -547,6 +680,13 @@ class DeepTCR_base(object):
         self.hla_data_seq = hla_data_seq
         self.hla_data_seq_num = hla_data_seq_num
         self.w = np.ones(len(self.seq_index))
+        self.sample_index = group_index(self.sample_id)
+        #arrays still memory-mapped from the data store, reopened by cross-validation workers instead of being copied
+        self.data_store = None
+        if Load_Prev_Data is True and os.path.exists(os.path.join(store,'meta.pkl')):
+            self.data_store = {'directory':store,'columns':{k:(name,v) for k,v in self.__dict__.items()
+                                                            for name,x in arrays.items()
+                                                            if (v is x) and isinstance(x,np.memmap)}}
         #self.seq_index_j = seq_index
         print('Data Loaded')
 
@@ -674,14 +814,9 @@ class DeepTCR_base(object):
                 len_input = len(i)
                 break
 
-        if p is None:
-            p = Pool(40)
-
         if alpha_sequences is not None:
             self.alpha_sequences = alpha_sequences
-            args = list(zip(alpha_sequences, [self.aa_idx] * len(alpha_sequences), [self.max_length] * len(alpha_sequences)))
-            result = p.starmap(Embed_Seq_Num, args)
-            sequences_num = np.vstack(result)
+            sequences_num = Embed_Seq_Num_Batch(alpha_sequences, self.aa_idx, self.max_length)
             self.X_Seq_alpha = np.expand_dims(sequences_num, 1)
             self.use_alpha = True
         else:
@@ -690,9 +825,7 @@ class DeepTCR_base(object):
 
         if beta_sequences is not None:
             self.beta_sequences = beta_sequences
-            args = list(zip(beta_sequences, [self.aa_idx] * len(beta_sequences), [self.max_length] * len(beta_sequences)))
-            result = p.starmap(Embed_Seq_Num, args)
-            sequences_num = np.vstack(result)
+            sequences_num = Embed_Seq_Num_Batch(beta_sequences, self.aa_idx, self.max_length)
             self.X_Seq_beta = np.expand_dims(sequences_num, 1)
             self.use_beta = True
         else:
@@ -749,21 +882,10 @@ class DeepTCR_base(object):
             self.j_alpha_num = np.zeros(shape=[len_input])
             self.j_alpha = np.asarray([None] * len_input)
 
-        if p is None:
-            p.close()
-            p.join()
-
         if counts is not None:
             if sample_labels is not None:
-                count_dict={}
-                for s in np.unique(sample_labels):
-                    idx = sample_labels==s
-                    count_dict[s]=np.sum(counts[idx])
-
-                freq = []
-                for c,n in zip(counts,sample_labels):
-                    freq.append(c/count_dict[n])
-                freq = np.asarray(freq)
+                label_index = group_index(sample_labels)
+                freq = counts/label_index.sum(counts)[label_index.codes]
                 self.counts = counts
             else:
                 print('Counts need to be provided with sample labels')
@@ -784,15 +906,8 @@ class DeepTCR_base(object):
 
         if (counts is None) & (freq is None):
             counts = np.ones(shape=len_input)
-            count_dict = {}
-            for s in np.unique(self.sample_id):
-                idx = self.sample_id == s
-                count_dict[s] = int(np.sum(counts[idx]))
-
-            freq = []
-            for c, n in zip(counts, self.sample_id):
-                freq.append(c / count_dict[n])
-            freq = np.asarray(freq)
+            label_index = group_index(self.sample_id)
+            freq = counts/label_index.counts[label_index.codes]
             self.counts = counts
             self.freq = freq
 
@@ -830,16 +945,37 @@ class DeepTCR_base(object):
         else:
             self.w = np.ones(len_input)
 
+        if self.compact is True:
+            self.X_Seq_alpha = Compact_Seq(self.X_Seq_alpha)
+            self.X_Seq_beta = Compact_Seq(self.X_Seq_beta)
+            self.v_beta_num = Compact_Codes(self.v_beta_num)
+            self.d_beta_num = Compact_Codes(self.d_beta_num)
+            self.j_beta_num = Compact_Codes(self.j_beta_num)
+            self.v_alpha_num = Compact_Codes(self.v_alpha_num)
+            self.j_alpha_num = Compact_Codes(self.j_alpha_num)
+            self.hla_data_seq_num = Compact_Multi_Hot(self.hla_data_seq_num)
+            self.alpha_sequences = Intern_Array(self.alpha_sequences)
+            self.beta_sequences = Intern_Array(self.beta_sequences)
+            self.class_id = Intern_Array(self.class_id)
+            self.sample_id = Intern_Array(self.sample_id)
+            self.v_beta = Intern_Array(self.v_beta)
+            self.d_beta = Intern_Array(self.d_beta)
+            self.j_beta = Intern_Array(self.j_beta)
+            self.v_alpha = Intern_Array(self.v_alpha)
+            self.j_alpha = Intern_Array(self.j_alpha)
+
         self.seq_index = np.asarray(list(range(len(self.Y))))
         if self.regression is False:
             self.predicted = np.zeros((len(self.Y),len(self.lb.classes_)))
         else:
             self.predicted = np.zeros([len(self.Y),1])
         self.sample_list = np.unique(self.sample_id)
+        self.sample_index = group_index(self.sample_id)
+        self.data_store = None
         print('Data Loaded')
 
     def Sequence_Inference(self, alpha_sequences=None, beta_sequences=None, v_beta=None, d_beta=None, j_beta=None,
-                  v_alpha=None, j_alpha=None, p=None,hla=None, batch_size=10000,models=None,return_dist=False):
+                  v_alpha=None, j_alpha=None, p=None,hla=None, batch_size=10000,models=None,return_dist=False,ensemble=False):
         """
         Predicting outputs of sequence models on new data
 
@@ -903,6 +1039,11 @@ class DeepTCR_base(object):
             If the user wants to also return teh distribution of sequence predicionts over all models use dfor inference,
             one should set this value to True.
 
+        ensemble: bool
+            When several models are used, set to True to load them all into a single graph that shares the inputs,
+            so every batch is fed once and evaluated by all models in one run. This returns the same predictions
+            with lower latency, at the cost of keeping all of the selected models in memory at the same time.
+
         Returns
         [features, features_dist]
 
@@ -927,13 +1068,191 @@ class DeepTCR_base(object):
         model_type,get = load_model_data(self)
         out, out_dist = inference_method_ss(get,alpha_sequences,beta_sequences,
                                v_beta,d_beta,j_beta,v_alpha,j_alpha,hla,
-                                p,batch_size,self,models)
+                                p,batch_size,self,models,ensemble)
 
         if return_dist:
             return out, out_dist
         else:
             return out
 
+    def Sequence_Inference_Stream(self,data,output_file,chunk_size=100000,aa_column_alpha=None,aa_column_beta=None,
+                                  v_beta_column=None,d_beta_column=None,j_beta_column=None,v_alpha_column=None,
+                                  j_alpha_column=None,sep='\t',hla=None,batch_size=10000,models=None,ensemble=False,
+                                  dist_stats=None,output_sep='\t'):
+        """
+        Predicting outputs of sequence models on inputs too large for memory
+
+        This method runs the same inference as Sequence_Inference but reads, encodes and scores the input in chunks
+        of chunk_size sequences and appends the results of each chunk to output_file, so memory use depends on
+        chunk_size and not on the size of the input. For each sequence, the output is the average over the models
+        (one column per class for the sequence classifier, one per latent feature for the autoencoder), optionally
+        followed by statistics of the distribution of predictions over the models.
+
+        Inputs
+        ---------------------------------------
+
+        data: str or iterable
+            Either the path to a tsv/csv file or to a directory of them (searched recursively, compressed files
+            are read as in Get_Data), whose columns are selected with the column arguments below, or an iterable
+            (e.g. a generator) of DataFrames or dicts of arrays keyed by the inputs of Sequence_Inference
+            (alpha_sequences, beta_sequences, v_beta, d_beta, j_beta, v_alpha, j_alpha, hla). Any other columns
+            of these chunks are written to the output as they are.
+
+        output_file: str
+            Path of the delimited text file the results are written to. Rows are written in the order they are read.
+            When reading files, the file name and row index (within the file) of every sequence are written with it;
+            rows with missing, non-IUPAC or too long sequences are skipped.
+
+        chunk_size: int
+            Number of sequences read, encoded and scored at a time.
+
+        aa_column_alpha: int
+            Column where alpha chain amino acid data is stored. (0-indexed)
+
+        aa_column_beta: int
+            Column where beta chain amino acid data is stored.(0-indexed)
+
+        v_beta_column: int
+            Column where v_beta gene information is stored.
+
+        d_beta_column: int
+            Column where d_beta gene information is stored.
+
+        j_beta_column: int
+            Column where j_beta gene information is stored.
+
+        v_alpha_column: int
+            Column where v_alpha gene information is stored.
+
+        j_alpha_column: int
+            Column where j_alpha gene information is stored.
+
+        sep: str
+            Type of delimiter used in the input files.
+
+        hla: str
+            When reading files, the path to a csv file with the HLA of each file in the format used by Get_Data.
+
+        batch_size: int
+            Batch size for inference.
+
+        models: list
+            In the case that multiple models have been trained via MC or K-fold Cross-Validation strategy,
+            this list can determine which models to use for inference. By default, all models are used.
+
+        ensemble: bool
+            To run all models as one merged graph (see Sequence_Inference).
+
+        dist_stats: list
+            Statistics of the predictions over the models to write for each output, any of 'std','min','max'
+            (i.e. columns <output>_std).
+
+        output_sep: str
+            Delimiter of the output file.
+
+        Returns
+
+        n: int
+            The number of sequences scored.
+
+        ---------------------------------------
+
+        """
+        model_type,get = load_model_data(self)
+        if dist_stats is None:
+            dist_stats = []
+        for s in dist_stats:
+            if s not in ['std','min','max']:
+                raise Exception('dist_stats must be any of std, min, max')
+
+        columns = OrderedDict()
+        for name,col in [('alpha_sequences',aa_column_alpha),('beta_sequences',aa_column_beta),
+                         ('v_beta',v_beta_column),('d_beta',d_beta_column),('j_beta',j_beta_column),
+                         ('v_alpha',v_alpha_column),('j_alpha',j_alpha_column)]:
+            if col is not None:
+                columns[name] = col
+
+        n = 0
+        start = time.time()
+        with open(output_file,'w') as f:
+            for chunk in Stream_Chunks(data,chunk_size,columns,sep,self.max_length,hla):
+                inputs = {k:(np.asarray(chunk[k]) if k in chunk.columns else None) for k in Stream_Inputs}
+                if inputs['hla'] is not None:
+                    inputs['hla'] = list(chunk['hla'])
+                out,out_dist = inference_method_ss(get,batch_size=batch_size,p=None,self=self,models=models,
+                                                   ensemble=ensemble,**inputs)
+
+                if (model_type == 'SS') and (self.regression is False):
+                    names = [str(c) for c in self.lb.classes_]
+                else:
+                    names = [str(i) for i in range(out.shape[1])]
+                df_out = chunk.drop(columns=[c for c in ['hla'] if c in chunk.columns])
+                df_out = pd.concat([df_out,pd.DataFrame(out,columns=names)],axis=1)
+                for s in dist_stats:
+                    stat = getattr(np,s)(out_dist,axis=0)
+                    df_out = pd.concat([df_out,pd.DataFrame(stat,columns=[c+'_'+s for c in names])],axis=1)
+
+                df_out.to_csv(f,sep=output_sep,header=(n == 0),index=False)
+                n += len(df_out)
+                print('\r{} sequences, {:.0f} sequences/s'.format(n,n/max(time.time()-start,1e-6)),end='')
+        print('')
+        return n
+
+    def Export_NumPy(self,models=None,check=True,n_check=1000,tol=1e-4):
+        """
+        Export trained models for inference without tensorflow
+
+        This method writes the weights of each trained model (VAE, sequence or repertoire classifier) together
+        with the label encoders it was trained with to a single model.npz in the directory of that model
+        (i.e. Name/models/model_0/model.npz). These files are loaded with DeepTCR.functions.numpy_inference, which
+        only depends on numpy and provides Sequence_Inference/Sample_Inference equivalents, so scoring processes
+        can run trained models without importing tensorflow.
+
+        Only models trained with this version of DeepTCR can be exported as earlier versions did not save the layout
+        of their layers.
+
+        Inputs
+        ---------------------------------------
+
+        models: list
+            In the case that multiple models have been trained via MC or K-fold Cross-Validation strategy,
+            this list can determine which models to export. By default, all models are exported.
+
+        check: bool
+            To run the first n_check sequences of the data loaded into the object through both the tensorflow
+            model and its NumPy export and raise an exception if their outputs differ by more than tol.
+
+        n_check: int
+            Number of sequences used to check the exported models.
+
+        tol: float
+            Largest absolute difference allowed between the outputs of the tensorflow model and its NumPy export.
+
+        Returns
+
+        filenames: list
+            The paths of the exported model files.
+
+        ---------------------------------------
+
+        """
+        model_type,get = load_model_data(self)
+        if models is None:
+            directory = os.path.join(self.Name,'models')
+            models = [d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
+            models = [f for f in models if not f.startswith('.')]
+
+        if check and not hasattr(self,'v_beta_num'):
+            raise Exception('Load the data the models were trained on to check the export or set check=False.')
+
+        filenames = []
+        for m in models:
+            filename = Export_Model_NumPy(self,os.path.join(self.Name,'models',m))
+            if check:
+                Check_NumPy_Parity(self,m,filename,n_check,tol)
+            filenames.append(filename)
+        return filenames
+
 class feature_analytics_class(object):
     def Structural_Diversity(self, sample=None, n_jobs=1):
         """
@@ -971,13 +1290,20 @@ class feature_analytics_class(object):
         else:
             IDX, _, _ = phenograph.cluster(self.features, k=30, n_jobs=n_jobs)
 
+        #sample x cluster frequency table in one pass
+        sample_index = self.sample_index
+        cluster_index = group_index(IDX)
+        freq_table = np.zeros([len(sample_index.groups),len(cluster_index.groups)])
+        np.add.at(freq_table,(sample_index.codes,cluster_index.codes),self.freq)
+        freq_table = pd.DataFrame(freq_table,index=sample_index.groups,columns=cluster_index.groups)
+
         DFs = []
         DF_Sum = pd.DataFrame()
         DF_Sum['Sample'] = self.sample_list
         DF_Sum.set_index('Sample', inplace=True)
-        for i in np.unique(IDX):
+        for c,i in enumerate(cluster_index.groups):
             if i != -1:
-                sel = IDX == i
+                sel = cluster_index.order[cluster_index.offsets[c]:cluster_index.offsets[c+1]]
                 seq_alpha = self.alpha_sequences[sel]
                 seq_beta = self.beta_sequences[sel]
                 label = self.class_id[sel]
@@ -996,9 +1322,7 @@ class feature_analytics_class(object):
                 df['D_beta'] = self.d_beta[sel]
                 df['J_beta'] = self.j_beta[sel]
 
-                df_sum = df.groupby(by='Sample', sort=False).agg({'Frequency': 'sum'})
-
-                DF_Sum['Cluster_' + str(i)] = df_sum
+                DF_Sum['Cluster_' + str(i)] = freq_table[i]
 
                 DFs.append(df)
 
@@ -1007,12 +1331,13 @@ class feature_analytics_class(object):
         labels = []
         num_clusters = []
         entropy_list = []
+        class_first = sample_index.first(self.class_id)
         for file in self.sample_list:
             v = np.array(DF_Sum.loc[file].tolist())
             v = v[v > 0.0]
             entropy_list.append(entropy(v))
             num_clusters.append(len(v))
-            labels.append(self.class_id[self.sample_id == file][0])
+            labels.append(class_first[sample_index.lookup(file)])
 
         df_out = pd.DataFrame()
         df_out['Sample'] = self.sample_list
@@ -1199,15 +1524,22 @@ class feature_analytics_class(object):
             elif clustering_method == 'kmeans':
                 IDX = KMeans(n_clusters=t).fit_predict(features)
 
+        #sample x cluster frequency table in one pass
+        sample_index = group_index(sample_id)
+        cluster_index = group_index(IDX)
+        freq_table = np.zeros([len(sample_index.groups),len(cluster_index.groups)])
+        np.add.at(freq_table,(sample_index.codes,cluster_index.codes),freq)
+        freq_table = pd.DataFrame(freq_table,index=sample_index.groups,columns=cluster_index.groups)
+
         DFs = []
         DF_Sum = pd.DataFrame()
-        DF_Sum['Sample'] = np.unique(sample_id)
+        DF_Sum['Sample'] = sample_index.groups
         DF_Sum.set_index('Sample', inplace=True)
         var_list_alpha = []
         var_list_beta = []
-        for i in np.unique(IDX):
+        for c,i in enumerate(cluster_index.groups):
             if i != -1:
-                sel = IDX == i
+                sel = cluster_index.order[cluster_index.offsets[c]:cluster_index.offsets[c+1]]
                 seq_alpha = alpha_sequences[sel]
                 seq_beta = beta_sequences[sel]
                 label = class_id[sel]
@@ -1229,7 +1561,7 @@ class feature_analytics_class(object):
                     var_list_beta.append(0)
 
                 df = pd.DataFrame()
-                df['index'] = np.where(sel)[0]
+                df['index'] = sel
                 df['Alpha_Sequences'] = seq_alpha
                 df['Beta_Sequences'] = seq_beta
                 df['V_alpha'] = v_alpha[sel]
@@ -1249,9 +1581,7 @@ class feature_analytics_class(object):
                 if order_by_linkage:
                     df = df.iloc[leaves_list(linkage(features[sel],'ward'))]
 
-                df_sum = df.groupby(by='Sample', sort=False).agg({'Frequency': 'sum'})
-
-                DF_Sum['Cluster_' + str(i)] = df_sum
+                DF_Sum['Cluster_' + str(i)] = freq_table[i]
 
                 DFs.append(df)
 
@@ -1389,22 +1719,14 @@ class feature_analytics_class(object):
             sample_id = self.sample_id[self.test_idx]
             freq = self.freq[self.test_idx]
 
-        sample_list = np.unique(sample_id)
+        sample_index = group_index(sample_id)
+        sample_list = sample_index.groups
 
-        vector = []
-        file_label = []
-        for id in sample_list:
-            sel = sample_id == id
-            sel_idx = features[sel]
-            sel_freq = np.expand_dims(freq[sel], 1)
-            if Weight_by_Freq is True:
-                dist = np.expand_dims(np.sum(sel_idx * sel_freq, 0), 0)
-            else:
-                dist = np.expand_dims(np.mean(sel_idx, 0), 0)
-            file_label.append(np.unique(class_id[sel])[0])
-            vector.append(dist)
+        if Weight_by_Freq is True:
+            vector = sample_index.sum(features * np.expand_dims(freq, 1))
+        else:
+            vector = sample_index.sum(features) / np.expand_dims(sample_index.counts, 1)
 
-        vector = np.vstack(vector)
         dfs = pd.DataFrame(vector)
         dfs.set_index(sample_list, inplace=True)
         self.sample_features = dfs
@@ -2254,9 +2576,12 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                     if self.use_w:
                         GO.w = tf.placeholder(tf.float32, shape=[None])
                     GO.Features = Conv_Model(GO, self, trainable_embedding, kernel, use_only_seq, use_only_gene,use_only_hla)
+                    start = len(tf.global_variables())
                     fc = tf.layers.dense(GO.Features, 256)
                     fc = tf.layers.dense(fc, latent_dim)
                     z_w = tf.get_variable(name='z_w',shape=[latent_dim,latent_dim])
+                    Record_Block(GO,'encoder',start)
+                    GO.arch['model'] = 'VAE'
                     z_mean = tf.matmul(fc,z_w)
                     z_mean = tf.identity(z_mean,'z_mean')
                     z_log_var = tf.layers.dense(fc, latent_dim, activation=tf.nn.softplus, name='z_log_var')
@@ -2291,8 +2616,7 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                         w = tf.cast(tf.squeeze(tf.greater(GO.X_Seq_beta, 0), 1), tf.float32)
                         correct_ae_beta = tf.reduce_sum(w * tf.cast(tf.equal(predicted_beta, actual_ae_beta), tf.float32),axis=1) / tf.reduce_sum(w, axis=1)
 
-                        accuracy_beta = tf.reduce_mean(correct_ae_beta, axis=0)
-                        seq_accuracies.append(accuracy_beta)
+                        seq_accuracies.append(correct_ae_beta)
 
                     if self.use_alpha:
                         upsample1_alpha = tf.layers.conv2d_transpose(fc_up, 128, (1, 3), (1, 2), activation=tf.nn.relu)
@@ -2312,8 +2636,7 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                         actual_ae_alpha = tf.squeeze(GO.X_Seq_alpha, axis=1)
                         w = tf.cast(tf.squeeze(tf.greater(GO.X_Seq_alpha, 0), 1), tf.float32)
                         correct_ae_alpha = tf.reduce_sum(w * tf.cast(tf.equal(predicted_alpha, actual_ae_alpha), tf.float32), axis=1) / tf.reduce_sum(w, axis=1)
-                        accuracy_alpha = tf.reduce_mean(correct_ae_alpha, axis=0)
-                        seq_accuracies.append(accuracy_alpha)
+                        seq_accuracies.append(correct_ae_alpha)
 
                     hla_accuracies = []
                     hla_losses = []
@@ -2382,11 +2705,13 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                     total_cost = tf.reduce_sum(total_cost,1)
                     total_cost = tf.reduce_mean(total_cost)
 
+                    #per sequence accuracy, so it can be weighted by duplicates when rows are run once
                     num_acc = len(accuracies)
-                    accuracy = 0
+                    accuracy_rows = 0
                     for a in accuracies:
-                        accuracy += a
-                    accuracy = accuracy/num_acc
+                        accuracy_rows += a
+                    accuracy_rows = accuracy_rows/num_acc
+                    accuracy = tf.reduce_mean(accuracy_rows)
                     latent_cost = tf.reduce_mean(latent_cost)
 
                     opt_ae = tf.train.AdamOptimizer(learning_rate=learning_rate).minimize(total_cost)
@@ -2414,17 +2739,25 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                 recon_loss = []
                 train_loss = []
                 latent_loss = []
+                model_dir = os.path.join(self.Name,'models','model_0')
+                history = Training_History('VAE',0,self.trace_epoch)
                 training = True
                 e = 0
                 while training:
                     iteration = 0
+                    trace = history.start_epoch(e)
+                    n_batches = len(train_loss)
                     Vars = [self.X_Seq_alpha,self.X_Seq_beta,self.v_beta_num,self.d_beta_num,self.j_beta_num,
                             self.v_alpha_num,self.j_alpha_num,self.hla_data_seq_num,self.w]
 
                     if split_seed is not None:
                         np.random.seed(split_seed)
 
-                    for vars in get_batches(Vars, batch_size=batch_size,random=True):
+                    start = time.time()
+                    run_time = 0.0
+                    n_examples = 0
+                    for vars in Input_Batches(self,get_batches(Vars, batch_size=batch_size,random=True)):
+                        n_examples += len(vars[0])
                         feed_dict = {}
                         if self.use_alpha is True:
                             feed_dict[GO.X_Seq_alpha] = vars[0]
@@ -2452,11 +2785,18 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                         if self.use_w:
                             feed_dict[GO.w] = vars[8]
 
-                        train_loss_i, recon_loss_i, latent_loss_i, sparsity_loss_i, accuracy_i, _ = sess.run([total_cost, recon_cost, latent_cost, sparsity_cost, accuracy, opt_ae], feed_dict=feed_dict)
+                        t = time.time()
+                        train_loss_i, recon_loss_i, latent_loss_i, sparsity_loss_i, accuracy_i, _ = sess.run([total_cost, recon_cost, latent_cost, sparsity_cost, accuracy, opt_ae], feed_dict=feed_dict,
+                                                                                                             **Trace_Options(trace))
+                        run_time += time.time()-t
+                        if trace is not None:
+                            Write_Timeline(trace,model_dir,e)
+                            trace = None
                         accuracy_list.append(accuracy_i)
                         recon_loss.append(recon_loss_i)
                         latent_loss.append(latent_loss_i)
                         train_loss.append(train_loss_i)
+                        self.train_examples_per_sec = n_examples/(time.time()-start)
 
                         if suppress_output is False:
                             print("Epoch = {}, Iteration = {}".format(e,iteration),
@@ -2464,7 +2804,8 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                                   "Recon Loss: {:.5f}:".format(recon_loss_i),
                                   "Latent Loss: {:.5f}:".format(latent_loss_i),
                                   "Sparsity Loss: {:.5f}:".format(sparsity_loss_i),
-                                  "Recon Accuracy: {:.5f}".format(accuracy_i))
+                                  "Recon Accuracy: {:.5f}".format(accuracy_i),
+                                  "Examples/sec: {:.1f}".format(self.train_examples_per_sec))
 
                         if e >= epochs_min:
                             if accuracy_min is not None:
@@ -2479,69 +2820,35 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                                         training = False
                                         break
                         iteration += 1
+                    total = time.time()-start
+                    history.add_times({'batching':total-run_time,'forward_backward':run_time})
+                    history.end_epoch(examples_per_sec=self.train_examples_per_sec,
+                                      train_loss=np.mean(train_loss[n_batches:]),recon_loss=np.mean(recon_loss[n_batches:]),
+                                      latent_loss=np.mean(latent_loss[n_batches:]),recon_accuracy=np.mean(accuracy_list[n_batches:]))
                     e += 1
 
-                features_list = []
-                accuracy_list = []
-                alpha_features_list = []
-                alpha_indices_list = []
-                beta_features_list = []
-                beta_indices_list = []
                 Vars = [self.X_Seq_alpha, self.X_Seq_beta, self.v_beta_num, self.d_beta_num, self.j_beta_num,
                         self.v_alpha_num, self.j_alpha_num,self.hla_data_seq_num,self.w]
-
-                for vars in get_batches(Vars, batch_size=batch_size, random=False):
-                    feed_dict = {}
-                    if self.use_alpha is True:
-                        feed_dict[GO.X_Seq_alpha] = vars[0]
-                    if self.use_beta is True:
-                        feed_dict[GO.X_Seq_beta] = vars[1]
-
-                    if self.use_v_beta is True:
-                        feed_dict[GO.X_v_beta] = vars[2]
-
-                    if self.use_d_beta is True:
-                        feed_dict[GO.X_d_beta] = vars[3]
-
-                    if self.use_j_beta is True:
-                        feed_dict[GO.X_j_beta] = vars[4]
-
-                    if self.use_v_alpha is True:
-                        feed_dict[GO.X_v_alpha] = vars[5]
-
-                    if self.use_j_alpha is True:
-                        feed_dict[GO.X_j_alpha] = vars[6]
-
-                    if self.use_hla:
-                        feed_dict[GO.X_hla] = vars[7]
-
-                    if self.use_w:
-                        feed_dict[GO.w] = vars[8]
-
-                    get = z_mean
-                    features_ind, accuracy_check = sess.run([get, accuracy], feed_dict=feed_dict)
-                    features_list.append(features_ind)
-                    accuracy_list.append(accuracy_check)
-
-                    if self.use_alpha is True:
-                        alpha_ft, alpha_i = sess.run([GO.alpha_out,GO.indices_alpha],feed_dict=feed_dict)
-                        alpha_features_list.append(alpha_ft)
-                        alpha_indices_list.append(alpha_i)
-
-                    if self.use_beta is True:
-                        beta_ft, beta_i = sess.run([GO.beta_out,GO.indices_beta],feed_dict=feed_dict)
-                        beta_features_list.append(beta_ft)
-                        beta_indices_list.append(beta_i)
-
-                features = np.vstack(features_list)
-                accuracy_list = np.hstack(accuracy_list)
-                if self.use_alpha is True:
-                    self.alpha_features = np.vstack(alpha_features_list)
-                    self.alpha_indices = np.vstack(alpha_indices_list)
-
-                if self.use_beta is True:
-                    self.beta_features = np.vstack(beta_features_list)
-                    self.beta_indices = np.vstack(beta_indices_list)
+                #extract features once per unique input row
+                idx_u,inv = Unique_Rows(Vars[:-1])
+                Vars = [v[idx_u] for v in Vars]
+
+                #latent features, accuracy and per-chain features in a single pass over the data
+                feeds = Input_Feeds(self,GO,Vars[:-1])
+                if self.use_w:
+                    feeds.append((GO.w,Vars[8],False))
+                fetches = Seq_Feature_Fetches(self,GO)
+                fetches['features'] = z_mean
+                fetches['accuracy'] = accuracy_rows
+                out = Fused_Run(sess,fetches,feeds,batch_size)
+                features = out.pop('features')[inv]
+                #accuracy of each unique row counted once per sequence it stands for
+                accuracy_u = out.pop('accuracy')
+                n_u = np.bincount(inv,minlength=len(accuracy_u))
+                valid = ~np.isnan(accuracy_u)
+                recon_accuracy = np.sum(accuracy_u[valid]*n_u[valid])/np.sum(n_u[valid])
+                for k,v in out.items():
+                    setattr(self,k,v[inv])
 
                 self.kernel = kernel
                 #
@@ -2559,7 +2866,7 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                     pickle.dump(self.kernel, f)
 
 
-                print('Reconstruction Accuracy: {:.5f}'.format(np.nanmean(accuracy_list)))
+                print('Reconstruction Accuracy: {:.5f}'.format(recon_accuracy))
 
                 embedding_layers = [GO.embedding_layer_v_alpha,GO.embedding_layer_j_alpha,
                                     GO.embedding_layer_v_beta,GO.embedding_layer_d_beta,
@@ -2587,7 +2894,9 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
 
                 self.ind = ind[:features.shape[1]]
                 #save model data and information for inference engine
-                save_model_data(self,GO.saver,sess,name='VAE',get=z_mean)
+                save_model_data(self,GO.saver,sess,name='VAE',get=z_mean,arch=GO.arch)
+                history.write(model_dir)
+                self.history = history
 
             with open(os.path.join(self.Name,self.Name) + '_VAE_features.pkl', 'wb') as f:
                 pickle.dump([features,embed_dict,explained_variance,explained_variance_ratio], f,protocol=4)
@@ -2817,6 +3126,66 @@ class DeepTCR_U(DeepTCR_base,feature_analytics_class,vis_class):
                 sns.catplot(data=df_out, x='Metric', y='Value', kind=plot_type)
 
 class DeepTCR_S_base(DeepTCR_base,feature_analytics_class,vis_class):
+    def _save_features(self):
+        if self.use_alpha is True:
+            var_save = [self.alpha_features,self.alpha_indices,self.alpha_sequences]
+            with open(os.path.join(self.Name, self.Name) + '_alpha_features.pkl', 'wb') as f:
+                pickle.dump(var_save, f)
+
+        if self.use_beta is True:
+            var_save = [self.beta_features,self.beta_indices,self.beta_sequences]
+            with open(os.path.join(self.Name, self.Name) + '_beta_features.pkl', 'wb') as f:
+                pickle.dump(var_save, f)
+
+        with open(os.path.join(self.Name, self.Name) + '_kernel.pkl', 'wb') as f:
+            pickle.dump(self.kernel, f)
+
+    def _run_folds(self,folds,split,build_args,train_kwargs,n_jobs=1,threads_per_job=None):
+        #Trains each fold and yields its index once the fold's results are set on the object, always in fold order.
+        #With n_jobs > 1, all splits are drawn up front in this process and the folds are trained in spawned workers;
+        #each worker resumes from the random state its fold's split left, as training would sequentially.
+        suppress_output = self.train_params.suppress_output
+        if n_jobs == 1:
+            for i in range(folds):
+                if suppress_output is False:
+                    print(i)
+                split(i)
+                self._train(iteration=i,**train_kwargs)
+                yield i
+            return
+
+        fold_attrs = []
+        rng_states = []
+        for i in range(folds):
+            before = dict(self.__dict__)
+            split(i)
+            fold_attrs.append(Changed_Attrs(self,before))
+            rng_states.append(np.random.get_state())
+
+        if n_jobs is None:
+            n_jobs = Available_Cores()
+        n_jobs = min(n_jobs,folds)
+        if threads_per_job is None:
+            threads_per_job = max(1,Available_Cores()//n_jobs)
+
+        state = {k:v for k,v in self.__dict__.items() if k not in ['GO','graph_model']}
+        state,mapped = Mapped_State(self,state)
+        tasks = [(i,fold_attrs[i],rng_states[i],train_kwargs) for i in range(folds)]
+        with Spawn_Pool(n_jobs,initializer=Init_Fold_Worker,initargs=(type(self),state,mapped,build_args,threads_per_job),
+                        env=Thread_Env(threads_per_job)) as pool:
+            for i,out in pool.imap(Train_Fold,tasks):
+                predicted = out.pop('predicted',None)
+                self.__dict__.update(fold_attrs[i])
+                self.__dict__.update(out)
+                if predicted is not None:
+                    self.predicted += predicted
+                if suppress_output is False:
+                    print(i)
+                yield i
+
+        #workers wrote these concurrently, leave the files from the last fold as in a sequential run
+        self._save_features()
+
     def AUC_Curve(self,by=None,filename='AUC.tif',title=None,title_font=None,plot=True,diag_line=True,
                   xtick_size = None, ytick_size=None, xlabel_size = None, ylabel_size=None,
                   legend_font_size=None,frameon=True,legend_loc = 'lower right',
@@ -3400,9 +3769,6 @@ class DeepTCR_S_base(DeepTCR_base,feature_analytics_class,vis_class):
 
         self.model_type, get = load_model_data(self)
         if Load_Prev_Data is False:
-            if p is None:
-                p = Pool(40)
-
             inputs = [alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,v_alpha,j_alpha, hla]
 
             for i in inputs:
@@ -3511,10 +3877,6 @@ class DeepTCR_S_base(DeepTCR_base,feature_analytics_class,vis_class):
                         beta_masks.append(temp_mask)
 
 
-            if p is None:
-                p.close()
-                p.join()
-
             with open(os.path.join(self.Name,'sens_data.pkl'),'wb') as f:
                 pickle.dump([alpha_sequences,alpha_matrices,alpha_masks,df_alpha_list,
                              beta_sequences,beta_matrices,beta_masks,df_beta_list],f,protocol=4)
@@ -3697,6 +4059,7 @@ class DeepTCR_SS(DeepTCR_S_base):
                 else:
                     GO.Y = tf.placeholder(tf.float32, shape=[None, 1])
 
+                start = len(tf.global_variables())
                 if self.regression is False:
                     if multisample_dropout:
                         GO.logits = MultiSample_Dropout(GO.Features,
@@ -3736,6 +4099,9 @@ class DeepTCR_SS(DeepTCR_S_base):
 
                     GO.loss = tf.reduce_mean(tf.square(GO.Y-GO.logits))
 
+                Record_Block(GO,'head',start)
+                GO.arch.update({'model':'SS','regression':self.regression})
+
                 GO.opt = tf.train.AdamOptimizer(learning_rate=learning_rate).minimize(GO.loss)
 
                 if self.regression is False:
@@ -3754,7 +4120,7 @@ class DeepTCR_SS(DeepTCR_S_base):
                 self.graph_model = graph_model
                 self.kernel = kernel
 
-    def _train(self,batch_seed=None,iteration=0):
+    def _train(self,batch_seed=None,iteration=0,eval_every=1):
 
         GO = self.GO
         graph_model = self.graph_model
@@ -3776,6 +4142,9 @@ class DeepTCR_SS(DeepTCR_S_base):
         tf.reset_default_graph()
         config = tf.ConfigProto(allow_soft_placement=True)
         config.gpu_options.allow_growth = True
+        if self.tf_threads is not None:
+            config.intra_op_parallelism_threads = self.tf_threads
+            config.inter_op_parallelism_threads = self.tf_threads
         with tf.Session(graph=graph_model,config=config) as sess:
             sess.run(tf.global_variables_initializer())
 
@@ -3783,61 +4152,76 @@ class DeepTCR_SS(DeepTCR_S_base):
             train_accuracy_total = []
             train_loss_total = []
             stop_check_list = []
+            model_dir = os.path.join(self.Name,'models','model_'+str(iteration))
+            history = Training_History(self.__class__.__name__,iteration,self.trace_epoch)
+            valid_convergence = (accuracy_min is None) and (train_loss_min is None) and (convergence == 'validation')
             e = 0
             while True:
                 if batch_seed is not None:
                     np.random.seed(batch_seed)
+                trace = history.start_epoch(e)
                 train_loss, train_accuracy, train_predicted,train_auc = \
-                    Run_Graph_SS(self.train,sess,self,GO,batch_size,random=True,train=True,drop_out_rate=drop_out_rate,multisample_dropout_rate=multisample_dropout_rate)
+                    Run_Graph_SS(self.train,sess,self,GO,batch_size,random=True,train=True,drop_out_rate=drop_out_rate,multisample_dropout_rate=multisample_dropout_rate,
+                                 trace=trace)
+                history.add_times(self.train_times)
+                if trace is not None:
+                    Write_Timeline(trace,model_dir,e)
 
                 train_accuracy_total.append(train_accuracy)
                 train_loss_total.append(train_loss)
 
-                valid_loss, valid_accuracy, valid_predicted,valid_auc = \
-                    Run_Graph_SS(self.valid,sess,self,GO,batch_size,random=False,train=False)
-
-                val_loss_total.append(valid_loss)
-
-                test_loss, test_accuracy, test_predicted,test_auc = \
-                    Run_Graph_SS(self.test,sess,self,GO,batch_size,random=False,train=False)
-                self.y_pred = test_predicted
-                self.y_test = self.test[-1]
-
+                t = time.time()
+                #validation is run before the stopping check only when the check reads it, any other scheduled
+                #validation is deferred so it can share a pass with the test partition on the final epoch
+                valid = None
+                if valid_convergence and Eval_Needed(e,None,epochs_min,stop_criterion_window,True):
+                    valid = Eval_Graph_SS([self.valid],sess,self,GO,batch_size)[0]
+                val_loss_total.append(np.nan if valid is None else valid[0])
+
+                stop = Check_Stop(e,train_params,train_accuracy_total,train_loss_total,val_loss_total,stop_check_list)
+                sets = []
+                if (valid is None) and (stop or Eval_Needed(e,eval_every,epochs_min,stop_criterion_window,False)):
+                    sets.append(self.valid)
+                if stop:
+                    sets.append(self.test)
+                results = Eval_Graph_SS(sets,sess,self,GO,batch_size)
+                if valid is None:
+                    if sets and (sets[0] is self.valid):
+                        valid = results.pop(0)
+                        val_loss_total[-1] = valid[0]
+                    else:
+                        valid = (np.nan,np.nan,None,np.nan)
+                valid_loss, valid_accuracy, valid_predicted, valid_auc = valid
+
+                test_loss, test_accuracy, test_auc = np.nan, np.nan, np.nan
+                if stop:
+                    test_loss, test_accuracy, test_predicted, test_auc = results.pop(0)
+                    self.y_pred = test_predicted
+                    self.y_test = self.test[-1]
+                history.add_times({'evaluation':time.time()-t})
+                history.end_epoch(examples_per_sec=self.train_examples_per_sec,
+                                  train_loss=train_loss,valid_loss=valid_loss,test_loss=test_loss,
+                                  train_accuracy=train_accuracy,valid_accuracy=valid_accuracy,test_accuracy=test_accuracy,
+                                  test_auc=test_auc)
 
                 if suppress_output is False:
-                    print("Training_Statistics: \n",
-                          "Epoch: {}".format(e + 1),
-                          "Training loss: {:.5f}".format(train_loss),
-                          "Validation loss: {:.5f}".format(valid_loss),
-                          "Testing loss: {:.5f}".format(test_loss),
-                          "Training Accuracy: {:.5}".format(train_accuracy),
-                          "Validation Accuracy: {:.5}".format(valid_accuracy),
-                          "Testing AUC: {:.5}".format(test_auc))
-
-                with warnings.catch_warnings():
-                    warnings.simplefilter('ignore')
-                    if e > epochs_min:
-                        if accuracy_min is not None:
-                            if np.mean(train_accuracy_total[-3:]) >= accuracy_min:
-                                break
-                        elif train_loss_min is not None:
-                            if np.mean(train_loss_total[-3:]) < train_loss_min:
-                                break
-                        elif convergence == 'validation':
-                            if val_loss_total:
-                                stop_check_list.append(stop_check(val_loss_total, stop_criterion, stop_criterion_window))
-                                if np.sum(stop_check_list[-3:]) >= 3:
-                                    break
-
-                        elif convergence == 'training':
-                            if train_loss_total:
-                                stop_check_list.append(stop_check(train_loss_total, stop_criterion, stop_criterion_window))
-                                if np.sum(stop_check_list[-3:]) >= 3:
-                                    break
+                    stats = ["Epoch: {}".format(e + 1),
+                             "Training loss: {:.5f}".format(train_loss),
+                             "Validation loss: {:.5f}".format(valid_loss),
+                             "Training Accuracy: {:.5}".format(train_accuracy),
+                             "Validation Accuracy: {:.5}".format(valid_accuracy)]
+                    if stop:
+                        stats += ["Testing loss: {:.5f}".format(test_loss),
+                                  "Testing Accuracy: {:.5}".format(test_accuracy),
+                                  "Testing AUC: {:.5}".format(test_auc)]
+                    stats.append("Examples/sec: {:.1f}".format(self.train_examples_per_sec))
+                    print("Training_Statistics: \n",*stats)
+
+                if stop:
+                    break
 
                 e += 1
 
-            Get_Seq_Features_Indices(self,batch_size,GO,sess)
             self.features = Get_Latent_Features(self,batch_size,GO,sess)
 
             idx_base = np.asarray(range(len(self.sample_id)))
@@ -3849,22 +4233,13 @@ class DeepTCR_SS(DeepTCR_S_base):
                 self.predicted[self.test[self.var_dict['seq_index']]] += self.y_pred
 
             #
-            if self.use_alpha is True:
-                var_save = [self.alpha_features,self.alpha_indices,self.alpha_sequences]
-                with open(os.path.join(self.Name, self.Name) + '_alpha_features.pkl', 'wb') as f:
-                    pickle.dump(var_save, f)
-
-            if self.use_beta is True:
-                var_save = [self.beta_features,self.beta_indices,self.beta_sequences]
-                with open(os.path.join(self.Name, self.Name) + '_beta_features.pkl', 'wb') as f:
-                    pickle.dump(var_save, f)
-
-            with open(os.path.join(self.Name, self.Name) + '_kernel.pkl', 'wb') as f:
-                pickle.dump(self.kernel, f)
+            self._save_features()
 
             print('Done Training')
             # save model data and information for inference engine
-            save_model_data(self, GO.saver, sess, name='SS', get=GO.predicted,iteration=iteration)
+            save_model_data(self, GO.saver, sess, name='SS', get=GO.predicted,iteration=iteration,arch=GO.arch)
+            history.write(model_dir)
+            self.history = history
 
     def Train(self,kernel = 5,trainable_embedding = True,embedding_dim_aa = 64, embedding_dim_genes = 48, embedding_dim_hla = 12,
                num_fc_layers = 0, units_fc = 12,weight_by_class = False, class_weights = None,
@@ -3872,7 +4247,7 @@ class DeepTCR_SS(DeepTCR_S_base):
                drop_out_rate=0.0,multisample_dropout = False, multisample_dropout_rate = 0.50, multisample_dropout_num_masks = 64,
                batch_size = 1000, epochs_min = 10, stop_criterion = 0.001, stop_criterion_window = 10,
                accuracy_min = None, train_loss_min = None, hinge_loss_t = 0.0, convergence = 'validation', learning_rate = 0.001, suppress_output = False,
-                batch_seed = None):
+                batch_seed = None,eval_every = 1):
         """
         Train Single-Sequence Classifier
 
@@ -4001,6 +4376,12 @@ class DeepTCR_SS(DeepTCR_S_base):
         batch_seed: int
             For deterministic batching during training, set this value to an integer of choice.
 
+        eval_every: int
+            Number of epochs between passes over the validation partition. Regardless of this value, validation
+            is also run on every epoch the early stopping criterion reads when convergence is assessed on the
+            validation loss, and on the final epoch. Set to None to only run it when needed for early stopping.
+            The test partition is evaluated once, after the final epoch, in the same pass as the final validation.
+
         Returns
         ---------------------------------------
 
@@ -4012,7 +4393,7 @@ class DeepTCR_SS(DeepTCR_S_base):
                drop_out_rate,multisample_dropout, multisample_dropout_rate, multisample_dropout_num_masks,
                batch_size, epochs_min, stop_criterion, stop_criterion_window,
                accuracy_min, train_loss_min, hinge_loss_t, convergence, learning_rate, suppress_output)
-        self._train(batch_seed=batch_seed,iteration=0)
+        self._train(batch_seed=batch_seed,iteration=0,eval_every=eval_every)
 
     def Monte_Carlo_CrossVal(self,folds=5,test_size=0.25,LOO=None,split_by_sample=False,combine_train_valid=False,seeds=None,
                              kernel=5, trainable_embedding=True, embedding_dim_aa=64, embedding_dim_genes=48, embedding_dim_hla=12,
@@ -4021,7 +4402,7 @@ class DeepTCR_SS(DeepTCR_S_base):
                              drop_out_rate=0.0, multisample_dropout=False, multisample_dropout_rate=0.50, multisample_dropout_num_masks=64,
                              batch_size=1000, epochs_min=10, stop_criterion=0.001, stop_criterion_window=10,
                              accuracy_min=None, train_loss_min=None, hinge_loss_t=0.0, convergence='validation', learning_rate=0.001, suppress_output=False,
-                             batch_seed=None):
+                             batch_seed=None,eval_every=1,n_jobs=1,threads_per_job=None):
 
         '''
         Monte Carlo Cross-Validation for Single-Sequence Classifier
@@ -4186,6 +4567,25 @@ class DeepTCR_SS(DeepTCR_S_base):
         batch_seed: int
             For deterministic batching during training, set this value to an integer of choice.
 
+        eval_every: int
+            Number of epochs between passes over the validation partition. Regardless of this value, validation
+            is also run on every epoch the early stopping criterion reads when convergence is assessed on the
+            validation loss, and on the final epoch. Set to None to only run it when needed for early stopping.
+            The test partition is evaluated once, after the final epoch, in the same pass as the final validation.
+
+        n_jobs: int
+            Number of folds to train at the same time. With the default of 1, folds are trained one after another
+            in this process. When set higher, all train/valid/test splits are drawn first and the folds are trained on
+            CPU in separate worker processes, each continuing from the random state its split left so batches are drawn
+            as in a sequential run. With seeds (or batch_seed) and graph_seed set, every fold is deterministic and matches
+            n_jobs=1; without them, folds are only as reproducible as a sequential run. Models, predictions
+            and y_test/y_pred are merged in fold order exactly as in a sequential run. Because workers are started with
+            the 'spawn' method, scripts calling this must be guarded by if __name__ == '__main__'.
+
+        threads_per_job: int
+            Number of tensorflow threads each worker may use when n_jobs > 1. By default, the available
+            cores are divided evenly between the workers.
+
         Returns
         ---------------------------------------
 
@@ -4197,21 +4597,20 @@ class DeepTCR_SS(DeepTCR_S_base):
         predicted = np.zeros_like(self.predicted)
         counts = np.zeros_like(self.predicted)
         self._reset_models()
-        self._build(kernel,trainable_embedding,embedding_dim_aa, embedding_dim_genes, embedding_dim_hla,
+        build_args = (kernel,trainable_embedding,embedding_dim_aa, embedding_dim_genes, embedding_dim_hla,
                num_fc_layers, units_fc,weight_by_class, class_weights,
                use_only_seq, use_only_gene, use_only_hla, size_of_net,graph_seed,
                drop_out_rate,multisample_dropout, multisample_dropout_rate, multisample_dropout_num_masks,
                batch_size, epochs_min, stop_criterion, stop_criterion_window,
                accuracy_min, train_loss_min, hinge_loss_t, convergence, learning_rate, suppress_output)
+        self._build(*build_args)
 
-        for i in range(0, folds):
-            if suppress_output is False:
-                print(i)
+        def split(i):
             if seeds is not None:
                 np.random.seed(seeds[i])
             self.Get_Train_Valid_Test(test_size=test_size, LOO=LOO,split_by_sample=split_by_sample,combine_train_valid=combine_train_valid)
-            self._train(batch_seed=batch_seed,iteration=i)
 
+        for i in self._run_folds(folds,split,build_args,{'batch_seed':batch_seed,'eval_every':eval_every},n_jobs,threads_per_job):
             y_test.append(self.y_test)
             y_pred.append(self.y_pred)
 
@@ -4243,7 +4642,7 @@ class DeepTCR_SS(DeepTCR_S_base):
                         drop_out_rate=0.0, multisample_dropout=False, multisample_dropout_rate=0.50, multisample_dropout_num_masks=64,
                         batch_size=1000, epochs_min=10, stop_criterion=0.001, stop_criterion_window=10,
                         accuracy_min=None, train_loss_min=None, hinge_loss_t=0.0, convergence='validation', learning_rate=0.001, suppress_output=False,
-                        batch_seed=None):
+                        batch_seed=None,eval_every=1,n_jobs=1,threads_per_job=None):
 
         '''
         K_Fold Cross-Validation for Single-Sequence Classifier
@@ -4277,6 +4676,7 @@ class DeepTCR_SS(DeepTCR_S_base):
         seeds: nd.array
             In order to set a deterministic train/test split over the K-Fold Simulations, one can provide an array
             of seeds for each K-fold simulation. This will result in the same train/test split over the N Fold simulations.
+            Each seed also sets the validation split and batch order of its fold.
             This parameter, if provided, should have the same size of the value of folds.
 
         Model Parameters
@@ -4399,6 +4799,25 @@ class DeepTCR_SS(DeepTCR_S_base):
         batch_seed: int
             For deterministic batching during training, set this value to an integer of choice.
 
+        eval_every: int
+            Number of epochs between passes over the validation partition. Regardless of this value, validation
+            is also run on every epoch the early stopping criterion reads when convergence is assessed on the
+            validation loss, and on the final epoch. Set to None to only run it when needed for early stopping.
+            The test partition is evaluated once, after the final epoch, in the same pass as the final validation.
+
+        n_jobs: int
+            Number of folds to train at the same time. With the default of 1, folds are trained one after another
+            in this process. When set higher, all train/valid/test splits are drawn first and the folds are trained on
+            CPU in separate worker processes, each continuing from the random state its split left so batches are drawn
+            as in a sequential run. With seeds (or batch_seed) and graph_seed set, every fold is deterministic and matches
+            n_jobs=1; without them, folds are only as reproducible as a sequential run. Models, predictions
+            and y_test/y_pred are merged in fold order exactly as in a sequential run. Because workers are started with
+            the 'spawn' method, scripts calling this must be guarded by if __name__ == '__main__'.
+
+        threads_per_job: int
+            Number of tensorflow threads each worker may use when n_jobs > 1. By default, the available
+            cores are divided evenly between the workers.
+
         Returns
         ---------------------------------------
 
@@ -4448,18 +4867,19 @@ class DeepTCR_SS(DeepTCR_S_base):
 
 
         self._reset_models()
-        self._build(kernel, trainable_embedding, embedding_dim_aa, embedding_dim_genes, embedding_dim_hla,
+        build_args = (kernel, trainable_embedding, embedding_dim_aa, embedding_dim_genes, embedding_dim_hla,
                     num_fc_layers, units_fc, weight_by_class, class_weights,
                     use_only_seq, use_only_gene, use_only_hla, size_of_net, graph_seed,
                     drop_out_rate, multisample_dropout, multisample_dropout_rate, multisample_dropout_num_masks,
                     batch_size, epochs_min, stop_criterion, stop_criterion_window,
                     accuracy_min, train_loss_min, hinge_loss_t, convergence, learning_rate, suppress_output)
+        self._build(*build_args)
 
         y_test = []
         y_pred = []
-        for ii in range(folds):
-            if suppress_output is False:
-                print(ii)
+        def split(ii):
+            if seeds is not None:
+                np.random.seed(seeds[ii])
             train_idx = np.setdiff1d(idx,test_idx[ii])
             valid_idx = np.random.choice(train_idx,len(train_idx)//(folds-1),replace=False)
             train_idx = np.setdiff1d(train_idx,valid_idx)
@@ -4487,8 +4907,8 @@ class DeepTCR_SS(DeepTCR_S_base):
                     self.valid[i] = self.test[i]
 
             self.LOO = None
-            self._train(batch_seed=batch_seed,iteration=ii)
 
+        for ii in self._run_folds(folds,split,build_args,{'batch_seed':batch_seed,'eval_every':eval_every},n_jobs,threads_per_job):
             y_test.append(self.y_test)
             y_pred.append(self.y_pred)
 
@@ -4582,7 +5002,7 @@ class DeepTCR_WF(DeepTCR_S_base):
                drop_out_rate=0.0,multisample_dropout=False, multisample_dropout_rate = 0.50,multisample_dropout_num_masks = 64,
                batch_size = 25,batch_size_update = None, epochs_min = 25,stop_criterion=0.25,stop_criterion_window=10,
               accuracy_min = None,train_loss_min=None,hinge_loss_t=0.0,convergence='validation',learning_rate=0.001, suppress_output=False,
-               loss_criteria='mean'):
+               loss_criteria='mean',aggregation='sparse',pooling='sum'):
 
         graph_model = tf.Graph()
         GO = graph_object()
@@ -4602,6 +5022,13 @@ class DeepTCR_WF(DeepTCR_S_base):
         GO.embedding_dim_genes = embedding_dim_genes
         GO.embedding_dim_aa = embedding_dim_aa
         GO.embedding_dim_hla = embedding_dim_hla
+        if aggregation not in ('sparse','segment'):
+            raise Exception("aggregation must be 'sparse' or 'segment'")
+        if pooling not in ('sum','mean','max'):
+            raise Exception("pooling must be 'sum', 'mean' or 'max'")
+        if aggregation == 'sparse' and pooling != 'sum':
+            raise Exception("pooling other than 'sum' requires aggregation='segment'")
+        GO.aggregation = aggregation
         with graph_model.device(self.device):
             with graph_model.as_default():
                 if graph_seed is not None:
@@ -4616,26 +5043,41 @@ class DeepTCR_WF(DeepTCR_S_base):
                 else:
                     GO.Y = tf.placeholder(tf.float32, shape=[None, 1])
 
+                if aggregation == 'segment':
+                    GO.seg = tf.placeholder(tf.int32, shape=[None, ], name='seg')
+                    GO.n_seg = tf.placeholder(tf.int32, shape=(), name='n_seg')
+                    agg_fn = Segment_Pool(GO.seg,GO.n_seg,pooling)
+                else:
+                    agg_fn = lambda x: tf.sparse.matmul(GO.sp, x)
+
+                start = len(tf.global_variables())
                 Features = tf.layers.dense(GO.Features, num_concepts, lambda x: isru(x, l=0, h=1, a=0, b=0))
+                Record_Block(GO,'concepts',start)
                 agg_list = []
                 if qualitative_agg:
                     #qualitative agg
                     GO.Features_W = Features * GO.X_Freq[:, tf.newaxis]
-                    GO.Features_Agg = tf.sparse.matmul(GO.sp, GO.Features_W)
+                    GO.Features_Agg = agg_fn(GO.Features_W)
                     agg_list.append(GO.Features_Agg)
                 if quantitative_agg:
                     #quantitative agg
                     GO.Features_W_c = Features * GO.X_Counts[:, tf.newaxis]
+                    start = len(tf.global_variables())
                     c_b = tf.Variable(name='c_b',initial_value=np.zeros(num_concepts), trainable=True,dtype=tf.float32)
-                    GO.Features_Agg_c = isru(tf.sparse.matmul(GO.sp, GO.Features_W_c)+c_b,l=0,h=1,a=0,b=0)
+                    GO.Features_Agg_c = isru(agg_fn(GO.Features_W_c)+c_b,l=0,h=1,a=0,b=0)
+                    Record_Block(GO,'quantitative',start)
                     agg_list.append(GO.Features_Agg_c)
 
                 GO.Features_Agg = tf.concat(agg_list,axis=1)
 
+                start = len(tf.global_variables())
                 if num_agg_layers != 0:
                     for lyr in range(num_agg_layers):
                         GO.Features_Agg = tf.layers.dropout(GO.Features_Agg, GO.prob)
                         GO.Features_Agg = tf.layers.dense(GO.Features_Agg, units_agg, tf.nn.relu)
+                Record_Block(GO,'agg',start)
+
+                start = len(tf.global_variables())
 
                 if self.regression is False:
                     if multisample_dropout:
@@ -4683,6 +5125,10 @@ class DeepTCR_WF(DeepTCR_S_base):
 
                     GO.loss = tf.reduce_mean(tf.square(GO.Y-GO.logits))
 
+                Record_Block(GO,'head',start)
+                GO.arch.update({'model':'WF','regression':self.regression,'qualitative_agg':qualitative_agg,
+                                'quantitative_agg':quantitative_agg,'aggregation':aggregation,'pooling':pooling})
+
                 var_train = tf.trainable_variables()
                 if batch_size_update is None:
                     GO.opt = tf.train.AdamOptimizer(learning_rate=learning_rate).minimize(GO.loss,var_list=var_train)
@@ -4692,8 +5138,15 @@ class DeepTCR_WF(DeepTCR_S_base):
                     GO.gradients = tf.gradients(GO.loss,var_train)
                     GO.gradients,keep_ii = zip(*[(v,ii) for ii,v in enumerate(GO.gradients) if v is not None])
                     var_train = list(np.asarray(var_train)[list(keep_ii)])
-                    GO.grads_accum = [tf.Variable(tf.zeros_like(v)) for v in GO.gradients]
-                    GO.grads_and_vars = list(zip(GO.grads_accum,var_train))
+                    #gradients are accumulated in-graph, weighted by the number of samples in each micro-batch
+                    GO.grads_accum = [tf.Variable(tf.zeros_like(v),trainable=False) for v in GO.gradients]
+                    GO.w_accum = tf.Variable(0.0,trainable=False)
+                    n_batch = tf.cast(tf.shape(GO.Y)[0],tf.float32)
+                    GO.accum_op = tf.group([a.assign_add(g*n_batch) for a,g in zip(GO.grads_accum,GO.gradients)]
+                                           +[GO.w_accum.assign_add(n_batch)])
+                    GO.zero_op = tf.group([a.assign(tf.zeros_like(a)) for a in GO.grads_accum]
+                                          +[GO.w_accum.assign(0.0)])
+                    GO.grads_and_vars = list(zip([a/GO.w_accum for a in GO.grads_accum],var_train))
                     GO.opt = GO.opt.apply_gradients(GO.grads_and_vars)
 
 
@@ -4712,7 +5165,7 @@ class DeepTCR_WF(DeepTCR_S_base):
                 self.graph_model = graph_model
                 self.kernel = kernel
 
-    def _train(self,write=True,batch_seed=None,iteration=0):
+    def _train(self,write=True,batch_seed=None,iteration=0,eval_every=1):
         GO = self.GO
         graph_model = self.graph_model
         train_params = self.train_params
@@ -4732,6 +5185,9 @@ class DeepTCR_WF(DeepTCR_S_base):
         tf.reset_default_graph()
         config = tf.ConfigProto(allow_soft_placement=True)
         config.gpu_options.allow_growth = True
+        if self.tf_threads is not None:
+            config.intra_op_parallelism_threads = self.tf_threads
+            config.inter_op_parallelism_threads = self.tf_threads
         with tf.Session(graph=graph_model,config=config) as sess:
             sess.run(tf.global_variables_initializer())
 
@@ -4739,66 +5195,79 @@ class DeepTCR_WF(DeepTCR_S_base):
             train_accuracy_total = []
             train_loss_total = []
             stop_check_list = []
+            model_dir = os.path.join(self.Name,'models','model_'+str(iteration))
+            history = Training_History(self.__class__.__name__,iteration,self.trace_epoch)
+            valid_convergence = (accuracy_min is None) and (train_loss_min is None) and (convergence == 'validation')
             e = 0
 
             while True:
                 if batch_seed is not None:
                     np.random.seed(batch_seed)
+                trace = history.start_epoch(e)
                 train_loss, train_accuracy, train_predicted,train_auc = \
                     Run_Graph_WF(self.train,sess,self,GO,batch_size,batch_size_update,random=True,train=True,
-                                 drop_out_rate=drop_out_rate,multisample_dropout_rate=multisample_dropout_rate)
+                                 drop_out_rate=drop_out_rate,multisample_dropout_rate=multisample_dropout_rate,trace=trace)
+                history.add_times(self.train_times)
+                if trace is not None:
+                    Write_Timeline(trace,model_dir,e)
 
                 train_accuracy_total.append(train_accuracy)
                 train_loss_total.append(train_loss)
 
-                valid_loss, valid_accuracy, valid_predicted, valid_auc = \
-                    Run_Graph_WF(self.valid, sess, self, GO, batch_size,batch_size_update, random=False, train=False)
-
-                val_loss_total.append(valid_loss)
-
-                test_loss, test_accuracy, test_predicted, test_auc = \
-                    Run_Graph_WF(self.test, sess, self, GO, batch_size,batch_size_update, random=False, train=False)
-
-                self.y_pred = test_predicted
-                self.y_test = self.test[-1]
+                t = time.time()
+                #validation is run before the stopping check only when the check reads it, any other scheduled
+                #validation is deferred so it can share a pass with the test partition on the final epoch
+                valid = None
+                if valid_convergence and Eval_Needed(e,None,epochs_min,stop_criterion_window,True):
+                    valid = Eval_Graph_WF([self.valid],sess,self,GO,batch_size)[0]
+                val_loss_total.append(np.nan if valid is None else valid[0])
+
+                stop = Check_Stop(e,train_params,train_accuracy_total,train_loss_total,val_loss_total,stop_check_list)
+                sets = []
+                if (valid is None) and (stop or Eval_Needed(e,eval_every,epochs_min,stop_criterion_window,False)):
+                    sets.append(self.valid)
+                if stop:
+                    sets.append(self.test)
+                results = Eval_Graph_WF(sets,sess,self,GO,batch_size)
+                if valid is None:
+                    if sets and (sets[0] is self.valid):
+                        valid = results.pop(0)
+                        val_loss_total[-1] = valid[0]
+                    else:
+                        valid = (np.nan,np.nan,None,np.nan)
+                valid_loss, valid_accuracy, valid_predicted, valid_auc = valid
+
+                test_loss, test_accuracy, test_auc = np.nan, np.nan, np.nan
+                if stop:
+                    test_loss, test_accuracy, test_predicted, test_auc = results.pop(0)
+                    self.y_pred = test_predicted
+                    self.y_test = self.test[-1]
+                history.add_times({'evaluation':time.time()-t})
+                history.end_epoch(examples_per_sec=self.train_examples_per_sec,
+                                  train_loss=train_loss,valid_loss=valid_loss,test_loss=test_loss,
+                                  train_accuracy=train_accuracy,valid_accuracy=valid_accuracy,test_accuracy=test_accuracy,
+                                  test_auc=test_auc)
 
                 if suppress_output is False:
-                    print("Training_Statistics: \n",
-                          "Epoch: {}".format(e),
-                          "Training loss: {:.5f}".format(train_loss),
-                          "Validation loss: {:.5f}".format(valid_loss),
-                          "Testing loss: {:.5f}".format(test_loss),
-                          "Training Accuracy: {:.5}".format(train_accuracy),
-                          "Validation Accuracy: {:.5}".format(valid_accuracy),
-                          "Testing Accuracy: {:.5}".format(test_accuracy),
-                          'Testing AUC: {:.5}'.format(test_auc))
-
-                with warnings.catch_warnings():
-                    warnings.simplefilter('ignore')
-                    if e > epochs_min:
-                        if accuracy_min is not None:
-                            if np.mean(train_accuracy_total[-3:]) >= accuracy_min:
-                                break
-                        elif train_loss_min is not None:
-                            if np.mean(train_loss_total[-3:]) < train_loss_min:
-                                break
-                        elif convergence == 'validation':
-                            if val_loss_total:
-                                stop_check_list.append(stop_check(val_loss_total, stop_criterion, stop_criterion_window))
-                                if np.sum(stop_check_list[-3:]) >= 3:
-                                    break
-
-                        elif convergence == 'training':
-                            if train_loss_total:
-                                stop_check_list.append(stop_check(train_loss_total, stop_criterion, stop_criterion_window))
-                                if np.sum(stop_check_list[-3:]) >= 3:
-                                    break
+                    stats = ["Epoch: {}".format(e),
+                             "Training loss: {:.5f}".format(train_loss),
+                             "Validation loss: {:.5f}".format(valid_loss),
+                             "Training Accuracy: {:.5}".format(train_accuracy),
+                             "Validation Accuracy: {:.5}".format(valid_accuracy)]
+                    if stop:
+                        stats += ["Testing loss: {:.5f}".format(test_loss),
+                                  "Testing Accuracy: {:.5}".format(test_accuracy),
+                                  "Testing AUC: {:.5}".format(test_auc)]
+                    stats.append("Examples/sec: {:.1f}".format(self.train_examples_per_sec))
+                    print("Training_Statistics: \n",*stats)
+
+                if stop:
+                    break
 
                 e +=  1
 
             if write:
                 batch_size_seq = round(len(self.sample_id)/(len(self.sample_list)/batch_size))
-                Get_Seq_Features_Indices(self,batch_size_seq,GO,sess)
                 self.features = Get_Latent_Features(self, batch_size_seq, GO, sess)
 
             pred, idx = Get_Sequence_Pred(self, batch_size, GO, sess)
@@ -4813,25 +5282,16 @@ class DeepTCR_WF(DeepTCR_S_base):
             self.test_idx = np.isin(self.sample_id,self.test[0])
 
             if write:
-                if self.use_alpha is True:
-                    var_save = [self.alpha_features,self.alpha_indices,self.alpha_sequences]
-                    with open(os.path.join(self.Name, self.Name) + '_alpha_features.pkl', 'wb') as f:
-                        pickle.dump(var_save, f)
-
-                if self.use_beta is True:
-                    var_save = [self.beta_features,self.beta_indices,self.beta_sequences]
-                    with open(os.path.join(self.Name, self.Name) + '_beta_features.pkl', 'wb') as f:
-                        pickle.dump(var_save, f)
-
-                with open(os.path.join(self.Name, self.Name) + '_kernel.pkl', 'wb') as f:
-                    pickle.dump(self.kernel, f)
+                self._save_features()
 
                 if self.use_hla:
                     self.HLA_embed = GO.embedding_layer_hla.eval()
 
                 # save model data and information for inference engine
-                save_model_data(self, GO.saver, sess, name='WF', get=GO.predicted,iteration=iteration)
+                save_model_data(self, GO.saver, sess, name='WF', get=GO.predicted,iteration=iteration,arch=GO.arch)
 
+            history.write(model_dir)
+            self.history = history
             print('Done Training')
 
     def Train(self,kernel=5,num_concepts=12,trainable_embedding = True,embedding_dim_aa=64, embedding_dim_genes=48, embedding_dim_hla=12,
@@ -4841,8 +5301,8 @@ class DeepTCR_WF(DeepTCR_S_base):
                drop_out_rate=0.0,multisample_dropout=False, multisample_dropout_rate = 0.50,multisample_dropout_num_masks = 64,
                batch_size = 25,batch_size_update = None, epochs_min = 25,stop_criterion=0.25,stop_criterion_window=10,
               accuracy_min = None,train_loss_min=None,hinge_loss_t=0.0,convergence='validation',learning_rate=0.001, suppress_output=False,
-              loss_criteria='mean',
-              batch_seed = None):
+              loss_criteria='mean',aggregation='sparse',pooling='sum',
+              batch_seed = None,eval_every = 1):
 
         """
         Train Whole-Sample Classifier
@@ -5005,12 +5465,28 @@ class DeepTCR_WF(DeepTCR_S_base):
             increase the rate of convergence but can introduce instability into training. For most,
             altering this value will not be necessary.
 
+        aggregation: str
+            How per-sequence features are pooled into each repertoire. 'sparse' (default) multiplies by a
+            sparse assignment matrix built for every batch. 'segment' instead feeds the sample index of every
+            sequence and pools with segment operations in the graph, which avoids building the sparse matrix
+            and is cheaper for large repertoires. Models trained with either option can be used with Sample_Inference.
+
+        pooling: str
+            Pooling function applied over the sequences of a repertoire when aggregation is 'segment'.
+            Options are 'sum' (equivalent to the 'sparse' aggregation), 'mean', and 'max'.
+
         suppress_output: bool
             To suppress command line output with training statisitcs, set to True.
 
         batch_seed: int
             For deterministic batching during training, set this value to an integer of choice.
 
+        eval_every: int
+            Number of epochs between passes over the validation partition. Regardless of this value, validation
+            is also run on every epoch the early stopping criterion reads when convergence is assessed on the
+            validation loss, and on the final epoch. Set to None to only run it when needed for early stopping.
+            The test partition is evaluated once, after the final epoch, in the same pass as the final validation.
+
         Returns
         ---------------------------------------
 
@@ -5024,8 +5500,8 @@ class DeepTCR_WF(DeepTCR_S_base):
                drop_out_rate,multisample_dropout, multisample_dropout_rate,multisample_dropout_num_masks,
                batch_size,batch_size_update, epochs_min,stop_criterion,stop_criterion_window,
               accuracy_min,train_loss_min,hinge_loss_t,convergence,learning_rate, suppress_output,
-                    loss_criteria)
-        self._train(write=True,batch_seed=batch_seed,iteration=0)
+                    loss_criteria,aggregation,pooling)
+        self._train(write=True,batch_seed=batch_seed,iteration=0,eval_every=eval_every)
 
     def Monte_Carlo_CrossVal(self,folds=5,test_size=0.25,LOO=None,combine_train_valid=False,random_perm=False,seeds=None,
                              kernel=5, num_concepts=12, trainable_embedding=True, embedding_dim_aa=64, embedding_dim_genes=48, embedding_dim_hla=12,
@@ -5035,8 +5511,8 @@ class DeepTCR_WF(DeepTCR_S_base):
                              drop_out_rate=0.0, multisample_dropout=False, multisample_dropout_rate=0.50,multisample_dropout_num_masks=64,
                              batch_size=25, batch_size_update=None, epochs_min=25, stop_criterion=0.25, stop_criterion_window=10,
                              accuracy_min=None, train_loss_min=None, hinge_loss_t=0.0, convergence='validation',learning_rate=0.001, suppress_output=False,
-                             loss_criteria='mean',
-                             batch_seed=None):
+                             loss_criteria='mean',aggregation='sparse',pooling='sum',
+                             batch_seed=None,eval_every=1,n_jobs=1,threads_per_job=None):
 
         """
         Monte Carlo Cross-Validation for Whole Sample Classifier
@@ -5229,12 +5705,41 @@ class DeepTCR_WF(DeepTCR_S_base):
             increase the rate of convergence but can introduce instability into training. For most,
             altering this value will not be necessary.
 
+        aggregation: str
+            How per-sequence features are pooled into each repertoire. 'sparse' (default) multiplies by a
+            sparse assignment matrix built for every batch. 'segment' instead feeds the sample index of every
+            sequence and pools with segment operations in the graph, which avoids building the sparse matrix
+            and is cheaper for large repertoires. Models trained with either option can be used with Sample_Inference.
+
+        pooling: str
+            Pooling function applied over the sequences of a repertoire when aggregation is 'segment'.
+            Options are 'sum' (equivalent to the 'sparse' aggregation), 'mean', and 'max'.
+
         suppress_output: bool
             To suppress command line output with training statisitcs, set to True.
 
         batch_seed: int
             For deterministic batching during training, set this value to an integer of choice.
 
+        eval_every: int
+            Number of epochs between passes over the validation partition. Regardless of this value, validation
+            is also run on every epoch the early stopping criterion reads when convergence is assessed on the
+            validation loss, and on the final epoch. Set to None to only run it when needed for early stopping.
+            The test partition is evaluated once, after the final epoch, in the same pass as the final validation.
+
+        n_jobs: int
+            Number of folds to train at the same time. With the default of 1, folds are trained one after another
+            in this process. When set higher, all train/valid/test splits are drawn first and the folds are trained on
+            CPU in separate worker processes, each continuing from the random state its split left so batches are drawn
+            as in a sequential run. With seeds (or batch_seed) and graph_seed set, every fold is deterministic and matches
+            n_jobs=1; without them, folds are only as reproducible as a sequential run. Models, predictions
+            and y_test/y_pred are merged in fold order exactly as in a sequential run. Because workers are started with
+            the 'spawn' method, scripts calling this must be guarded by if __name__ == '__main__'.
+
+        threads_per_job: int
+            Number of tensorflow threads each worker may use when n_jobs > 1. By default, the available
+            cores are divided evenly between the workers.
+
         Returns
 
         self.DFs_pred: dict of dataframes
@@ -5250,25 +5755,24 @@ class DeepTCR_WF(DeepTCR_S_base):
         self.predicted = np.zeros_like(self.predicted)
         counts = np.zeros_like(self.predicted)
         self._reset_models()
-        self._build(kernel, num_concepts, trainable_embedding, embedding_dim_aa, embedding_dim_genes, embedding_dim_hla,
+        build_args = (kernel, num_concepts, trainable_embedding, embedding_dim_aa, embedding_dim_genes, embedding_dim_hla,
                     num_fc_layers, units_fc, weight_by_class, class_weights,
                     use_only_seq, use_only_gene, use_only_hla, size_of_net, graph_seed,
                     qualitative_agg, quantitative_agg, num_agg_layers, units_agg,
                     drop_out_rate, multisample_dropout, multisample_dropout_rate, multisample_dropout_num_masks,
                     batch_size, batch_size_update, epochs_min, stop_criterion, stop_criterion_window,
                     accuracy_min, train_loss_min, hinge_loss_t, convergence, learning_rate, suppress_output,
-                    loss_criteria)
+                    loss_criteria,aggregation,pooling)
+        self._build(*build_args)
 
-        for i in range(0, folds):
-            if suppress_output is False:
-                print(i)
+        def split(i):
             if seeds is not None:
                 np.random.seed(seeds[i])
 
             self.Get_Train_Valid_Test(test_size=test_size, LOO=LOO,combine_train_valid=combine_train_valid,
                                       random_perm=random_perm)
-            self._train(write=True,batch_seed=batch_seed,iteration=i)
 
+        for i in self._run_folds(folds,split,build_args,{'write':True,'batch_seed':batch_seed,'eval_every':eval_every},n_jobs,threads_per_job):
             y_test.append(self.y_test)
             y_pred.append(self.y_pred)
             files.append(self.test[0])
@@ -5314,8 +5818,8 @@ class DeepTCR_WF(DeepTCR_S_base):
                         drop_out_rate=0.0, multisample_dropout=False, multisample_dropout_rate=0.50, multisample_dropout_num_masks=64,
                         batch_size=25, batch_size_update=None, epochs_min=25, stop_criterion=0.25, stop_criterion_window=10,
                         accuracy_min=None, train_loss_min=None, hinge_loss_t=0.0, convergence='validation', learning_rate=0.001, suppress_output=False,
-                        loss_criteria='mean',
-                        batch_seed=None):
+                        loss_criteria='mean',aggregation='sparse',pooling='sum',
+                        batch_seed=None,eval_every=1,n_jobs=1,threads_per_job=None):
 
         """
         K_Fold Cross-Validation for Whole Sample Classifier
@@ -5345,6 +5849,7 @@ class DeepTCR_WF(DeepTCR_S_base):
         seeds: nd.array
             In order to set a deterministic train/test split over the K-Fold Simulations, one can provide an array
             of seeds for each K-fold simulation. This will result in the same train/test split over the N Fold simulations.
+            Each seed also sets the validation split and batch order of its fold.
             This parameter, if provided, should have the same size of the value of folds.
 
         Model Parameters
@@ -5499,12 +6004,41 @@ class DeepTCR_WF(DeepTCR_S_base):
             increase the rate of convergence but can introduce instability into training. For most,
             altering this value will not be necessary.
 
+        aggregation: str
+            How per-sequence features are pooled into each repertoire. 'sparse' (default) multiplies by a
+            sparse assignment matrix built for every batch. 'segment' instead feeds the sample index of every
+            sequence and pools with segment operations in the graph, which avoids building the sparse matrix
+            and is cheaper for large repertoires. Models trained with either option can be used with Sample_Inference.
+
+        pooling: str
+            Pooling function applied over the sequences of a repertoire when aggregation is 'segment'.
+            Options are 'sum' (equivalent to the 'sparse' aggregation), 'mean', and 'max'.
+
         suppress_output: bool
             To suppress command line output with training statisitcs, set to True.
 
         batch_seed: int
             For deterministic batching during training, set this value to an integer of choice.
 
+        eval_every: int
+            Number of epochs between passes over the validation partition. Regardless of this value, validation
+            is also run on every epoch the early stopping criterion reads when convergence is assessed on the
+            validation loss, and on the final epoch. Set to None to only run it when needed for early stopping.
+            The test partition is evaluated once, after the final epoch, in the same pass as the final validation.
+
+        n_jobs: int
+            Number of folds to train at the same time. With the default of 1, folds are trained one after another
+            in this process. When set higher, all train/valid/test splits are drawn first and the folds are trained on
+            CPU in separate worker processes, each continuing from the random state its split left so batches are drawn
+            as in a sequential run. With seeds (or batch_seed) and graph_seed set, every fold is deterministic and matches
+            n_jobs=1; without them, folds are only as reproducible as a sequential run. Models, predictions
+            and y_test/y_pred are merged in fold order exactly as in a sequential run. Because workers are started with
+            the 'spawn' method, scripts calling this must be guarded by if __name__ == '__main__'.
+
+        threads_per_job: int
+            Number of tensorflow threads each worker may use when n_jobs > 1. By default, the available
+            cores are divided evenly between the workers.
+
         Returns
         ---------------------------------------
 
@@ -5538,20 +6072,21 @@ class DeepTCR_WF(DeepTCR_S_base):
             idx_left = np.setdiff1d(idx_left, idx_sel)
 
         self._reset_models()
-        self._build(kernel, num_concepts, trainable_embedding, embedding_dim_aa, embedding_dim_genes, embedding_dim_hla,
+        build_args = (kernel, num_concepts, trainable_embedding, embedding_dim_aa, embedding_dim_genes, embedding_dim_hla,
                     num_fc_layers, units_fc, weight_by_class, class_weights,
                     use_only_seq, use_only_gene, use_only_hla, size_of_net, graph_seed,
                     qualitative_agg, quantitative_agg, num_agg_layers, units_agg,
                     drop_out_rate, multisample_dropout, multisample_dropout_rate, multisample_dropout_num_masks,
                     batch_size, batch_size_update, epochs_min, stop_criterion, stop_criterion_window,
                     accuracy_min, train_loss_min, hinge_loss_t, convergence, learning_rate, suppress_output,
-                    loss_criteria)
+                    loss_criteria,aggregation,pooling)
+        self._build(*build_args)
 
         y_test = []
         y_pred = []
-        for ii in range(folds):
-            if suppress_output is False:
-                print(ii)
+        def split(ii):
+            if seeds is not None:
+                np.random.seed(seeds[ii])
             train_idx = np.setdiff1d(idx,test_idx[ii])
             valid_idx = np.random.choice(train_idx,len(train_idx)//(folds-1),replace=False)
             train_idx = np.setdiff1d(train_idx,valid_idx)
@@ -5566,8 +6101,8 @@ class DeepTCR_WF(DeepTCR_S_base):
                     self.valid[i] = self.test[i]
 
             self.LOO = None
-            self._train(write=True, batch_seed=batch_seed, iteration=ii)
 
+        for ii in self._run_folds(folds,split,build_args,{'write':True,'batch_seed':batch_seed,'eval_every':eval_every},n_jobs,threads_per_job):
             y_test.append(self.y_test)
             y_pred.append(self.y_pred)
 
@@ -5602,96 +6137,101 @@ class DeepTCR_WF(DeepTCR_S_base):
         sample_labels = data.sample_labels
         get = data.get
 
-        tf.reset_default_graph()
-        config = tf.ConfigProto(allow_soft_placement=True)
-        config.gpu_options.allow_growth = True
-        with tf.device(self.device):
-            saver = tf.train.import_meta_graph(os.path.join(self.Name, 'models', model, 'model.ckpt.meta'),clear_devices=True)
-        graph = tf.get_default_graph()
-        with tf.Session(graph=graph,config=config) as sess:
-            saver.restore(sess, tf.train.latest_checkpoint(os.path.join(self.Name,'models', model)))
-
-            X_Freq = graph.get_tensor_by_name('Freq:0')
-            X_Counts = graph.get_tensor_by_name('Counts:0')
-            sp_i = graph.get_tensor_by_name('sp/indices:0')
-            sp_v = graph.get_tensor_by_name('sp/values:0')
-            sp_s = graph.get_tensor_by_name('sp/shape:0')
+        #a list of models is run as one merged ensemble graph, returning [n_models, n_samples, ...]
+        ensemble = isinstance(model,list)
+        if ensemble:
+            graph,sess,get = self.model_cache.get_ensemble([os.path.join(self.Name,'models', m) for m in model],get,self.device)
+        else:
+            graph,sess = self.model_cache.get(os.path.join(self.Name,'models', model),self.device)
 
-            if self.use_alpha is True:
-                X_Seq_alpha_v = graph.get_tensor_by_name('Input_Alpha:0')
+        X_Freq = graph.get_tensor_by_name('Freq:0')
+        X_Counts = graph.get_tensor_by_name('Counts:0')
+        sp_i = graph.get_tensor_by_name('sp/indices:0')
+        sp_v = graph.get_tensor_by_name('sp/values:0')
+        sp_s = graph.get_tensor_by_name('sp/shape:0')
 
-            if self.use_beta is True:
-                X_Seq_beta_v = graph.get_tensor_by_name('Input_Beta:0')
+        #models trained with aggregation='segment' pool over a sample index placeholder
+        try:
+            X_seg = graph.get_tensor_by_name('seg:0')
+            X_n_seg = graph.get_tensor_by_name('n_seg:0')
+            segment = True
+        except KeyError:
+            segment = False
 
-            if self.use_v_beta is True:
-                X_v_beta = graph.get_tensor_by_name('Input_V_Beta:0')
+        if self.use_alpha is True:
+            X_Seq_alpha_v = graph.get_tensor_by_name('Input_Alpha:0')
 
-            if self.use_d_beta is True:
-                X_d_beta = graph.get_tensor_by_name('Input_D_Beta:0')
+        if self.use_beta is True:
+            X_Seq_beta_v = graph.get_tensor_by_name('Input_Beta:0')
 
-            if self.use_j_beta is True:
-                X_j_beta = graph.get_tensor_by_name('Input_J_Beta:0')
+        if self.use_v_beta is True:
+            X_v_beta = graph.get_tensor_by_name('Input_V_Beta:0')
 
-            if self.use_v_alpha is True:
-                X_v_alpha = graph.get_tensor_by_name('Input_V_Alpha:0')
+        if self.use_d_beta is True:
+            X_d_beta = graph.get_tensor_by_name('Input_D_Beta:0')
 
-            if self.use_j_alpha is True:
-                X_j_alpha = graph.get_tensor_by_name('Input_J_Alpha:0')
+        if self.use_j_beta is True:
+            X_j_beta = graph.get_tensor_by_name('Input_J_Beta:0')
 
-            if self.use_hla:
-                X_hla = graph.get_tensor_by_name('HLA:0')
+        if self.use_v_alpha is True:
+            X_v_alpha = graph.get_tensor_by_name('Input_V_Alpha:0')
 
-            get_obj = graph.get_tensor_by_name(get)
+        if self.use_j_alpha is True:
+            X_j_alpha = graph.get_tensor_by_name('Input_J_Alpha:0')
 
-            out_list = []
-            sample_list = np.unique(sample_labels)
-            for vars in get_batches([sample_list], batch_size=batch_size, random=False):
-                var_idx = np.where(np.isin(sample_labels, vars[0]))[0]
-                lb = LabelEncoder()
-                lb.fit(vars[0])
-                i = lb.transform(sample_labels[var_idx])
+        if self.use_hla:
+            X_hla = graph.get_tensor_by_name('HLA:0')
 
-                OH = OneHotEncoder(categories='auto')
-                sp = OH.fit_transform(i.reshape(-1, 1)).T
-                sp = sp.tocoo()
-                indices = np.mat([sp.row, sp.col]).T
+        get_obj = graph.get_tensor_by_name(get)
 
-                feed_dict = {X_Freq: freq[var_idx],
-                             X_Counts: counts[var_idx],
-                             sp_i: indices,
-                             sp_v: sp.data,
-                             sp_s: sp.shape}
+        out_list = []
+        sample_list = data.sample_index.groups
+        for vars in get_batches([sample_list], batch_size=batch_size, random=False):
+            var_idx,i = data.sample_index.rows(vars[0])
 
-                if self.use_alpha is True:
-                    feed_dict[X_Seq_alpha_v] = X_Seq_alpha[var_idx]
-                if self.use_beta is True:
-                    feed_dict[X_Seq_beta_v] = X_Seq_beta[var_idx]
+            feed_dict = {X_Freq: freq[var_idx],
+                         X_Counts: counts[var_idx]}
 
-                if self.use_v_beta is True:
-                    feed_dict[X_v_beta] = v_beta_num[var_idx]
+            if segment is True:
+                feed_dict[X_seg] = i
+                feed_dict[X_n_seg] = len(vars[0])
+            else:
+                sp = Segment_Sparse(i,len(vars[0]))
+                feed_dict[sp_i] = sp.indices
+                feed_dict[sp_v] = sp.values
+                feed_dict[sp_s] = sp.dense_shape
 
-                if self.use_d_beta is True:
-                    feed_dict[X_d_beta] = d_beta_num[var_idx]
+            if self.use_alpha is True:
+                feed_dict[X_Seq_alpha_v] = X_Seq_alpha[var_idx]
+            if self.use_beta is True:
+                feed_dict[X_Seq_beta_v] = X_Seq_beta[var_idx]
 
-                if self.use_j_beta is True:
-                    feed_dict[X_j_beta] = j_beta_num[var_idx]
+            if self.use_v_beta is True:
+                feed_dict[X_v_beta] = v_beta_num[var_idx]
 
-                if self.use_v_alpha is True:
-                    feed_dict[X_v_alpha] = v_alpha_num[var_idx]
+            if self.use_d_beta is True:
+                feed_dict[X_d_beta] = d_beta_num[var_idx]
 
-                if self.use_j_alpha is True:
-                    feed_dict[X_j_alpha] = j_alpha_num[var_idx]
+            if self.use_j_beta is True:
+                feed_dict[X_j_beta] = j_beta_num[var_idx]
 
-                if self.use_hla:
-                    feed_dict[X_hla] = hla_data_seq_num[var_idx]
+            if self.use_v_alpha is True:
+                feed_dict[X_v_alpha] = v_alpha_num[var_idx]
+
+            if self.use_j_alpha is True:
+                feed_dict[X_j_alpha] = j_alpha_num[var_idx]
+
+            if self.use_hla:
+                feed_dict[X_hla] = hla_data_seq_num[var_idx]
 
-                out_list.append(sess.run(get_obj,feed_dict=feed_dict))
+            out_list.append(sess.run(get_obj,feed_dict=feed_dict))
 
-        out_list = np.vstack(out_list)
+        out_list = np.concatenate(out_list,axis=1 if ensemble else 0)
         return sample_list, out_list
 
     def Sample_Inference(self,sample_labels=None,alpha_sequences=None, beta_sequences=None, v_beta=None, d_beta=None, j_beta=None,
-                  v_alpha=None, j_alpha=None, p=None,hla=None,freq=None,counts=None, batch_size=10,models=None,return_dist=False):
+                  v_alpha=None, j_alpha=None, p=None,hla=None,freq=None,counts=None, batch_size=10,models=None,return_dist=False,
+                  ensemble=False):
 
         """
         Predicting outputs of sample/repertoire model on new data
@@ -5768,6 +6308,11 @@ class DeepTCR_WF(DeepTCR_S_base):
             If the user wants to also return teh distribution of sequence predicionts over all models use dfor inference,
             one should set this value to True.
 
+        ensemble: bool
+            When several models are used, set to True to load them all into a single graph that shares the inputs,
+            so every batch is fed once and evaluated by all models in one run. This returns the same predictions
+            with lower latency, at the cost of keeping all of the selected models in memory at the same time.
+
         Returns
 
         self.Inference_Sample_List: ndarray
@@ -5807,14 +6352,8 @@ class DeepTCR_WF(DeepTCR_S_base):
 
         model_type, get  = load_model_data(self)
 
-        if p is None:
-            p = Pool(40)
-
         if alpha_sequences is not None:
-            args = list(
-                zip(alpha_sequences, [self.aa_idx] * len(alpha_sequences), [self.max_length] * len(alpha_sequences)))
-            result = p.starmap(Embed_Seq_Num, args)
-            sequences_num = np.vstack(result)
+            sequences_num = Embed_Seq_Num_Batch(alpha_sequences, self.aa_idx, self.max_length)
             X_Seq_alpha = np.expand_dims(sequences_num, 1)
         else:
             X_Seq_alpha = np.zeros(shape=[len_input,self.max_length])
@@ -5822,10 +6361,7 @@ class DeepTCR_WF(DeepTCR_S_base):
             alpha_sequences = np.asarray([None] * len_input)
 
         if beta_sequences is not None:
-            args = list(
-                zip(beta_sequences, [self.aa_idx] * len(beta_sequences), [self.max_length] * len(beta_sequences)))
-            result = p.starmap(Embed_Seq_Num, args)
-            sequences_num = np.vstack(result)
+            sequences_num = Embed_Seq_Num_Batch(beta_sequences, self.aa_idx, self.max_length)
             X_Seq_beta = np.expand_dims(sequences_num, 1)
         else:
             X_Seq_beta = np.zeros(shape=[len_input,self.max_length])
@@ -5888,24 +6424,12 @@ class DeepTCR_WF(DeepTCR_S_base):
                 hla_data_seq_num = np.zeros(shape=[len_input,1])
                 pass
 
-        if p is None:
-            p.close()
-            p.join()
-
         if (counts is None) & (freq is None):
             counts = np.ones(shape=len_input)
 
-        if counts is not None:
-            count_dict={}
-            for s in np.unique(sample_labels):
-                idx = sample_labels==s
-                count_dict[s]=np.sum(counts[idx])
-
+        sample_index = group_index(sample_labels)
         if freq is None:
-            freq = []
-            for c,n in zip(counts,sample_labels):
-                freq.append(c/count_dict[n])
-            freq = np.asarray(freq)
+            freq = counts/sample_index.sum(counts)[sample_index.codes]
 
         data = graph_object()
         data.X_Seq_alpha = X_Seq_alpha
@@ -5920,6 +6444,7 @@ class DeepTCR_WF(DeepTCR_S_base):
         data.counts = counts
         data.batch_size = batch_size
         data.sample_labels = sample_labels
+        data.sample_index = sample_index
         data.get = get
 
         if models is None:
@@ -5928,9 +6453,13 @@ class DeepTCR_WF(DeepTCR_S_base):
             models = [f for f in models if not f.startswith('.')]
 
         predicted = []
-        for m in models:
-            sample_list,pred = self._inf(data,model=m)
-            predicted.append(pred)
+        if ensemble is True:
+            sample_list,pred = self._inf(data,model=list(models))
+            predicted = list(pred)
+        else:
+            for m in models:
+                sample_list,pred = self._inf(data,model=m)
+                predicted.append(pred)
 
         predicted_dist = []
         for p in predicted:
@@ -1,9 +1,15 @@
 import tensorflow as tf
+from DeepTCR.functions.data_processing import Trim_Widths
 
 class graph_object(object):
     def __init__(self):
         self.init=0
 
+def Record_Block(GO,block,start):
+    #names of the variables a block of layers created since len(tf.global_variables()) was start;
+    #saved with the model so its forward pass can be exported and re-run outside tensorflow
+    GO.arch['variables'][block] = [v.name for v in tf.global_variables()[start:]]
+
 #Common layers
 def Get_Gene_Features(self,embedding_dim_genes,gene_features):
     if self.use_v_beta is True:
@@ -11,7 +17,7 @@ def Get_Gene_Features(self,embedding_dim_genes,gene_features):
         X_v_beta_OH = tf.one_hot(X_v_beta, depth=len(self.lb_v_beta.classes_))
         embedding_layer_v_beta = tf.get_variable(name='Embedding_V_beta',
                                                  shape=[len(self.lb_v_beta.classes_), embedding_dim_genes])
-        X_v_beta_embed = tf.matmul(X_v_beta_OH, embedding_layer_v_beta)
+        X_v_beta_embed = tf.nn.embedding_lookup(embedding_layer_v_beta, X_v_beta)
         gene_features.append(X_v_beta_embed)
     else:
         X_v_beta = None
@@ -23,7 +29,7 @@ def Get_Gene_Features(self,embedding_dim_genes,gene_features):
         X_d_beta_OH = tf.one_hot(X_d_beta, depth=len(self.lb_d_beta.classes_))
         embedding_layer_d_beta = tf.get_variable(name='Embedding_D_beta',
                                                  shape=[len(self.lb_d_beta.classes_), embedding_dim_genes])
-        X_d_beta_embed = tf.matmul(X_d_beta_OH, embedding_layer_d_beta)
+        X_d_beta_embed = tf.nn.embedding_lookup(embedding_layer_d_beta, X_d_beta)
         gene_features.append(X_d_beta_embed)
     else:
         X_d_beta = None
@@ -35,7 +41,7 @@ def Get_Gene_Features(self,embedding_dim_genes,gene_features):
         X_j_beta_OH = tf.one_hot(X_j_beta, depth=len(self.lb_j_beta.classes_))
         embedding_layer_j_beta = tf.get_variable(name='Embedding_J_Beta',
                                                  shape=[len(self.lb_j_beta.classes_), embedding_dim_genes])
-        X_j_beta_embed = tf.matmul(X_j_beta_OH, embedding_layer_j_beta)
+        X_j_beta_embed = tf.nn.embedding_lookup(embedding_layer_j_beta, X_j_beta)
         gene_features.append(X_j_beta_embed)
     else:
         X_j_beta = None
@@ -47,7 +53,7 @@ def Get_Gene_Features(self,embedding_dim_genes,gene_features):
         X_v_alpha_OH = tf.one_hot(X_v_alpha, depth=len(self.lb_v_alpha.classes_))
         embedding_layer_v_alpha = tf.get_variable(name='Embedding_V_Alpha',
                                                  shape=[len(self.lb_v_alpha.classes_), embedding_dim_genes])
-        X_v_alpha_embed = tf.matmul(X_v_alpha_OH, embedding_layer_v_alpha)
+        X_v_alpha_embed = tf.nn.embedding_lookup(embedding_layer_v_alpha, X_v_alpha)
         gene_features.append(X_v_alpha_embed)
     else:
         X_v_alpha = None
@@ -59,7 +65,7 @@ def Get_Gene_Features(self,embedding_dim_genes,gene_features):
         X_j_alpha_OH = tf.one_hot(X_j_alpha, depth=len(self.lb_j_alpha.classes_))
         embedding_layer_j_alpha = tf.get_variable(name='Embedding_J_Alpha',
                                                  shape=[len(self.lb_j_alpha.classes_), embedding_dim_genes])
-        X_j_alpha_embed = tf.matmul(X_j_alpha_OH, embedding_layer_j_alpha)
+        X_j_alpha_embed = tf.nn.embedding_lookup(embedding_layer_j_alpha, X_j_alpha)
         gene_features.append(X_j_alpha_embed)
     else:
         X_j_alpha = None
@@ -80,7 +86,11 @@ def Get_HLA_Features(self,GO,embedding_dim):
     GO.X_hla = tf.placeholder(tf.float32, shape=[None, self.hla_data_seq_num.shape[1]], name='HLA')
     GO.embedding_layer_hla = tf.get_variable(name='Embedding_HLA',
                                           shape=[len(self.lb_hla.classes_), embedding_dim])
-    GO.HLA_Features = tf.matmul(GO.X_hla,GO.embedding_layer_hla)
+    #sum of the embeddings of the alleles present, gathered rather than multiplied through the multi-hot matrix
+    idx = tf.where(tf.not_equal(GO.X_hla,0.0))
+    weights = tf.gather_nd(GO.X_hla,idx)
+    embed = tf.nn.embedding_lookup(GO.embedding_layer_hla,idx[:,1])*weights[:,tf.newaxis]
+    GO.HLA_Features = tf.math.unsorted_segment_sum(embed,idx[:,0],tf.shape(GO.X_hla,out_type=tf.int64)[0])
     return GO.HLA_Features
 
 def Convolutional_Features(inputs,reuse=False,prob=0.0,name='Convolutional_Features',kernel=3,net='ae',
@@ -120,15 +130,29 @@ def Convolutional_Features(inputs,reuse=False,prob=0.0,name='Convolutional_Featu
 def Conv_Model(GO, self, trainable_embedding, kernel, use_only_seq,
                use_only_gene,use_only_hla,num_fc_layers=0, units_fc=12):
 
+    GO.arch = {'net':GO.net,'use_only_seq':use_only_seq,'use_only_gene':use_only_gene,'use_only_hla':use_only_hla,
+               'variables':{}}
+
+    #with length bucketing, the sequence width is left open so batches can be fed trimmed of trailing padding
+    GO.seq_widths = None
+    width_alpha = width_beta = None
+    if self.use_alpha is True:
+        width_alpha = self.X_Seq_alpha.shape[2]
+    if self.use_beta is True:
+        width_beta = self.X_Seq_beta.shape[2]
+    if (self.length_bucketing is True) and (GO.net == 'sup') and (self.use_alpha or self.use_beta):
+        GO.seq_widths = Trim_Widths(self.max_length,kernel)
+        width_alpha = width_beta = None
+
     if self.use_alpha is True:
         GO.X_Seq_alpha = tf.placeholder(tf.int64,
-                                        shape=[None, self.X_Seq_alpha.shape[1], self.X_Seq_alpha.shape[2]],
+                                        shape=[None, self.X_Seq_alpha.shape[1], width_alpha],
                                         name='Input_Alpha')
         GO.X_Seq_alpha_OH = tf.one_hot(GO.X_Seq_alpha, depth=21)
 
     if self.use_beta is True:
         GO.X_Seq_beta = tf.placeholder(tf.int64,
-                                       shape=[None, self.X_Seq_beta.shape[1], self.X_Seq_beta.shape[2]],
+                                       shape=[None, self.X_Seq_beta.shape[1], width_beta],
                                        name='Input_Beta')
         GO.X_Seq_beta_OH = tf.one_hot(GO.X_Seq_beta, depth=21)
 
@@ -147,18 +171,22 @@ def Conv_Model(GO, self, trainable_embedding, kernel, use_only_seq,
     GO.X_v_alpha, GO.X_v_alpha_OH, GO.embedding_layer_v_alpha, \
     GO.X_j_alpha, GO.X_j_alpha_OH, GO.embedding_layer_j_alpha, \
     gene_features = Get_Gene_Features(self, GO.embedding_dim_genes, gene_features)
+    for name,layer in [('v_beta',GO.embedding_layer_v_beta),('d_beta',GO.embedding_layer_d_beta),
+                       ('j_beta',GO.embedding_layer_j_beta),('v_alpha',GO.embedding_layer_v_alpha),
+                       ('j_alpha',GO.embedding_layer_j_alpha)]:
+        if layer is not None:
+            GO.arch['variables'][name] = [layer.name]
 
     if trainable_embedding is True:
         # AA Embedding
         with tf.variable_scope('AA_Embedding'):
-            GO.embedding_layer_seq = tf.get_variable(name='Embedding_Layer_Seq', shape=[21, GO.embedding_dim_aa])
-            GO.embedding_layer_seq = tf.expand_dims(tf.expand_dims(GO.embedding_layer_seq, axis=0), axis=0)
+            embedding_layer_seq = tf.get_variable(name='Embedding_Layer_Seq', shape=[21, GO.embedding_dim_aa])
+            GO.arch['variables']['aa'] = [embedding_layer_seq.name]
+            GO.embedding_layer_seq = tf.expand_dims(tf.expand_dims(embedding_layer_seq, axis=0), axis=0)
             if self.use_alpha is True:
-                inputs_seq_embed_alpha = tf.squeeze(
-                    tf.tensordot(GO.X_Seq_alpha_OH, GO.embedding_layer_seq, axes=(3, 2)), axis=(3, 4))
+                inputs_seq_embed_alpha = tf.nn.embedding_lookup(embedding_layer_seq, GO.X_Seq_alpha)
             if self.use_beta is True:
-                inputs_seq_embed_beta = tf.squeeze(
-                    tf.tensordot(GO.X_Seq_beta_OH, GO.embedding_layer_seq, axes=(3, 2)), axis=(3, 4))
+                inputs_seq_embed_beta = tf.nn.embedding_lookup(embedding_layer_seq, GO.X_Seq_beta)
 
     else:
         if self.use_alpha is True:
@@ -169,16 +197,20 @@ def Conv_Model(GO, self, trainable_embedding, kernel, use_only_seq,
 
     # Convolutional Features
     if self.use_alpha is True:
+        start = len(tf.global_variables())
         GO.Seq_Features_alpha, GO.alpha_out, GO.indices_alpha = Convolutional_Features(inputs_seq_embed_alpha,
                                                                                        kernel=kernel,
                                                                                        name='alpha_conv', prob=GO.prob,
                                                                                        net=GO.net,size_of_net=GO.size_of_net)
+        Record_Block(GO,'alpha_conv',start)
 
     if self.use_beta is True:
+        start = len(tf.global_variables())
         GO.Seq_Features_beta, GO.beta_out, GO.indices_beta = Convolutional_Features(inputs_seq_embed_beta,
                                                                                     kernel=kernel,
                                                                                     name='beta_conv', prob=GO.prob,
                                                                                     net=GO.net,size_of_net=GO.size_of_net)
+        Record_Block(GO,'beta_conv',start)
 
     Seq_Features = []
     if self.use_alpha is True:
@@ -207,6 +239,7 @@ def Conv_Model(GO, self, trainable_embedding, kernel, use_only_seq,
 
     if self.use_hla:
         HLA_Features = Get_HLA_Features(self,GO,GO.embedding_dim_hla)
+        GO.arch['variables']['hla'] = [GO.embedding_layer_hla.name]
         Features = tf.concat((Features,HLA_Features),axis=1)
 
     if use_only_seq:
@@ -224,10 +257,12 @@ def Conv_Model(GO, self, trainable_embedding, kernel, use_only_seq,
     #     Features = tf.layers.dense(Features,Features.shape[1],tf.nn.relu)
 
     fc = Features
+    start = len(tf.global_variables())
     if num_fc_layers != 0:
         for lyr in range(num_fc_layers):
             fc = tf.layers.dropout(fc, GO.prob)
             fc = tf.layers.dense(fc, units_fc, tf.nn.relu)
+    Record_Block(GO,'fc',start)
 
     return fc
 
@@ -254,9 +289,10 @@ def Get_Gene_Loss(fc,embedding_layer,X_OH):
     logits = tf.matmul(upsample3, tf.transpose(embedding_layer))
     loss = tf.nn.softmax_cross_entropy_with_logits_v2(labels=X_OH, logits=logits)
 
+    #per sample accuracy
     predicted = tf.argmax(logits,1)
     actual = tf.argmax(X_OH,1)
-    accuracy = tf.reduce_mean(tf.cast(tf.equal(predicted,actual),tf.float32))
+    accuracy = tf.cast(tf.equal(predicted,actual),tf.float32)
 
     return loss,accuracy
 
@@ -268,7 +304,7 @@ def Get_HLA_Loss(fc,embedding_layer,X_OH,alpha=1.0):
     loss = tf.reduce_mean(tf.nn.sigmoid_cross_entropy_with_logits(labels=X_OH, logits=logits),-1)
 
     predicted = tf.greater(logits,0.9)
-    accuracy = tf.reduce_mean(tf.cast(tf.equal(predicted,tf.cast(X_OH,tf.bool)),tf.float32))
+    accuracy = tf.reduce_mean(tf.cast(tf.equal(predicted,tf.cast(X_OH,tf.bool)),tf.float32),-1)
     return loss, accuracy
 
 
@@ -1,11 +1,15 @@
 from Bio.SubsMat import MatrixInfo
 from Bio.Alphabet import IUPAC
 from collections import OrderedDict
+from contextlib import contextmanager
 import numpy as np
 import pandas as pd
 import re
 import os
 import pickle
+import hashlib
+import time
+import io
 
 def Embed_Seq_Num(seq,aa_idx,maxlength):
     seq_embed = np.zeros((1, maxlength)).astype('int64')
@@ -16,6 +20,170 @@ def Embed_Seq_Num(seq,aa_idx,maxlength):
             n += 1
     return seq_embed
 
+def Embed_Seq_Num_Batch(seqs,aa_idx,maxlength):
+    #encode each unique sequence once through a byte view and a lookup table
+    seqs, inverse = np.unique(np.asarray(seqs).astype(str), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    seqs[seqs == 'null'] = ''
+    seq_len = np.char.str_len(seqs)
+    if np.any(seq_len > maxlength):
+        raise Exception('{} sequences are longer than max_length ({})!'.format(np.sum(seq_len > maxlength),maxlength))
+
+    def Unknown_Residues(unknown_seqs,residues):
+        rows = np.where(np.isin(inverse,np.where(unknown_seqs)[0]))[0]
+        raise Exception('{} sequences contain unknown residues {} (first at index {}: {})'.format(
+            len(rows),residues,rows[0],seqs[inverse[rows[0]]]))
+
+    #non-ASCII residues cannot go through the byte view
+    non_ascii = np.array([not s.isascii() for s in seqs],dtype=bool)
+    if np.any(non_ascii):
+        Unknown_Residues(non_ascii,sorted(set(c for s in seqs[non_ascii] for c in s if not c.isascii())))
+
+    lut = np.full(256, -1, dtype='int64')
+    lut[0] = 0
+    for c in aa_idx:
+        lut[ord(c)] = aa_idx[c]
+
+    seq_bytes = seqs.astype('S'+str(maxlength)).view(np.uint8).reshape(-1,maxlength)
+    seq_embed = lut[seq_bytes]
+
+    unknown = seq_embed < 0
+    if np.any(unknown):
+        Unknown_Residues(np.any(unknown,-1),[chr(c) for c in np.unique(seq_bytes[unknown])])
+
+    return seq_embed[inverse]
+
+def Unique_Rows(Vars):
+    #intern identical input rows across all arrays (seq, genes, hla) so they only go through the network once;
+    #returns the first occurrence of each unique row and the map from every row back to its unique row
+    n = len(Vars[0])
+    codes = np.zeros(n,dtype=np.int64)
+    for v in Vars:
+        v = np.asarray(v)
+        if v.dtype.kind not in ('b','i','u','f'):
+            continue
+        _,inv = np.unique(np.ascontiguousarray(v.reshape(n,-1)),axis=0,return_inverse=True)
+        inv = inv.reshape(-1)
+        _,codes = np.unique(codes*(np.max(inv)+1)+inv,return_inverse=True)
+        codes = codes.reshape(-1)
+    _,idx,inverse = np.unique(codes,return_index=True,return_inverse=True)
+    return idx,inverse.reshape(-1)
+
+def Compact_Seq(X_Seq):
+    #residue codes fit in uint8; tensorflow casts back to int64 at the feed
+    return X_Seq.astype(np.uint8,copy=False)
+
+def Compact_Codes(x):
+    #gene indices from LabelEncoder, or zeros when the gene is not used
+    x = np.asarray(x)
+    if x.size and np.max(x) >= np.iinfo(np.int16).max:
+        return x.astype(np.int32,copy=False)
+    return x.astype(np.int16,copy=False)
+
+def Compact_Multi_Hot(x):
+    #hla multi-hot; the 'None' placeholder array is left as is
+    x = np.asarray(x)
+    if x.dtype.kind in ('U','S','O'):
+        return x
+    return x.astype(np.uint8,copy=False)
+
+def Intern_Array(x):
+    #share one python object per unique string instead of a fixed width cell per row
+    x = np.asarray(x)
+    if x.ndim != 1 or x.dtype.kind not in ('U','S','O'):
+        return x
+    codes, uniques = pd.factorize(x)
+    out = np.asarray(uniques,dtype=object)[codes]
+    #missing values (code -1) are kept as they were
+    out[codes < 0] = x[codes < 0]
+    return out
+
+def Reorder_Unique(idx,inverse,order):
+    #reorder the unique rows returned by Unique_Rows while keeping inverse pointing at the same rows
+    pos = np.empty_like(order)
+    pos[order] = np.arange(len(order))
+    return idx[order],pos[inverse]
+
+def _conv_classes(x,k,stride,ids):
+    #symbolic 'same'-padded convolution: each output is the id of the exact window of inputs it sees
+    W = len(x)
+    out = -(-W//stride)
+    pad_total = max((out-1)*stride+k-W,0)
+    pad_left = pad_total//2
+    x = [-1]*pad_left + x + [-1]*(pad_total-pad_left)
+    return [ids.setdefault(tuple(x[o*stride:o*stride+k]),len(ids)) for o in range(out)]
+
+def _pooled_classes(L,W,kernel,ids):
+    #distinct window contents seen by each max-pooled layer of Convolutional_Features
+    x = list(range(L)) + [-2]*(W-L)
+    out = []
+    for k,stride in [(kernel,1),(3,3),(3,3)]:
+        x = _conv_classes(x,k,stride,ids)
+        out.append(set(x))
+    return out
+
+def Trim_Widths(max_length,kernel):
+    #For a batch whose longest sequence has length L, widths[L] is the narrowest padded width at which
+    #every max-pooled output of Convolutional_Features is unchanged from the full max_length width,
+    #for every sequence of length <= L. Padding columns all embed to the same vector, so trailing
+    #padding can be dropped as long as each distinct padding window (and the stride phase) is kept.
+    ids = {}
+    valid = np.zeros((max_length+1,max_length+1),dtype=bool)
+    for L in range(max_length+1):
+        full = _pooled_classes(L,max_length,kernel,ids)
+        for W in range(max(L,1),max_length+1):
+            valid[L,W] = _pooled_classes(L,W,kernel,ids) == full
+    valid = np.logical_and.accumulate(valid,axis=0)
+    widths = np.zeros(max_length+1,dtype=int)
+    for L in range(max_length+1):
+        widths[L] = np.where(valid[L,max(L,1):])[0][0] + max(L,1)
+    return widths
+
+def Seq_Lengths(X):
+    #length of each left-aligned residue code row of an [N,1,max_length] array
+    return np.sum(np.asarray(X).reshape(len(X),-1)>0,axis=1)
+
+def Trim_Seq(X,widths):
+    if widths is None or len(X) == 0:
+        return X
+    return X[:,:,:widths[np.max(Seq_Lengths(X))]]
+
+def Bucket_Keys(widths,*X):
+    #rows sharing a key can be batched together at the same trimmed width
+    keys = np.zeros(len(X[0]),dtype=np.int64)
+    for x in X:
+        keys = keys*len(widths) + widths[Seq_Lengths(x)]
+    return keys
+
+class group_index(object):
+    #CSR-style grouping of rows by label: rows of group g are order[offsets[g]:offsets[g+1]]
+    def __init__(self,labels):
+        self.groups, self.codes = np.unique(labels,return_inverse=True)
+        self.codes = self.codes.reshape(-1)
+        self.order = np.argsort(self.codes,kind='stable')
+        self.counts = np.bincount(self.codes,minlength=len(self.groups))
+        self.offsets = np.concatenate([[0],np.cumsum(self.counts)])
+
+    def lookup(self,labels):
+        return np.searchsorted(self.groups,labels)
+
+    def rows(self,labels):
+        #rows of the requested groups (in the order given) and the position of each row's group
+        c = self.lookup(labels)
+        n = self.counts[c]
+        seg = np.repeat(np.arange(len(c)),n)
+        #offset of each row within its group, computed without a python loop over groups
+        pos = np.arange(len(seg)) - np.repeat(np.cumsum(n)-n,n)
+        rows = self.order[self.offsets[c][seg] + pos]
+        return rows,seg
+
+    def sum(self,x):
+        #per-group sums, groups in sorted label order
+        return np.add.reduceat(np.asarray(x)[self.order],self.offsets[:-1],axis=0)
+
+    def first(self,x):
+        return np.asarray(x)[self.order[self.offsets[:-1]]]
+
 def make_aa_df():
     # load matrix as symmetric pandas dataframe
     aa_df = pd.Series(MatrixInfo.blosum100).unstack()
@@ -58,21 +226,45 @@ def Process_Seq(df,col):
     #Drop null values
     df = df.dropna(subset=[col])
 
-    #strip any white space and remove non-IUPAC characters
+    #strip any white space and remove rows with non-IUPAC characters
     df[col] = df[col].str.strip()
-    searchfor = ['\*', 'X', 'O']
-    df = df[~df[col].str.contains('|'.join(searchfor))]
+    df = df[df[col].str.match('^['+IUPAC.IUPACProtein.letters+']*$')]
 
     return df
 
+compression_ext = ['.gz','.bz2','.zst']
+
+def Strip_Compression_Ext(file):
+    for c in compression_ext:
+        if file.endswith(c):
+            return file[:-len(c)]
+    return file
+
+@contextmanager
+def Open_Repertoire(file):
+    #gzip/bzip2 are streamed by pandas from the path; zstd through the optional zstandard package
+    if not file.endswith('.zst'):
+        yield file
+        return
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('The zstandard package is required to read .zst files')
+    with open(file,'rb') as fh:
+        with io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(fh)) as f:
+            yield f
+
+def Read_Repertoire(file,**kwargs):
+    with Open_Repertoire(file) as f:
+        return pd.read_csv(f,**kwargs)
+
 def Get_DF_Data(file,type_of_data_cut='Fraction_Response',data_cut = 1.0,aa_column_alpha=None,aa_column_beta=None,
                 count_column=None,sep='\t',max_length=40,aggregate_by_aa=True,v_beta_column=None,
                 d_beta_column=None,j_beta_columns=None,
-                v_alpha_column=None,j_alpha_column=None):
+                v_alpha_column=None,j_alpha_column=None,fast_parse=True):
 
     with pd.option_context('mode.chained_assignment', None):
 
-        df = pd.read_csv(file, sep=sep,dtype=object)
         #First collect columns in dataframe based on user preferences
         cols_to_keep = []
         column_names = []
@@ -89,10 +281,6 @@ def Get_DF_Data(file,type_of_data_cut='Fraction_Response',data_cut = 1.0,aa_colu
         if count_column is not None:
             cols_to_keep.append(count_column)
             column_names.append('counts')
-        else:
-            df['counts'] = 1
-            cols_to_keep.append(np.where(df.columns=='counts')[0][0])
-            column_names.append('counts')
 
         if v_alpha_column is not None:
             cols_to_keep.append(v_alpha_column)
@@ -114,10 +302,25 @@ def Get_DF_Data(file,type_of_data_cut='Fraction_Response',data_cut = 1.0,aa_colu
             cols_to_keep.append(j_beta_columns)
             column_names.append('j_beta')
 
-
-        df = df.iloc[:,cols_to_keep]
+        if fast_parse is True:
+            #only parse the requested columns; counts numeric, genes categorical
+            usecols = sorted(set(cols_to_keep))
+            dtype = {}
+            for c,n in zip(cols_to_keep,column_names):
+                if n in sequence_columns:
+                    dtype[c] = object
+                elif n != 'counts':
+                    dtype[c] = 'category'
+            df = Read_Repertoire(file,sep=sep,usecols=usecols,dtype=dtype)
+            #usecols returns columns in file order
+            df = df.iloc[:,[usecols.index(c) for c in cols_to_keep]]
+        else:
+            df = Read_Repertoire(file,sep=sep,dtype=object)
+            df = df.iloc[:,cols_to_keep]
 
         df.columns = column_names
+        if count_column is None:
+            df.insert(len(sequence_columns),'counts',1)
         df.dropna(subset=['counts'],inplace=True)
         df['counts']=df['counts'].astype(int)
 
@@ -156,6 +359,92 @@ def Get_DF_Data(file,type_of_data_cut='Fraction_Response',data_cut = 1.0,aa_colu
 
     return df
 
+def Read_Repertoire_Chunks(file,chunksize,**kwargs):
+    #Read_Repertoire, chunksize rows at a time
+    with Open_Repertoire(file) as f:
+        for df in pd.read_csv(f,chunksize=chunksize,**kwargs):
+            yield df
+
+#names of the Sequence_Inference inputs a stream of chunks can provide
+Stream_Inputs = ['alpha_sequences','beta_sequences','v_beta','d_beta','j_beta','v_alpha','j_alpha','hla']
+
+def Stream_File_Chunks(files,chunk_size,columns,sep='\t',max_length=40,hla=None):
+    #Rows of repertoire files in the Get_Data column layout (columns maps input name to column index), as frames
+    #of at most chunk_size rows with the file and row of origin. Rows are not aggregated; rows with missing,
+    #non-IUPAC or too long sequences are dropped as in Get_DF_Data.
+    usecols = sorted(set(columns.values()))
+    for file in files:
+        file_id = Strip_Compression_Ext(file).split('/')[-1]
+        offset = 0
+        for df in Read_Repertoire_Chunks(file,chunk_size,sep=sep,usecols=usecols,dtype=object):
+            with pd.option_context('mode.chained_assignment', None):
+                df = df.iloc[:,[usecols.index(c) for c in columns.values()]]
+                df.columns = list(columns.keys())
+                df.insert(0,'row',np.arange(offset,offset+len(df)))
+                df.insert(0,'file',file_id)
+                offset += len(df)
+                for col in ['alpha_sequences','beta_sequences']:
+                    if col in df.columns:
+                        df = Process_Seq(df,col)
+                        df = df[df[col].str.len() <= max_length]
+                if hla is not None:
+                    df['hla'] = [hla.get(file_id,np.asarray([]))]*len(df)
+            if len(df) > 0:
+                yield df.reset_index(drop=True)
+
+def Stream_Chunks(data,chunk_size,columns,sep='\t',max_length=40,hla=None):
+    #data is a repertoire file, a directory of them (searched as in Get_Data) or an iterable of
+    #DataFrames/dicts keyed by the Sequence_Inference inputs
+    if isinstance(data,str):
+        if os.path.isdir(data):
+            ext = {'\t':'.tsv',',':'.csv'}.get(sep)
+            if ext is None:
+                raise Exception('Not Valid Delimiter')
+            files = []
+            for root,dirs,fs in os.walk(data):
+                dirs[:] = sorted([d for d in dirs if not d.startswith('.')])
+                files += [os.path.join(root,f) for f in sorted(fs) if Strip_Compression_Ext(f).endswith(ext)]
+        else:
+            files = [data]
+        if hla is not None:
+            hla_df = pd.read_csv(hla)
+            hla_df = hla_df.set_index(hla_df.columns[0])
+            hla = {i:np.asarray(r.dropna().tolist()) for i,r in hla_df.iterrows()}
+        for df in Stream_File_Chunks(files,chunk_size,columns,sep,max_length,hla):
+            yield df
+        return
+
+    for chunk in data:
+        if isinstance(chunk,dict):
+            chunk = pd.DataFrame({k:(list(v) if k == 'hla' else v) for k,v in chunk.items()})
+        #larger chunks are split so memory stays bounded by chunk_size
+        for ii in range(0,len(chunk),chunk_size):
+            yield chunk.iloc[ii:ii+chunk_size].reset_index(drop=True)
+
+def Parse_Cache_Key(file,params):
+    #<hash of the path>_<hash of the file state (size,mtime) + every parameter that changes the parsed frame>,
+    #so outdated entries of a file can be found from its path
+    st = os.stat(file)
+    path = os.path.abspath(file)
+    key = repr((path,st.st_size,st.st_mtime_ns,tuple(params)))
+    return hashlib.md5(path.encode()).hexdigest() + '_' + hashlib.md5(key.encode()).hexdigest()
+
+def Get_DF_Data_Cached(cache_file,*args):
+    #returns the parsed frame, the time it took and whether it came from the cache
+    start = time.time()
+    if cache_file is not None and os.path.exists(cache_file):
+        try:
+            return pd.read_pickle(cache_file),time.time()-start,True
+        except Exception:
+            pass
+
+    df = Get_DF_Data(*args)
+    if cache_file is not None:
+        temp = cache_file + '.' + str(os.getpid())
+        df.to_pickle(temp)
+        os.replace(temp,cache_file)
+    return df,time.time()-start,False
+
 def supertype_conv_op(hla,keep_non_supertype_alleles=False):
     dir_path = os.path.dirname(os.path.realpath(__file__))
     df_supertypes = pd.read_csv(os.path.join(dir_path,'Supertype_Data_Dict.csv'))
@@ -177,8 +466,62 @@ def supertype_conv(df,keep_non_supertype_alleles=False):
     hla_sup = pd.concat([hla_sup, pd.DataFrame(hla_list_sup)], axis=1)
     return hla_sup
 
-def save_model_data(self,saver,sess,name,get,iteration=0):
+def Save_Data_Store(directory,arrays,meta):
+    #one .npy per array + meta.pkl holding encoders and flags; string columns are saved as fixed-width
+    #unicode so they are memory-mapped on load like the numeric ones
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    columns = OrderedDict()
+    for name,x in arrays.items():
+        x = np.asarray(x)
+        if x.dtype.kind == 'O':
+            #object columns of plain strings only; anything else (None placeholders, ragged hla) is pickled
+            if x.ndim == 1 and all([isinstance(v,str) for v in x.tolist()]):
+                x = x.astype(str)
+            else:
+                columns[name] = ('pickle',x)
+                continue
+        np.save(os.path.join(directory,name+'.npy'),x)
+        columns[name] = ('npy',)
+
+    meta = dict(meta)
+    meta['columns'] = columns
+    with open(os.path.join(directory,'meta.pkl'),'wb') as f:
+        pickle.dump(meta,f,protocol=4)
+
+def Load_Store_Column(directory,name,col,mmap_mode='r'):
+    if col[0] == 'npy':
+        return np.load(os.path.join(directory,name+'.npy'),mmap_mode=mmap_mode)
+    elif col[0] == 'codes':
+        #stores written before string columns were saved as fixed-width arrays
+        codes = np.load(os.path.join(directory,name+'.npy'),mmap_mode=mmap_mode)
+        uniques = np.empty(len(col[1]),dtype=object)
+        for ii,u in enumerate(col[1]):
+            uniques[ii] = u
+        x = uniques[codes]
+        if col[2].kind != 'O':
+            x = x.astype(col[2])
+        return x
+    return col[1]
+
+def Load_Data_Store(directory,mmap_mode='r',names=None):
+    with open(os.path.join(directory,'meta.pkl'),'rb') as f:
+        meta = pickle.load(f)
+
+    arrays = OrderedDict()
+    for name,col in meta['columns'].items():
+        if (names is None) or (name in names):
+            arrays[name] = Load_Store_Column(directory,name,col,mmap_mode)
+
+    return arrays,meta
+
+def save_model_data(self,saver,sess,name,get,iteration=0,arch=None):
     saver.save(sess, os.path.join(self.Name, 'models', 'model_' + str(iteration), 'model.ckpt'))
+    if arch is not None:
+        #layer layout and variable names, used to export the model for inference without tensorflow
+        with open(os.path.join(self.Name, 'models', 'model_' + str(iteration), 'arch.pkl'), 'wb') as f:
+            pickle.dump(arch, f)
     with open(os.path.join(self.Name, 'models', 'model_type.pkl'), 'wb') as f:
         pickle.dump([name, get.name, self.use_alpha, self.use_beta,
                      self.use_v_beta, self.use_d_beta, self.use_j_beta,
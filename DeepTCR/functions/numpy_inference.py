@@ -0,0 +1,260 @@
+"""
+Forward pass of trained DeepTCR models in NumPy.
+
+Models exported with Export_NumPy (DeepTCR_U, DeepTCR_SS, DeepTCR_WF) are written as one .npz per
+trained model. This module only depends on numpy so scoring processes can load those files and run
+inference without importing tensorflow.
+
+    from DeepTCR.functions.numpy_inference import Load_Models, Sequence_Inference, Sample_Inference
+    models = Load_Models(['Name/models/model_0/model.npz', 'Name/models/model_1/model.npz'])
+    out, out_dist = Sequence_Inference(models, beta_sequences=beta_sequences, v_beta=v_beta)
+"""
+import json
+import numpy as np
+
+def Leaky_Relu(x,alpha=0.2):
+    return np.where(x > 0, x, alpha*x)
+
+def Relu(x):
+    return np.maximum(x,0)
+
+def Softmax(x):
+    e = np.exp(x - np.max(x,axis=1,keepdims=True))
+    return e/np.sum(e,axis=1,keepdims=True)
+
+def ISRU(x,l=-1,h=1,a=None,b=None):
+    #same as act_fun.isru, with a/b the trained variables when given
+    lim = 4
+    _a = h - l if a is None else 2 ** ISRU(a, l=-lim, h=lim)
+    _b = 1 if b is None else (2 ** ISRU(b, l=-lim, h=lim)) + 1
+    return l + (((h - l) / 2) * (1 + (x * ((_a + ((x ** 2) ** _b)) ** -(1 / (2 * _b))))))
+
+def Conv_Same(x,kernel,bias,stride):
+    #conv2d over the sequence axis with 'same' padding: x is [N,L,C], kernel is [1,k,C,units]
+    k = kernel.shape[1]
+    L = x.shape[1]
+    out = -(-L//stride)
+    pad = max((out-1)*stride + k - L,0)
+    x = np.pad(x,((0,0),(pad//2,pad-pad//2),(0,0)))
+    idx = np.arange(out)[:,np.newaxis]*stride + np.arange(k)[np.newaxis,:]
+    cols = x[:,idx,:].reshape(x.shape[0],out,-1)
+    return cols @ kernel.reshape(-1,kernel.shape[-1]) + bias
+
+def Convolutional_Features(x,w,net='sup'):
+    #Layers.Convolutional_Features at inference (dropout inactive)
+    conv = Leaky_Relu(Conv_Same(x,w[0],w[1],1))
+    conv_2 = Leaky_Relu(Conv_Same(conv,w[2],w[3],3))
+    conv_3 = Leaky_Relu(Conv_Same(conv_2,w[4],w[5],3))
+    if net == 'ae':
+        return conv_3.reshape(conv_3.shape[0],-1)
+    return np.max(conv_3,axis=1)
+
+def Dense_Layers(x,w,activation=None):
+    for kernel,bias in zip(w[0::2],w[1::2]):
+        x = x @ kernel + bias
+        if activation is not None:
+            x = activation(x)
+    return x
+
+def Segment_Pool(x,seg,n_seg,pooling='sum'):
+    out = np.zeros((n_seg,x.shape[1]),dtype=x.dtype)
+    if pooling == 'max':
+        #features are non-negative, empty segments pool to zero
+        np.maximum.at(out,seg,x)
+        return out
+    np.add.at(out,seg,x)
+    if pooling == 'mean':
+        out /= np.maximum(np.bincount(seg,minlength=n_seg),1)[:,np.newaxis]
+    return out
+
+class NumPy_Model(object):
+    """ A trained model loaded from the .npz written by Export_NumPy. """
+    def __init__(self,filename):
+        with np.load(filename) as f:
+            self.config = json.loads(str(f['config']))
+            self.weights = {k:f[k] for k in f.files if k != 'config'}
+        self.arch = self.config['arch']
+
+    def block(self,name):
+        return [self.weights[k] for k in self.arch['variables'].get(name,[])]
+
+    def encode(self,alpha_sequences=None,beta_sequences=None,v_beta=None,d_beta=None,j_beta=None,
+               v_alpha=None,j_alpha=None,hla=None):
+        #string inputs to the numeric inputs of the network, as Sequence_Inference/Sample_Inference prepare them
+        c = self.config
+        inputs = [alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,v_alpha,j_alpha,hla]
+        n = [len(i) for i in inputs if i is not None][0]
+
+        X = {}
+        for name,seqs in [('alpha',alpha_sequences),('beta',beta_sequences)]:
+            X[name] = np.zeros((n,c['max_length']),dtype=np.int64)
+            if seqs is None:
+                continue
+            for ii,s in enumerate(np.asarray(seqs).astype(str)):
+                if s == 'null':
+                    continue
+                if len(s) > c['max_length']:
+                    raise Exception('Sequence {} is longer than max_length ({})!'.format(s,c['max_length']))
+                try:
+                    X[name][ii,:len(s)] = [c['aa_idx'][r] for r in s]
+                except KeyError as e:
+                    raise Exception('Unknown amino acid {} in sequence {}!'.format(e,s))
+
+        for name,genes in [('v_beta',v_beta),('d_beta',d_beta),('j_beta',j_beta),('v_alpha',v_alpha),('j_alpha',j_alpha)]:
+            X[name] = np.zeros(n,dtype=np.int64)
+            if genes is None or c['classes'][name] is None:
+                continue
+            lookup = {g:ii for ii,g in enumerate(c['classes'][name])}
+            #object so the known genes written below are not truncated to the width of the input names
+            genes = np.asarray(genes).astype(str).astype(object)
+            #genes not seen in training are replaced by a random known gene
+            unknown = np.array([g not in lookup for g in genes],dtype=bool)
+            genes[unknown] = np.random.choice(c['classes'][name],np.sum(unknown))
+            X[name] = np.array([lookup[g] for g in genes],dtype=np.int64)
+
+        n_hla = len(c['classes']['hla']) if c['classes']['hla'] is not None else 1
+        X['hla'] = np.zeros((n,n_hla),dtype=np.float32)
+        if hla is not None and c['classes']['hla'] is not None:
+            lookup = {h:ii for ii,h in enumerate(c['classes']['hla'])}
+            sup = c['hla_supertypes']
+            for ii,h in enumerate(hla):
+                if sup is not None:
+                    if not c['keep_non_supertype_alleles']:
+                        h = [x for x in h if x in sup]
+                    h = [sup.get(x,x) for x in h]
+                for x in h:
+                    if x in lookup:
+                        X['hla'][ii,lookup[x]] = 1.0
+        return X
+
+    def features(self,X):
+        #Layers.Conv_Model: sequence, gene and HLA features followed by the fully connected layers
+        c = self.config
+        a = self.arch
+        seq_features = []
+        for chain in ['alpha','beta']:
+            if c['use_'+chain]:
+                x = X[chain]
+                if 'aa' in a['variables']:
+                    x = self.block('aa')[0][x]
+                else:
+                    x = np.eye(21,dtype=np.float32)[x]
+                seq_features.append(Convolutional_Features(x,self.block(chain+'_conv'),a['net']))
+
+        gene_features = []
+        for name in ['v_beta','d_beta','j_beta','v_alpha','j_alpha']:
+            if c['use_'+name]:
+                gene_features.append(self.block(name)[0][X[name]])
+
+        features = [np.concatenate(f,axis=1) for f in [seq_features,gene_features] if f]
+        if c['use_hla']:
+            hla_features = X['hla'].astype(np.float32) @ self.block('hla')[0]
+            features.append(hla_features)
+        features = np.concatenate(features,axis=1)
+
+        if a['use_only_seq']:
+            features = np.concatenate(seq_features,axis=1)
+        if a['use_only_gene']:
+            features = np.concatenate(gene_features,axis=1)
+        if a['use_only_hla']:
+            features = hla_features
+
+        return Dense_Layers(features,self.block('fc'),Relu)
+
+    def output(self,logits):
+        if self.config['regression'] is True:
+            return logits
+        return Softmax(logits)
+
+    def sequence_forward(self,X):
+        a = self.arch
+        if a['model'] == 'WF':
+            raise Exception('Repertoire classifier models are run through Sample_Inference!')
+        features = self.features(X)
+        if a['model'] == 'VAE':
+            w = self.block('encoder')
+            out = Dense_Layers(features,w[:4]) @ w[4]
+        else:
+            out = self.output(Dense_Layers(features,self.block('head')))
+        if self.config['ind'] is not None:
+            out = out[:,self.config['ind']]
+        return out
+
+    def sample_forward(self,X,seg,n_seg,freq,counts):
+        a = self.arch
+        w = self.block('concepts')
+        concepts = ISRU(self.features(X) @ w[0] + w[1],l=0,h=1,a=w[2],b=w[3])
+        pooling = a['pooling'] if a['aggregation'] == 'segment' else 'sum'
+        agg_list = []
+        if a['qualitative_agg']:
+            agg_list.append(Segment_Pool(concepts*freq[:,np.newaxis],seg,n_seg,pooling))
+        if a['quantitative_agg']:
+            w = self.block('quantitative')
+            agg = Segment_Pool(concepts*counts[:,np.newaxis],seg,n_seg,pooling)
+            agg_list.append(ISRU(agg + w[0],l=0,h=1,a=w[1],b=w[2]))
+        agg = Dense_Layers(np.concatenate(agg_list,axis=1),self.block('agg'),Relu)
+        return self.output(Dense_Layers(agg,self.block('head')))
+
+def Load_Models(filenames):
+    if isinstance(filenames,str):
+        filenames = [filenames]
+    return [NumPy_Model(f) for f in filenames]
+
+def Sequence_Inference(models,alpha_sequences=None,beta_sequences=None,v_beta=None,d_beta=None,j_beta=None,
+                       v_alpha=None,j_alpha=None,hla=None,batch_size=10000):
+    """
+    NumPy counterpart of Sequence_Inference for exported VAE/sequence classifier models.
+
+    Returns the mean output over the models, shape [N, out], and the output of each model, shape [n_models, N, out].
+    """
+    models = [m if isinstance(m,NumPy_Model) else NumPy_Model(m) for m in models]
+    X = models[0].encode(alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,v_alpha,j_alpha,hla)
+    n = len(X['alpha'])
+    out_dist = []
+    for m in models:
+        out = [m.sequence_forward({k:v[ii:ii+batch_size] for k,v in X.items()}) for ii in range(0,n,batch_size)]
+        out_dist.append(np.concatenate(out,axis=0))
+    out_dist = np.stack(out_dist,0)
+    return np.mean(out_dist,0), out_dist
+
+def Sample_Inference(models,sample_labels=None,alpha_sequences=None,beta_sequences=None,v_beta=None,d_beta=None,
+                     j_beta=None,v_alpha=None,j_alpha=None,hla=None,freq=None,counts=None,batch_size=10):
+    """
+    NumPy counterpart of Sample_Inference for exported repertoire classifier models.
+
+    Returns the samples (sorted labels, or the input order when sample_labels is None), the mean prediction
+    over the models, shape [n_samples, n_classes], and the prediction of each model, shape [n_models, n_samples, n_classes].
+    """
+    models = [m if isinstance(m,NumPy_Model) else NumPy_Model(m) for m in models]
+    X = models[0].encode(alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,v_alpha,j_alpha,hla)
+    n = len(X['alpha'])
+
+    seq_inf = sample_labels is None
+    if seq_inf:
+        sample_labels = np.arange(n)
+    sample_list, codes = np.unique(sample_labels,return_inverse=True)
+    codes = codes.reshape(-1)
+    if (counts is None) and (freq is None):
+        counts = np.ones(n)
+    if freq is None:
+        freq = counts/np.bincount(codes,weights=counts)[codes]
+    if counts is None:
+        counts = np.zeros(n)
+    freq = np.asarray(freq,dtype=np.float32)
+    counts = np.asarray(counts,dtype=np.float32)
+
+    #rows grouped by sample once: the rows of samples [ii,jj) are order[offsets[ii]:offsets[jj]]
+    order = np.argsort(codes,kind='stable')
+    offsets = np.searchsorted(codes[order],np.arange(len(sample_list)+1))
+
+    out_dist = []
+    for m in models:
+        out = []
+        for ii in range(0,len(sample_list),batch_size):
+            rows = order[offsets[ii]:offsets[min(ii+batch_size,len(sample_list))]]
+            seg = codes[rows] - ii
+            out.append(m.sample_forward({k:v[rows] for k,v in X.items()},seg,min(batch_size,len(sample_list)-ii),
+                                        freq[rows],counts[rows]))
+        out_dist.append(np.concatenate(out,axis=0))
+    out_dist = np.stack(out_dist,0)
+    return sample_list, np.mean(out_dist,0), out_dist
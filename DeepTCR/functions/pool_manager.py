@@ -0,0 +1,143 @@
+import os
+import time
+import atexit
+from contextlib import contextmanager
+from multiprocessing import Pool, get_context
+
+_pool = None
+_pool_n_jobs = None
+_pool_stats = {'calls':0,'tasks':0,'wall_time':0.0,'task_time':0.0,'worker_time':0.0}
+
+def Available_Cores():
+    if hasattr(os,'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def Get_Pool(n_jobs=None):
+    #lazy module-level pool, re-created only when a different size is requested
+    global _pool, _pool_n_jobs
+    if n_jobs is None:
+        n_jobs = Available_Cores()
+    if _pool is not None and _pool_n_jobs != n_jobs:
+        Close_Pool()
+    if _pool is None:
+        _pool = Pool(n_jobs)
+        _pool_n_jobs = n_jobs
+    return _pool
+
+def Close_Pool():
+    global _pool, _pool_n_jobs
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+    _pool = None
+    _pool_n_jobs = None
+
+atexit.register(Close_Pool)
+
+@contextmanager
+def Managed_Pool(p=None,n_jobs=None,persistent=True):
+    #a pool passed in by the user is used as is and never closed here
+    if p is not None:
+        yield p
+    elif persistent is True:
+        yield Get_Pool(n_jobs)
+    else:
+        if n_jobs is None:
+            n_jobs = Available_Cores()
+        pool = Pool(n_jobs)
+        try:
+            yield pool
+        finally:
+            pool.close()
+            pool.join()
+
+@contextmanager
+def Spawn_Pool(n_jobs,initializer=None,initargs=(),env=None):
+    #workers start from a fresh interpreter (not a fork) so each can run its own tensorflow runtime;
+    #env is applied only while the workers are started
+    saved = {}
+    if env is not None:
+        saved = {k:os.environ.get(k) for k in env}
+        os.environ.update(env)
+    try:
+        pool = get_context('spawn').Pool(n_jobs,initializer=initializer,initargs=initargs)
+    finally:
+        for k,v in saved.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+    try:
+        yield pool
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def Thread_Env(n_threads,use_gpu=False):
+    env = {'OMP_NUM_THREADS':str(n_threads),'MKL_NUM_THREADS':str(n_threads)}
+    if use_gpu is False:
+        env['CUDA_VISIBLE_DEVICES'] = '-1'
+    return env
+
+def _timed_task(func,args):
+    start = time.time()
+    result = func(*args)
+    return result,time.time()-start
+
+def Pool_Starmap(func,args,p=None,n_jobs=None):
+    args = list(args)
+    with Managed_Pool(p,n_jobs) as pool:
+        start = time.time()
+        out = pool.starmap(_timed_task,[(func,a) for a in args])
+        wall = time.time()-start
+        n_workers = pool._processes
+
+    _pool_stats['calls'] += 1
+    _pool_stats['tasks'] += len(args)
+    _pool_stats['wall_time'] += wall
+    _pool_stats['worker_time'] += wall*n_workers
+    _pool_stats['task_time'] += sum([t for _,t in out])
+    return [r for r,_ in out]
+
+def _indexed_task(task):
+    i,func,args = task
+    result,t = _timed_task(func,args)
+    return i,result,t
+
+def Pool_Imap_Unordered(func,args,p=None,n_jobs=None):
+    #yields (position in args, result) as tasks complete
+    args = list(args)
+    with Managed_Pool(p,n_jobs) as pool:
+        start = time.time()
+        task_time = 0.0
+        for i,result,t in pool.imap_unordered(_indexed_task,[(i,func,a) for i,a in enumerate(args)]):
+            task_time += t
+            yield i,result
+        wall = time.time()-start
+        n_workers = pool._processes
+
+    _pool_stats['calls'] += 1
+    _pool_stats['tasks'] += len(args)
+    _pool_stats['wall_time'] += wall
+    _pool_stats['worker_time'] += wall*n_workers
+    _pool_stats['task_time'] += task_time
+
+def Pool_Map(func,iterable,p=None,n_jobs=None):
+    return Pool_Starmap(func,[(x,) for x in iterable],p,n_jobs)
+
+def Pool_Utilization(reset=False):
+    #fraction of available worker time spent inside tasks
+    stats = dict(_pool_stats)
+    if stats['worker_time'] > 0:
+        stats['utilization'] = stats['task_time']/stats['worker_time']
+    else:
+        stats['utilization'] = 0.0
+    stats['n_jobs'] = _pool_n_jobs
+    if reset is True:
+        for k in _pool_stats:
+            _pool_stats[k] = 0 if k in ('calls','tasks') else 0.0
+    return stats
@@ -7,17 +7,35 @@ from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 from scipy.stats import mannwhitneyu, spearmanr
 import os
+import sys
+import warnings
+import time
+import json
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from Bio.Alphabet import IUPAC
 import seaborn as sns
 from sklearn.metrics import roc_auc_score
 from sklearn.preprocessing import OneHotEncoder, LabelEncoder,StandardScaler, MinMaxScaler
 import tensorflow as tf
+from tensorflow.python.client import timeline
 from multiprocessing import Pool
 from DeepTCR.functions.data_processing import *
+from DeepTCR.functions import numpy_inference
 from sklearn.model_selection import train_test_split
 import logomaker
 import shutil
 from sklearn.linear_model import LinearRegression
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 def custom_train_test_split(X,Y,test_size,stratify):
     idx = np.array(range(len(X)))
@@ -193,6 +211,204 @@ def get_batches(Vars, batch_size=10,random=False):
 
         yield Vars_Out
 
+def get_batches_bucketed(Vars, keys, batch_size=10,random=False):
+    """ Return a generator that yields batches from vars, each drawn from rows sharing one key. """
+    batches = []
+    for k in np.unique(keys):
+        sel = np.where(keys == k)[0]
+        if random is True:
+            np.random.shuffle(sel)
+        for ii in range(0,len(sel),batch_size):
+            batches.append(sel[ii:ii+batch_size])
+
+    if random is True:
+        np.random.shuffle(batches)
+
+    for sel_ind in batches:
+        yield [var[sel_ind] for var in Vars]
+
+def Seq_Keys(self,GO,idx=None):
+    #bucket key of every row (or of rows idx) by the trimmed width of its used CDR3 chains
+    X = []
+    if self.use_alpha is True:
+        X.append(self.X_Seq_alpha)
+    if self.use_beta is True:
+        X.append(self.X_Seq_beta)
+    if idx is not None:
+        X = [x[idx] for x in X]
+    return Bucket_Keys(GO.seq_widths,*X)
+
+def Bucket_Order(self,GO,idx_u,inv):
+    #order the unique rows so that inference batches hold sequences of similar length
+    if GO.seq_widths is None or (self.use_alpha is False and self.use_beta is False):
+        return idx_u,inv
+    return Reorder_Unique(idx_u,inv,np.argsort(Seq_Keys(self,GO,idx_u),kind='stable'))
+
+def Changed_Attrs(obj,before):
+    #attributes that were added or rebound since the snapshot before = dict(obj.__dict__)
+    return {k:v for k,v in obj.__dict__.items() if (k not in before) or (before[k] is not v)}
+
+_fold_obj = None
+
+def Mapped_State(obj,state):
+    #Arrays the object still holds memory-mapped from its data store are left out of the state sent to workers
+    #(pickling a memmap copies its data); the workers map the same files read-only instead.
+    state = dict(state)
+    store = state.pop('data_store',None)
+    if store is None:
+        return state,None
+    mapped = {}
+    for k,(name,x) in store['columns'].items():
+        if state.get(k) is x:
+            mapped[k] = name
+            del state[k]
+    return state,(store['directory'],mapped)
+
+def Init_Fold_Worker(cls,state,mapped,build_args,threads):
+    #runs once in each cross-validation worker: rebuild the object and its graph from the parent state
+    global _fold_obj
+    obj = cls.__new__(cls)
+    obj.__dict__.update(state)
+    obj.data_store = None
+    if mapped is not None:
+        directory,names = mapped
+        arrays,_ = Load_Data_Store(directory,names=set(names.values()))
+        for k,name in names.items():
+            setattr(obj,k,arrays[name])
+    obj.tf_threads = threads
+    obj._build(*build_args)
+    _fold_obj = obj
+
+def Train_Fold(task):
+    i,fold_attrs,rng_state,train_kwargs = task
+    obj = _fold_obj
+    obj.__dict__.update(fold_attrs)
+    if hasattr(obj,'predicted'):
+        obj.predicted = np.zeros_like(obj.predicted)
+    before = dict(obj.__dict__)
+    #continue from the random state the fold's split left, so batches are drawn as in a sequential run
+    np.random.set_state(rng_state)
+    obj._train(iteration=i,**train_kwargs)
+    out = Changed_Attrs(obj,before)
+    for k in ['GO','graph_model','train_params']:
+        out.pop(k,None)
+    if hasattr(obj,'predicted'):
+        out['predicted'] = obj.predicted
+    return i,out
+
+def Prefetch_Batches(batches,prefetch=2):
+    """ Prepare the batches of a python batch generator on a background thread, holding at most
+    prefetch of them ahead of the training graph. """
+    #the first batch is pulled here so any shuffling happens in the same order as without prefetching
+    first = next(batches,None)
+    if first is None:
+        return
+
+    q = queue.Queue(maxsize=max(prefetch,1))
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        #give up once the consumer has stopped reading
+        while not stop.is_set():
+            try:
+                q.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fill():
+        try:
+            for b in batches:
+                if not put(b):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    thread = threading.Thread(target=fill,daemon=True)
+    thread.start()
+    try:
+        yield first
+        while True:
+            b = q.get()
+            if b is done:
+                break
+            if isinstance(b,BaseException):
+                raise b
+            yield b
+    finally:
+        stop.set()
+        thread.join()
+
+def Input_Batches(self,batches):
+    if self.use_tf_data is True:
+        return Prefetch_Batches(batches,self.prefetch)
+    return batches
+
+def Peak_RSS():
+    #peak resident set size of this process in MB (None where the resource module is unavailable)
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss/2**20
+    return rss/2**10
+
+class Training_History(object):
+    """ Per-epoch record of a training run: wall time split into batching, forward/backward and
+    evaluation, training examples/sec, peak RSS and the losses/accuracies of the epoch. """
+    def __init__(self,model_type,iteration=0,trace_epoch=None):
+        self.model_type = model_type
+        self.iteration = iteration
+        self.trace_epoch = trace_epoch
+        self.epochs = []
+        self._record = None
+        self._start = None
+
+    def start_epoch(self,e):
+        #returns a tf.RunMetadata to trace a training step with when e is the epoch to trace
+        self._record = {'epoch':e,'batching':0.0,'forward_backward':0.0,'evaluation':0.0}
+        self._start = time.time()
+        if e == self.trace_epoch:
+            return tf.RunMetadata()
+        return None
+
+    def add_times(self,times):
+        for k,v in times.items():
+            self._record[k] += v
+
+    def end_epoch(self,**metrics):
+        record = self._record
+        record['wall_time'] = time.time()-self._start
+        record['peak_rss_mb'] = Peak_RSS()
+        record.update(metrics)
+        self.epochs.append(record)
+        self._record = None
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.epochs)
+
+    def write(self,directory):
+        os.makedirs(directory,exist_ok=True)
+        with open(os.path.join(directory,'history.pkl'),'wb') as f:
+            pickle.dump({'model_type':self.model_type,'iteration':self.iteration,'epochs':self.epochs},f)
+        self.to_dataframe().to_csv(os.path.join(directory,'history.csv'),index=False)
+
+def Trace_Options(trace):
+    #keyword arguments for sess.run that fill trace (a tf.RunMetadata) with a full trace of the step
+    if trace is None:
+        return {}
+    return {'options':tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),'run_metadata':trace}
+
+def Write_Timeline(trace,directory,e):
+    #chrome://tracing timeline of the traced step
+    os.makedirs(directory,exist_ok=True)
+    tl = timeline.Timeline(trace.step_stats)
+    with open(os.path.join(directory,'timeline_epoch_'+str(e)+'.json'),'w') as f:
+        f.write(tl.generate_chrome_trace_format())
+
 def Diff_Features(features,indices,sequences,type,sample_id,p_val_threshold,
                   idx_pos,idx_neg,directory_results,group,kernel,sample_avg,top_seq):
     pos_mean = []
@@ -496,84 +712,138 @@ def Motif_Features_dep(self,features,indices,sequences,directory_results,sub_dir
 
     return Rep_Seq_Features
 
-def Run_Graph_SS(set,sess,self,GO,batch_size,random=True,train=True,drop_out_rate=None,multisample_dropout_rate=None):
-    loss = []
-    accuracy = []
-    predicted_list = []
-    var_names = ['X_Seq_alpha','X_Seq_beta','v_beta_num','d_beta_num',
-                 'j_beta_num','v_alpha_num','j_alpha_num','hla_data_seq_num']
+#arrays of a sequence classifier batch, in order: network inputs, the row of each example within its set, labels;
+#Eval_Graph_SS appends the partition tag at SS_Tag
+SS_Fields = ['X_Seq_alpha','X_Seq_beta','v_beta_num','d_beta_num','j_beta_num','v_alpha_num','j_alpha_num',
+             'hla_data_seq_num','idx','Y']
+SS_Tag = len(SS_Fields)
+
+def SS_Vars(set,self):
     Vars = []
-    for v in var_names:
+    for v in SS_Fields[:-2]:
         Vars.append(set[self.var_dict[v]])
+    Vars.append(np.arange(len(set[-1])))
     Vars.append(set[-1])
+    return Vars
 
-    for vars in get_batches(Vars, batch_size=batch_size, random=random):
-        feed_dict = {GO.Y: vars[-1]}
+def SS_Batches(Vars,self,GO,batch_size,random):
+    if GO.seq_widths is not None:
+        seqs = [Vars[SS_Fields.index('X_Seq_alpha')],Vars[SS_Fields.index('X_Seq_beta')]]
+        keys = Bucket_Keys(GO.seq_widths,*[v for v,use in zip(seqs,[self.use_alpha,self.use_beta]) if use is True])
+        return get_batches_bucketed(Vars, keys, batch_size=batch_size, random=random)
+    return get_batches(Vars, batch_size=batch_size, random=random)
 
-        if drop_out_rate is not None:
-            feed_dict[GO.prob] = drop_out_rate
+def SS_Feed(self,GO,vars):
+    b = dict(zip(SS_Fields,vars))
+    feed_dict = {GO.Y: b['Y']}
 
-        if multisample_dropout_rate is not None:
-            feed_dict[GO.prob_multisample] = multisample_dropout_rate
+    if self.use_alpha is True:
+        feed_dict[GO.X_Seq_alpha] = Trim_Seq(b['X_Seq_alpha'],GO.seq_widths)
+    if self.use_beta is True:
+        feed_dict[GO.X_Seq_beta] = Trim_Seq(b['X_Seq_beta'],GO.seq_widths)
 
-        if self.use_alpha is True:
-            feed_dict[GO.X_Seq_alpha] = vars[0]
-        if self.use_beta is True:
-            feed_dict[GO.X_Seq_beta] = vars[1]
+    if self.use_v_beta is True:
+        feed_dict[GO.X_v_beta] = b['v_beta_num']
 
-        if self.use_v_beta is True:
-            feed_dict[GO.X_v_beta] = vars[2]
+    if self.use_d_beta is True:
+        feed_dict[GO.X_d_beta] = b['d_beta_num']
 
-        if self.use_d_beta is True:
-            feed_dict[GO.X_d_beta] = vars[3]
+    if self.use_j_beta is True:
+        feed_dict[GO.X_j_beta] = b['j_beta_num']
 
-        if self.use_j_beta is True:
-            feed_dict[GO.X_j_beta] = vars[4]
+    if self.use_v_alpha is True:
+        feed_dict[GO.X_v_alpha] = b['v_alpha_num']
 
-        if self.use_v_alpha is True:
-            feed_dict[GO.X_v_alpha] = vars[5]
+    if self.use_j_alpha is True:
+        feed_dict[GO.X_j_alpha] = b['j_alpha_num']
 
-        if self.use_j_alpha is True:
-            feed_dict[GO.X_j_alpha] = vars[6]
+    if self.use_hla:
+        feed_dict[GO.X_hla] = b['hla_data_seq_num']
 
-        if self.use_hla:
-            feed_dict[GO.X_hla] = vars[7]
+    return feed_dict
+
+def SS_Summary(set,loss,accuracy,predicted_list,idx):
+    loss = np.mean(loss)
+    accuracy = np.mean(accuracy)
+    predicted_out = np.zeros_like(np.vstack(predicted_list))
+    predicted_out[np.hstack(idx)] = np.vstack(predicted_list)
+    try:
+        auc = roc_auc_score(set[-1], predicted_out)
+    except:
+        auc = 0.0
+    return loss,accuracy,predicted_out,auc
 
+def Run_Graph_SS(set,sess,self,GO,batch_size,random=True,train=True,drop_out_rate=None,multisample_dropout_rate=None,trace=None):
+    loss = []
+    accuracy = []
+    predicted_list = []
+    Vars = SS_Vars(set,self)
+    batches = SS_Batches(Vars,self,GO,batch_size,random)
+
+    start = time.time()
+    run_time = 0.0
+    n_examples = 0
+    idx = []
+    for vars in Input_Batches(self,batches):
+        n_examples += len(vars[SS_Fields.index('Y')])
+        idx.append(vars[SS_Fields.index('idx')])
+        feed_dict = SS_Feed(self,GO,vars)
+
+        if drop_out_rate is not None:
+            feed_dict[GO.prob] = drop_out_rate
+
+        if multisample_dropout_rate is not None:
+            feed_dict[GO.prob_multisample] = multisample_dropout_rate
+
+        t = time.time()
         if train is True:
-            loss_i, accuracy_i, _, predicted_i = sess.run([GO.loss, GO.accuracy, GO.opt, GO.predicted], feed_dict=feed_dict)
+            loss_i, accuracy_i, _, predicted_i = sess.run([GO.loss, GO.accuracy, GO.opt, GO.predicted], feed_dict=feed_dict,
+                                                          **Trace_Options(trace))
+            trace = None
         else:
             loss_i, accuracy_i, predicted_i = sess.run([GO.loss, GO.accuracy, GO.predicted], feed_dict=feed_dict)
+        run_time += time.time()-t
 
         loss.append(loss_i)
         accuracy.append(accuracy_i)
         predicted_list.append(predicted_i)
 
-    loss = np.mean(loss)
-    accuracy = np.mean(accuracy)
-    predicted_out = np.vstack(predicted_list)
-    try:
-        auc = roc_auc_score(set[-1], predicted_out)
-    except:
-        auc = 0.0
-    return loss,accuracy,predicted_out,auc
+    if train is True:
+        total = time.time()-start
+        self.train_examples_per_sec = n_examples/total
+        self.train_times = {'batching':total-run_time,'forward_backward':run_time}
+
+    return SS_Summary(set,loss,accuracy,predicted_list,idx)
+
+def Eval_Graph_SS(sets,sess,self,GO,batch_size):
+    #Evaluates several partitions (e.g. validation and test) in a single pass through one input pipeline.
+    #Batches never mix partitions, so each partition gets the same statistics as a Run_Graph_SS pass of its own.
+    def tagged():
+        for s,set in enumerate(sets):
+            for vars in SS_Batches(SS_Vars(set,self),self,GO,batch_size,False):
+                yield list(vars)+[np.full(len(vars[SS_Fields.index('Y')]),s)]
+
+    results = [([],[],[],[]) for _ in sets]
+    for vars in Input_Batches(self,tagged()):
+        loss_i, accuracy_i, predicted_i = sess.run([GO.loss, GO.accuracy, GO.predicted], feed_dict=SS_Feed(self,GO,vars))
+        loss,accuracy,predicted_list,idx = results[vars[SS_Tag][0]]
+        loss.append(loss_i)
+        accuracy.append(accuracy_i)
+        predicted_list.append(predicted_i)
+        idx.append(vars[SS_Fields.index('idx')])
+
+    return [SS_Summary(set,*r) for set,r in zip(sets,results)]
 
 def Run_Graph_WF_dep(set,sess,self,GO,batch_size,random=True,train=True,drop_out_rate=None):
     loss = []
     accuracy = []
     predicted_list = []
     for vars in get_batches(set, batch_size=batch_size, random=random):
-        var_idx = np.where(np.isin(self.sample_id, vars[0]))[0]
-        lb = LabelEncoder()
-        lb.fit(vars[0])
-        _,_,sample_idx = np.intersect1d(lb.classes_,vars[0],return_indices=True)
+        sample_idx = np.argsort(vars[0])
         vars = [v[sample_idx] for v in vars]
-        i = lb.transform(self.sample_id[var_idx])
+        var_idx,i = self.sample_index.rows(vars[0])
 
-        OH = OneHotEncoder(categories='auto')
-        sp = OH.fit_transform(i.reshape(-1, 1)).T
-        sp = sp.tocoo()
-        indices = np.mat([sp.row, sp.col]).T
-        sp = tf.SparseTensorValue(indices, sp.data, sp.shape)
+        sp = Segment_Sparse(i,len(sample_idx))
 
         # feed_dict = {GO.Y: vars[-1],
         #              GO.X_Freq: self.freq[var_idx],
@@ -635,157 +905,280 @@ def Run_Graph_WF_dep(set,sess,self,GO,batch_size,random=True,train=True,drop_out
         auc = 0.0
     return loss,accuracy,predicted_out,auc
 
-def Run_Graph_WF(set,sess,self,GO,batch_size,batch_size_update,random=True,train=True,drop_out_rate=None,multisample_dropout_rate=None):
-    loss = []
-    accuracy = []
-    predicted_list = []
-    if batch_size_update is not None:
-        if batch_size_update > len(set[0]):
-            batch_size_update = len(set[0])
-    it = 0
-    grads = []
-    w = []
+def Segment_Sparse(seg,n_segments=None):
+    #sparse [n_segments x n_rows] aggregation matrix with a one at (seg[r],r) for every row r
+    seg = np.asarray(seg)
+    if n_segments is None:
+        n_segments = seg.max()+1 if len(seg) else 0
+    indices = np.stack([seg,np.arange(len(seg))],axis=1).astype(np.int64)
+    return tf.SparseTensorValue(indices,np.ones(len(seg),dtype=np.float32),(n_segments,len(seg)))
+
+def Segment_Feed(feed_dict,GO,seg,n_segments):
+    #feeds the sample assignment of every sequence in the form the graph aggregates with
+    if GO.aggregation == 'segment':
+        feed_dict[GO.seg] = seg
+        feed_dict[GO.n_seg] = n_segments
+    else:
+        feed_dict[GO.sp] = Segment_Sparse(seg,n_segments)
+    return feed_dict
+
+def Segment_Pool(seg,n_seg,pooling='sum'):
+    #returns a function pooling [n_rows x d] features into [n_seg x d] over the segment ids
+    def pool(x):
+        if pooling == 'sum':
+            return tf.math.unsorted_segment_sum(x,seg,n_seg)
+        elif pooling == 'mean':
+            return tf.math.unsorted_segment_mean(x,seg,n_seg)
+        elif pooling == 'max':
+            #features are non-negative, empty segments pool to zero rather than the dtype minimum
+            return tf.maximum(tf.math.unsorted_segment_max(x,seg,n_seg),0.0)
+    return pool
+
+#arrays of a repertoire classifier batch, in order: the order of the batch's samples within the set, their labels,
+#the rows of their sequences and the sample (segment) of each row, then the per-sequence inputs;
+#Eval_Graph_WF appends the partition tag at WF_Tag
+WF_Fields = ['sample_idx','Y','var_idx','i','freq','counts','X_Seq_alpha','X_Seq_beta','v_beta_num','d_beta_num',
+             'j_beta_num','v_alpha_num','j_alpha_num','hla_data_seq_num']
+WF_Tag = len(WF_Fields)
+
+def WF_Batches(set,self,batch_size,random):
+    #host-side batch preparation for the repertoire model; yields only numeric arrays
     for vars in get_batches(set, batch_size=batch_size, random=random):
-        var_idx = np.where(np.isin(self.sample_id, vars[0]))[0]
-        lb = LabelEncoder()
-        lb.fit(vars[0])
-        _,_,sample_idx = np.intersect1d(lb.classes_,vars[0],return_indices=True)
+        sample_idx = np.argsort(vars[0])
         vars = [v[sample_idx] for v in vars]
-        i = lb.transform(self.sample_id[var_idx])
+        var_idx,i = self.sample_index.rows(vars[0])
+        yield [sample_idx,vars[-1],var_idx,i,self.freq[var_idx],self.counts[var_idx],
+               self.X_Seq_alpha[var_idx],self.X_Seq_beta[var_idx],self.v_beta_num[var_idx],self.d_beta_num[var_idx],
+               self.j_beta_num[var_idx],self.v_alpha_num[var_idx],self.j_alpha_num[var_idx],self.hla_data_seq_num[var_idx]]
+
+def WF_Feed(self,GO,batch):
+    b = dict(zip(WF_Fields,batch))
+    sample_idx,Y,i,freq,counts = b['sample_idx'],b['Y'],b['i'],b['freq'],b['counts']
+    X_Seq_alpha,X_Seq_beta,v_beta_num,d_beta_num = b['X_Seq_alpha'],b['X_Seq_beta'],b['v_beta_num'],b['d_beta_num']
+    j_beta_num,v_alpha_num,j_alpha_num,hla_data_seq_num = b['j_beta_num'],b['v_alpha_num'],b['j_alpha_num'],b['hla_data_seq_num']
+
+    # feed_dict = {GO.Y: vars[-1],
+    #              GO.X_Freq: self.freq[var_idx],
+    #              GO.sp: sp,
+    #              GO.i: i,
+    #              GO.j: self.seq_index_j[var_idx]}
+
+    feed_dict = {GO.Y: Y,
+                 GO.X_Freq: freq,
+                 GO.X_Counts: counts}
+    Segment_Feed(feed_dict,GO,i,len(sample_idx))
 
-        OH = OneHotEncoder(categories='auto')
-        sp = OH.fit_transform(i.reshape(-1, 1)).T
-        sp = sp.tocoo()
-        indices = np.mat([sp.row, sp.col]).T
-        sp = tf.SparseTensorValue(indices, sp.data, sp.shape)
+    if self.use_alpha is True:
+        feed_dict[GO.X_Seq_alpha] = Trim_Seq(X_Seq_alpha,GO.seq_widths)
+    if self.use_beta is True:
+        feed_dict[GO.X_Seq_beta] = Trim_Seq(X_Seq_beta,GO.seq_widths)
 
-        # feed_dict = {GO.Y: vars[-1],
-        #              GO.X_Freq: self.freq[var_idx],
-        #              GO.sp: sp,
-        #              GO.i: i,
-        #              GO.j: self.seq_index_j[var_idx]}
+    if self.use_v_beta is True:
+        feed_dict[GO.X_v_beta] = v_beta_num
 
-        feed_dict = {GO.Y: vars[-1],
-                     GO.X_Freq: self.freq[var_idx],
-                     GO.X_Counts: self.counts[var_idx],
-                     GO.sp: sp}
+    if self.use_d_beta is True:
+        feed_dict[GO.X_d_beta] = d_beta_num
 
-        if drop_out_rate is not None:
-            feed_dict[GO.prob] = drop_out_rate
+    if self.use_j_beta is True:
+        feed_dict[GO.X_j_beta] = j_beta_num
 
-        if multisample_dropout_rate is not None:
-            feed_dict[GO.prob_multisample] = multisample_dropout_rate
+    if self.use_v_alpha is True:
+        feed_dict[GO.X_v_alpha] = v_alpha_num
 
-        if self.use_alpha is True:
-            feed_dict[GO.X_Seq_alpha] = self.X_Seq_alpha[var_idx]
-        if self.use_beta is True:
-            feed_dict[GO.X_Seq_beta] = self.X_Seq_beta[var_idx]
+    if self.use_j_alpha is True:
+        feed_dict[GO.X_j_alpha] = j_alpha_num
 
-        if self.use_v_beta is True:
-            feed_dict[GO.X_v_beta] = self.v_beta_num[var_idx]
+    if self.use_hla:
+        feed_dict[GO.X_hla] = hla_data_seq_num
 
-        if self.use_d_beta is True:
-            feed_dict[GO.X_d_beta] = self.d_beta_num[var_idx]
+    return feed_dict
 
-        if self.use_j_beta is True:
-            feed_dict[GO.X_j_beta] = self.j_beta_num[var_idx]
+def WF_Summary(set,loss,accuracy,predicted_list):
+    loss = np.mean(loss)
+    accuracy = np.mean(accuracy)
+    predicted_out = np.vstack(predicted_list)
+    try:
+        auc = roc_auc_score(set[-1], predicted_out)
+    except:
+        auc = 0.0
+    return loss,accuracy,predicted_out,auc
 
-        if self.use_v_alpha is True:
-            feed_dict[GO.X_v_alpha] = self.v_alpha_num[var_idx]
+def WF_Predicted(predicted_i,sample_idx):
+    pred_temp = np.zeros_like(predicted_i)
+    pred_temp[sample_idx] = predicted_i
+    return pred_temp
 
-        if self.use_j_alpha is True:
-            feed_dict[GO.X_j_alpha] = self.j_alpha_num[var_idx]
+def Run_Graph_WF(set,sess,self,GO,batch_size,batch_size_update,random=True,train=True,drop_out_rate=None,multisample_dropout_rate=None,
+                 trace=None):
+    loss = []
+    accuracy = []
+    predicted_list = []
+    if batch_size_update is not None:
+        if batch_size_update > len(set[0]):
+            batch_size_update = len(set[0])
+    it = 0
+    if train & (batch_size_update is not None):
+        sess.run(GO.zero_op)
+    start = time.time()
+    run_time = 0.0
+    n_examples = 0
+    for batch in Input_Batches(self,WF_Batches(set,self,batch_size,random)):
+        sample_idx = batch[WF_Fields.index('sample_idx')]
+        n_examples += len(sample_idx)
+        feed_dict = WF_Feed(self,GO,batch)
 
-        if self.use_hla:
-            feed_dict[GO.X_hla] = self.hla_data_seq_num[var_idx]
+        if drop_out_rate is not None:
+            feed_dict[GO.prob] = drop_out_rate
 
+        if multisample_dropout_rate is not None:
+            feed_dict[GO.prob_multisample] = multisample_dropout_rate
 
+        t = time.time()
         if train & (batch_size_update is not None):
-            loss_i, accuracy_i, predicted_i, grad_i = sess.run([GO.loss, GO.accuracy, GO.predicted, GO.gradients],
-                                                               feed_dict=feed_dict)
-            grads.append(grad_i)
-            w.append(len(vars[0]))
-            it += len(vars[0])
+            loss_i, accuracy_i, predicted_i, _ = sess.run([GO.loss, GO.accuracy, GO.predicted, GO.accum_op],
+                                                          feed_dict=feed_dict,**Trace_Options(trace))
+            trace = None
+            it += len(sample_idx)
 
             if it >= batch_size_update:
-                for i,ph in enumerate(GO.grads_accum,0):
-                    feed_dict[ph] = np.stack([g[i]*x for g,x in zip(grads,w)],axis=0).sum(axis=0)/np.sum(w)
-
-                loss_i, accuracy_i, _, predicted_i = sess.run([GO.loss, GO.accuracy, GO.opt, GO.predicted],
-                                                              feed_dict=feed_dict)
-                grads = []
+                sess.run(GO.opt)
+                sess.run(GO.zero_op)
                 it = 0
-                w = []
         elif train:
             loss_i, accuracy_i, _, predicted_i = sess.run([GO.loss, GO.accuracy, GO.opt, GO.predicted],
-                                                          feed_dict=feed_dict)
+                                                          feed_dict=feed_dict,**Trace_Options(trace))
+            trace = None
         else:
             loss_i, accuracy_i, predicted_i = sess.run([GO.loss, GO.accuracy, GO.predicted],
                                                        feed_dict=feed_dict)
+        run_time += time.time()-t
 
         loss.append(loss_i)
         accuracy.append(accuracy_i)
-        pred_temp = np.zeros_like(predicted_i)
-        pred_temp[sample_idx] = predicted_i
-        predicted_i = pred_temp
-        predicted_list.append(predicted_i)
-
-    loss = np.mean(loss)
-    accuracy = np.mean(accuracy)
-    predicted_out = np.vstack(predicted_list)
-    try:
-        auc = roc_auc_score(set[-1], predicted_out)
-    except:
-        auc = 0.0
-    return loss,accuracy,predicted_out,auc
-
-def Get_Seq_Features_Indices(self,batch_size,GO,sess):
-    alpha_features_list = []
-    beta_features_list = []
-    alpha_indices_list = []
-    beta_indices_list = []
-    Vars = [self.X_Seq_alpha, self.X_Seq_beta]
-    for vars in get_batches(Vars, batch_size=batch_size, random=False):
+        predicted_list.append(WF_Predicted(predicted_i,sample_idx))
+
+    if train is True:
+        total = time.time()-start
+        self.train_examples_per_sec = n_examples/total
+        self.train_times = {'batching':total-run_time,'forward_backward':run_time}
+
+    return WF_Summary(set,loss,accuracy,predicted_list)
+
+def Eval_Graph_WF(sets,sess,self,GO,batch_size):
+    #Evaluates several partitions (e.g. validation and test) in a single pass through one input pipeline.
+    #Batches never mix partitions, so each partition gets the same statistics as a Run_Graph_WF pass of its own.
+    def tagged():
+        for s,set in enumerate(sets):
+            for batch in WF_Batches(set,self,batch_size,False):
+                yield list(batch)+[np.full(len(batch[WF_Fields.index('sample_idx')]),s)]
+
+    results = [([],[],[]) for _ in sets]
+    for batch in Input_Batches(self,tagged()):
+        loss_i, accuracy_i, predicted_i = sess.run([GO.loss, GO.accuracy, GO.predicted],
+                                                   feed_dict=WF_Feed(self,GO,batch))
+        loss,accuracy,predicted_list = results[batch[WF_Tag][0]]
+        loss.append(loss_i)
+        accuracy.append(accuracy_i)
+        predicted_list.append(WF_Predicted(predicted_i,batch[WF_Fields.index('sample_idx')]))
+
+    return [WF_Summary(set,*r) for set,r in zip(sets,results)]
+
+def Eval_Needed(e,eval_every,epochs_min,stop_criterion_window,valid_convergence):
+    #Validation runs every eval_every epochs (never when None) and, when early stopping reads the validation loss,
+    #on every epoch that stop_check can look at: the last stop_criterion_window epochs before any check after epochs_min.
+    if (eval_every is not None) and (e % eval_every == 0):
+        return True
+    if valid_convergence is True:
+        return e >= epochs_min + 2 - stop_criterion_window
+    return False
+
+def Check_Stop(e,train_params,train_accuracy_total,train_loss_total,val_loss_total,stop_check_list):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        if e > train_params.epochs_min:
+            if train_params.accuracy_min is not None:
+                if np.mean(train_accuracy_total[-3:]) >= train_params.accuracy_min:
+                    return True
+            elif train_params.train_loss_min is not None:
+                if np.mean(train_loss_total[-3:]) < train_params.train_loss_min:
+                    return True
+            elif train_params.convergence == 'validation':
+                if val_loss_total:
+                    stop_check_list.append(stop_check(val_loss_total, train_params.stop_criterion, train_params.stop_criterion_window))
+                    if np.sum(stop_check_list[-3:]) >= 3:
+                        return True
+
+            elif train_params.convergence == 'training':
+                if train_loss_total:
+                    stop_check_list.append(stop_check(train_loss_total, train_params.stop_criterion, train_params.stop_criterion_window))
+                    if np.sum(stop_check_list[-3:]) >= 3:
+                        return True
+    return False
+
+def Input_Feeds(self,GO,Vars):
+    #(placeholder, rows, is_sequence) for each input the model uses; Vars are ordered as
+    #[X_Seq_alpha, X_Seq_beta, v_beta_num, d_beta_num, j_beta_num, v_alpha_num, j_alpha_num, hla_data_seq_num]
+    use = [self.use_alpha,self.use_beta,self.use_v_beta,self.use_d_beta,self.use_j_beta,
+           self.use_v_alpha,self.use_j_alpha,self.use_hla]
+    names = ['X_Seq_alpha','X_Seq_beta','X_v_beta','X_d_beta','X_j_beta','X_v_alpha','X_j_alpha','X_hla']
+    return [(getattr(GO,n),v,ii < 2) for ii,(n,v,u) in enumerate(zip(names,Vars,use)) if u is True]
+
+def Fused_Run(sess,fetches,feeds,batch_size,widths=None):
+    #Evaluates every fetch with a single sess.run per batch and writes the results into arrays
+    #preallocated on the first batch (one row per input row; scalar fetches give one value per batch).
+    n = len(feeds[0][1])
+    n_batches = -(-n//batch_size)
+    out = {}
+    for b,ii in enumerate(range(0,n,batch_size)):
         feed_dict = {}
-        if self.use_alpha is True:
-            feed_dict[GO.X_Seq_alpha] = vars[0]
-        if self.use_beta is True:
-            feed_dict[GO.X_Seq_beta] = vars[1]
-
-        if self.use_alpha is True:
-            features_i_alpha, indices_i_alpha = sess.run([GO.alpha_out, GO.indices_alpha], feed_dict=feed_dict)
-            alpha_features_list.append(features_i_alpha)
-            alpha_indices_list.append(indices_i_alpha)
-
-        if self.use_beta is True:
-            features_i_beta, indices_i_beta = sess.run([GO.beta_out, GO.indices_beta], feed_dict=feed_dict)
-            beta_features_list.append(features_i_beta)
-            beta_indices_list.append(indices_i_beta)
+        for ph,x,is_seq in feeds:
+            x = x[ii:ii+batch_size]
+            if is_seq is True:
+                x = Trim_Seq(x,widths)
+            feed_dict[ph] = x
+        results = sess.run(fetches,feed_dict=feed_dict)
+        for k,r in results.items():
+            r = np.asarray(r)
+            if k not in out:
+                if r.ndim == 0:
+                    out[k] = np.zeros(n_batches,dtype=r.dtype)
+                else:
+                    out[k] = np.zeros((n,)+r.shape[1:],dtype=r.dtype)
+            if r.ndim == 0:
+                out[k][b] = r
+            else:
+                out[k][ii:ii+len(r)] = r
+    return out
 
+def Seq_Feature_Fetches(self,GO):
+    fetches = OrderedDict()
     if self.use_alpha is True:
-        self.alpha_features = np.vstack(alpha_features_list)
-        self.alpha_indices = np.vstack(alpha_indices_list)
-
+        fetches['alpha_features'] = GO.alpha_out
+        fetches['alpha_indices'] = GO.indices_alpha
     if self.use_beta is True:
-        self.beta_features = np.vstack(beta_features_list)
-        self.beta_indices = np.vstack(beta_indices_list)
+        fetches['beta_features'] = GO.beta_out
+        fetches['beta_indices'] = GO.indices_beta
+    return fetches
+
+def Get_Seq_Features_Indices(self,batch_size,GO,sess):
+    Vars = [self.X_Seq_alpha, self.X_Seq_beta]
+    idx_u,inv = Unique_Rows(Vars)
+    idx_u,inv = Bucket_Order(self,GO,idx_u,inv)
+    Vars = [v[idx_u] for v in Vars]
+    feeds = [f for f in Input_Feeds(self,GO,Vars+[None]*6) if f[2] is True]
+    out = Fused_Run(sess,Seq_Feature_Fetches(self,GO),feeds,batch_size,GO.seq_widths)
+    for k,v in out.items():
+        setattr(self,k,v[inv])
 
 def Get_Sequence_Pred(self,batch_size,GO,sess):
     predicted_list = []
-    i = np.asarray(range(len(self.Y)))
     freq = np.ones_like(self.freq)
     idx = []
     for vars in get_batches(self.test, batch_size=batch_size, random=False):
-        var_idx = np.where(np.isin(self.sample_id, vars[0]))[0]
-        OH = OneHotEncoder(categories='auto')
-        sp = OH.fit_transform(i[var_idx].reshape(-1, 1)).T
-        sp = sp.tocoo()
-        indices = np.mat([sp.row, sp.col]).T
-        sp = tf.SparseTensorValue(indices, sp.data, sp.shape)
-
+        var_idx,_ = self.sample_index.rows(vars[0])
         feed_dict = {GO.X_Freq: freq[var_idx],
-                     GO.X_Counts: self.counts[var_idx],
-                     GO.sp: sp}
+                     GO.X_Counts: self.counts[var_idx]}
+        Segment_Feed(feed_dict,GO,np.arange(len(var_idx)),len(var_idx))
 
         if self.use_alpha is True:
             feed_dict[GO.X_Seq_alpha] = self.X_Seq_alpha[var_idx]
@@ -816,40 +1209,19 @@ def Get_Sequence_Pred(self,batch_size,GO,sess):
     return np.vstack(predicted_list),np.squeeze(np.hstack(idx))
 
 def Get_Latent_Features(self,batch_size,GO,sess):
+    #latent features, base features and the per-chain convolutional features/indices in one pass
     Vars = [self.X_Seq_alpha, self.X_Seq_beta,self.v_beta_num,self.d_beta_num,self.j_beta_num,
-            self.v_alpha_num,self.v_alpha_num,self.hla_data_seq_num]
-    Features = []
-    Features_Base = []
-    for vars in get_batches(Vars, batch_size=batch_size, random=False):
-        feed_dict = {}
-        if self.use_alpha is True:
-            feed_dict[GO.X_Seq_alpha] = vars[0]
-        if self.use_beta is True:
-            feed_dict[GO.X_Seq_beta] = vars[1]
-
-        if self.use_v_beta is True:
-            feed_dict[GO.X_v_beta] = vars[2]
-
-        if self.use_d_beta is True:
-            feed_dict[GO.X_d_beta] = vars[3]
-
-        if self.use_j_beta is True:
-            feed_dict[GO.X_j_beta] = vars[4]
-
-        if self.use_v_alpha is True:
-            feed_dict[GO.X_v_alpha] = vars[5]
-
-        if self.use_j_alpha is True:
-            feed_dict[GO.X_j_alpha] = vars[6]
-
-        if self.use_hla:
-            feed_dict[GO.X_hla] = vars[7]
-
-        Features.append(sess.run(GO.Features,feed_dict=feed_dict))
-        Features_Base.append(sess.run(GO.Features_Base,feed_dict=feed_dict))
-
-    Features = np.vstack(Features)
-    self.features_base = np.vstack(Features_Base)
+            self.v_alpha_num,self.j_alpha_num,self.hla_data_seq_num]
+    idx_u,inv = Unique_Rows(Vars)
+    idx_u,inv = Bucket_Order(self,GO,idx_u,inv)
+    Vars = [v[idx_u] for v in Vars]
+    fetches = Seq_Feature_Fetches(self,GO)
+    fetches['features'] = GO.Features
+    fetches['features_base'] = GO.Features_Base
+    out = Fused_Run(sess,fetches,Input_Feeds(self,GO,Vars),batch_size,GO.seq_widths)
+    Features = out.pop('features')[inv]
+    for k,v in out.items():
+        setattr(self,k,v[inv])
     return Features
 
 def Get_Weights(self,batch_size,GO,sess):
@@ -893,12 +1265,8 @@ def Get_Sequence_Pred_GCN(self,batch_size,GO,sess):
     freq = np.ones_like(self.freq)
     idx = []
     for vars in get_batches(self.test, batch_size=batch_size, random=False):
-        var_idx = np.where(np.isin(self.sample_id, vars[0]))[0]
-        OH = OneHotEncoder(categories='auto')
-        sp = OH.fit_transform(i[var_idx].reshape(-1, 1)).T
-        sp = sp.tocoo()
-        indices = np.mat([sp.row, sp.col]).T
-        sp = tf.SparseTensorValue(indices, sp.data, sp.shape)
+        var_idx,_ = self.sample_index.rows(vars[0])
+        sp = Segment_Sparse(np.arange(len(var_idx)))
 
         feed_dict = {GO.X_Freq: freq[var_idx],
                      GO.sp: sp,
@@ -939,13 +1307,10 @@ def Get_Latent_Features_GCN(self,batch_size,GO,sess):
     Var_IDX = []
     total_seq = 0
     for vars in get_batches(set, batch_size=batch_size, random=False):
-        var_idx = np.where(np.isin(self.sample_id, vars[0]))[0]
-        total_seq += len(var_idx)
-        lb = LabelEncoder()
-        lb.fit(vars[0])
-        _,_,sample_idx = np.intersect1d(lb.classes_,vars[0],return_indices=True)
+        sample_idx = np.argsort(vars[0])
         vars = [v[sample_idx] for v in vars]
-        i = lb.transform(self.sample_id[var_idx])
+        var_idx,i = self.sample_index.rows(vars[0])
+        total_seq += len(var_idx)
 
         feed_dict = {GO.i: i,
                      GO.j: self.seq_index_j[var_idx]}
@@ -998,80 +1363,371 @@ def _inf_ss(data,model='model_0'):
     batch_size = data.batch_size
     get = data.get
 
-    tf.reset_default_graph()
-    config = tf.ConfigProto(allow_soft_placement=True)
-    config.gpu_options.allow_growth = True
-    with tf.device(self.device):
-        saver = tf.train.import_meta_graph(os.path.join(self.Name, 'models', model, 'model.ckpt.meta'),clear_devices=True)
-    graph = tf.get_default_graph()
-    with tf.Session(graph=graph,config=config) as sess:
-        saver.restore(sess, tf.train.latest_checkpoint(os.path.join(self.Name, 'models', model)))
-
-        if self.use_alpha is True:
-            X_Seq_alpha_v = graph.get_tensor_by_name('Input_Alpha:0')
+    #a list of models is run as one merged ensemble graph, returning [n_models, N, ...]
+    ensemble = isinstance(model,list)
+    if ensemble:
+        graph,sess,get = self.model_cache.get_ensemble([os.path.join(self.Name, 'models', m) for m in model],get,self.device)
+    else:
+        graph,sess = self.model_cache.get(os.path.join(self.Name, 'models', model),self.device)
 
-        if self.use_beta is True:
-            X_Seq_beta_v = graph.get_tensor_by_name('Input_Beta:0')
+    if self.use_alpha is True:
+        X_Seq_alpha_v = graph.get_tensor_by_name('Input_Alpha:0')
 
-        if self.use_v_beta is True:
-            X_v_beta = graph.get_tensor_by_name('Input_V_Beta:0')
+    if self.use_beta is True:
+        X_Seq_beta_v = graph.get_tensor_by_name('Input_Beta:0')
 
-        if self.use_d_beta is True:
-            X_d_beta = graph.get_tensor_by_name('Input_D_Beta:0')
+    if self.use_v_beta is True:
+        X_v_beta = graph.get_tensor_by_name('Input_V_Beta:0')
 
-        if self.use_j_beta is True:
-            X_j_beta = graph.get_tensor_by_name('Input_J_Beta:0')
+    if self.use_d_beta is True:
+        X_d_beta = graph.get_tensor_by_name('Input_D_Beta:0')
 
-        if self.use_v_alpha is True:
-            X_v_alpha = graph.get_tensor_by_name('Input_V_Alpha:0')
+    if self.use_j_beta is True:
+        X_j_beta = graph.get_tensor_by_name('Input_J_Beta:0')
 
-        if self.use_j_alpha is True:
-            X_j_alpha = graph.get_tensor_by_name('Input_J_Alpha:0')
+    if self.use_v_alpha is True:
+        X_v_alpha = graph.get_tensor_by_name('Input_V_Alpha:0')
 
-        if self.use_hla:
-            X_hla = graph.get_tensor_by_name('HLA:0')
+    if self.use_j_alpha is True:
+        X_j_alpha = graph.get_tensor_by_name('Input_J_Alpha:0')
 
-        get_obj = graph.get_tensor_by_name(get)
+    if self.use_hla:
+        X_hla = graph.get_tensor_by_name('HLA:0')
 
-        out_list = []
-        Vars = [X_Seq_alpha, X_Seq_beta, v_beta_num, d_beta_num, j_beta_num,
-                v_alpha_num, j_alpha_num,hla_data_seq_num]
+    get_obj = graph.get_tensor_by_name(get)
 
-        for vars in get_batches(Vars, batch_size=batch_size):
-            feed_dict = {}
-            if self.use_alpha is True:
-                feed_dict[X_Seq_alpha_v] = vars[0]
-            if self.use_beta is True:
-                feed_dict[X_Seq_beta_v] = vars[1]
+    #graphs built with length_bucketing accept sequences trimmed of trailing padding
+    widths = None
+    for chain,use in [('alpha',self.use_alpha),('beta',self.use_beta)]:
+        if use is True and graph.get_tensor_by_name('Input_'+chain.capitalize()+':0').shape[2].value is None:
+            kernel = graph.get_tensor_by_name(chain+'_conv/conv2d/kernel:0').shape[1].value
+            widths = Trim_Widths(self.max_length,kernel)
 
-            if self.use_v_beta is True:
-                feed_dict[X_v_beta] = vars[2]
+    out_list = []
+    Vars = [X_Seq_alpha, X_Seq_beta, v_beta_num, d_beta_num, j_beta_num,
+            v_alpha_num, j_alpha_num,hla_data_seq_num]
 
-            if self.use_d_beta is True:
-                feed_dict[X_d_beta] = vars[3]
+    for vars in get_batches(Vars, batch_size=batch_size):
+        feed_dict = {}
+        if self.use_alpha is True:
+            feed_dict[X_Seq_alpha_v] = Trim_Seq(vars[0],widths)
+        if self.use_beta is True:
+            feed_dict[X_Seq_beta_v] = Trim_Seq(vars[1],widths)
 
-            if self.use_j_beta is True:
-                feed_dict[X_j_beta] = vars[4]
+        if self.use_v_beta is True:
+            feed_dict[X_v_beta] = vars[2]
 
-            if self.use_v_alpha is True:
-                feed_dict[X_v_alpha] = vars[5]
+        if self.use_d_beta is True:
+            feed_dict[X_d_beta] = vars[3]
 
-            if self.use_j_alpha is True:
-                feed_dict[X_j_alpha] = vars[6]
+        if self.use_j_beta is True:
+            feed_dict[X_j_beta] = vars[4]
 
-            if self.use_hla:
-                feed_dict[X_hla] = vars[7]
+        if self.use_v_alpha is True:
+            feed_dict[X_v_alpha] = vars[5]
 
-            get_ind = sess.run(get_obj, feed_dict=feed_dict)
-            out_list.append(get_ind)
+        if self.use_j_alpha is True:
+            feed_dict[X_j_alpha] = vars[6]
 
-        return np.vstack(out_list)
+        if self.use_hla:
+            feed_dict[X_hla] = vars[7]
+
+        get_ind = sess.run(get_obj, feed_dict=feed_dict)
+        out_list.append(get_ind)
+
+    return np.concatenate(out_list,axis=1 if ensemble else 0)
+
+#placeholders a restored model is fed through; ensemble members share the first model's
+Model_Inputs = ['Input_Alpha','Input_Beta','Input_V_Beta','Input_D_Beta','Input_J_Beta','Input_V_Alpha','Input_J_Alpha',
+                'HLA','Freq','Counts','sp/indices','sp/values','sp/shape','seg','n_seg']
+
+class Model_Cache(object):
+    """ Restored inference graphs and their open sessions, kept resident between inference calls.
+    Entries are keyed by model directory and checkpoint modification time, so a retrained model is reloaded.
+    Least recently used models are closed once the size of their variables exceeds budget_mb in total
+    (None for no limit); the model most recently requested is always kept. """
+    def __init__(self,budget_mb=None):
+        self.budget_mb = budget_mb
+        self.entries = OrderedDict()
+
+    def __getstate__(self):
+        #sessions cannot be pickled (e.g. when the object is sent to cross-validation workers)
+        return {'budget_mb':self.budget_mb,'entries':OrderedDict()}
+
+    def get(self,model_dir,device):
+        graph,sess = self._load([model_dir],None,device)
+        return graph,sess
+
+    def get_ensemble(self,model_dirs,get,device):
+        #All models in one graph: the first keeps its own names, the others are imported under their own scope
+        #with their inputs mapped onto the first model's placeholders. 'ensemble:0' stacks the output (get) of
+        #every model to [n_models, batch, ...], so one feed and one sess.run evaluate the whole ensemble.
+        graph,sess = self._load(model_dirs,get,device)
+        return graph,sess,'ensemble:0'
+
+    def _load(self,model_dirs,get,device):
+        ckpts = [tf.train.latest_checkpoint(d) for d in model_dirs]
+        stamps = tuple([(os.path.abspath(d),os.stat(c+'.index').st_mtime_ns) for d,c in zip(model_dirs,ckpts)])
+        key = (stamps,get)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][:2]
+
+        #release models whose checkpoints have been replaced since they were loaded
+        dirs = dict(stamps)
+        for k in [k for k in self.entries if any([(d in dirs) and (dirs[d] != t) for d,t in k[0]])]:
+            self.close(k)
+
+        graph = tf.Graph()
+        config = tf.ConfigProto(allow_soft_placement=True)
+        config.gpu_options.allow_growth = True
+        sess = tf.Session(graph=graph,config=config)
+        with graph.as_default():
+            outputs = []
+            for ii,(d,c) in enumerate(zip(model_dirs,ckpts)):
+                meta_graph_def = tf.MetaGraphDef()
+                with open(os.path.join(d, 'model.ckpt.meta'),'rb') as f:
+                    meta_graph_def.ParseFromString(f.read())
+                scope = ''
+                input_map = None
+                if ii > 0:
+                    scope = 'member_'+str(ii)
+                    nodes = set([n.name for n in meta_graph_def.graph_def.node])
+                    input_map = {n+':0':graph.get_tensor_by_name(n+':0') for n in Model_Inputs if n in nodes}
+                with tf.device(device):
+                    saver = tf.train.import_meta_graph(meta_graph_def,clear_devices=True,import_scope=scope,input_map=input_map)
+                saver.restore(sess,c)
+                if get is not None:
+                    outputs.append(graph.get_tensor_by_name(scope+'/'+get if scope else get))
+            if get is not None:
+                tf.stack(outputs,0,name='ensemble')
+            size = sum([np.prod(v.shape.as_list())*v.dtype.base_dtype.size for v in tf.global_variables()])
+        self.entries[key] = (graph,sess,size)
+
+        while (self.budget_mb is not None) and (len(self.entries) > 1) and \
+                (sum([v[2] for v in self.entries.values()]) > self.budget_mb*2**20):
+            self.close(next(iter(self.entries)))
+        return graph,sess
+
+    def close(self,key):
+        graph,sess,size = self.entries.pop(key)
+        sess.close()
+
+    def clear(self):
+        for k in list(self.entries):
+            self.close(k)
+
+class Prediction_Cache(object):
+    """ On-disk memoization of the outputs of trained sequence models (Sequence_Inference).
+    Each model has its own store, named after a fingerprint of its checkpoint files, model_type.pkl and the
+    output fetched: an append-only file of fixed-size records (a 16-byte hash of the encoded input row followed
+    by the output row), memory-mapped for lookups. Writers hold an exclusive lock on the directory (fcntl) so
+    several processes can share it. Once the stores exceed budget_mb (None for no limit), the least recently
+    used stores are removed, and the oldest rows of the last one are dropped. """
+    def __init__(self,directory,budget_mb=None,shared=True):
+        if (fcntl is None) and (shared is True):
+            raise Exception('A prediction cache shared between objects requires file locking (fcntl), '
+                            'which is not available on this platform.')
+        self.directory = directory
+        self.budget_mb = budget_mb
+        self.fingerprints = {}
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['index'] = {}
+        return state
+
+    @contextmanager
+    def lock(self,exclusive):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory,'.lock'),'a') as f:
+            fcntl.flock(f,fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f,fcntl.LOCK_UN)
+
+    def fingerprint(self,model_dir,get):
+        files = [os.path.join(os.path.dirname(model_dir),'model_type.pkl')]
+        files += sorted([os.path.join(model_dir,f) for f in os.listdir(model_dir) if f.startswith('model.ckpt.')
+                         and not f.endswith('.meta')])
+        stamp = tuple([(f,os.stat(f).st_mtime_ns,os.stat(f).st_size) for f in files])
+        if stamp not in self.fingerprints:
+            h = hashlib.sha1(get.encode())
+            for f in files:
+                with open(f,'rb') as fh:
+                    for block in iter(lambda: fh.read(2**20), b''):
+                        h.update(block)
+            self.fingerprints[stamp] = h.hexdigest()
+        return self.fingerprints[stamp]
+
+    def row_keys(self,Vars):
+        #one key per input row over every encoded input (sequences, genes, HLA)
+        n = len(Vars[0])
+        rows = np.concatenate([np.asarray(v).reshape(n,-1).astype(np.float64) for v in Vars],axis=1)
+        return np.asarray([hashlib.blake2b(r.tobytes(),digest_size=16).digest() for r in rows],dtype='S16')
+
+    def _files(self,fp):
+        d = os.path.join(self.directory,fp)
+        return os.path.join(d,'records.bin'),os.path.join(d,'meta.pkl')
+
+    def _dtype(self,meta):
+        return np.dtype([('key','S16'),('value',meta['dtype'],tuple(meta['shape']))])
+
+    def _open(self,fp):
+        #complete records of a store, memory-mapped, with the inode of the file mapped
+        records_file,meta_file = self._files(fp)
+        if not os.path.exists(meta_file) or not os.path.exists(records_file):
+            return None,None
+        with open(meta_file,'rb') as f:
+            meta = pickle.load(f)
+        dtype = self._dtype(meta)
+        with open(records_file,'rb') as f:
+            st = os.fstat(f.fileno())
+            n = st.st_size//dtype.itemsize
+            if n == 0:
+                return None,None
+            records = np.memmap(f,dtype=dtype,mode='r',shape=(n,))
+        return records,st.st_ino
+
+    def _sorted_index(self,fp,records,inode):
+        #sorted keys of a store; records appended since the last lookup are merged in, and the
+        #index is only rebuilt when the file was replaced (compacted) by another writer
+        n = len(records)
+        prev = self.index.get(fp)
+        if (prev is None) or (prev[0] != inode) or (prev[1] > n):
+            order = np.argsort(records['key'],kind='stable')
+            prev = (inode,n,records['key'][order],order)
+        elif prev[1] < n:
+            _,n_prev,sorted_keys,order = prev
+            tail = np.asarray(records['key'][n_prev:])
+            o = np.argsort(tail,kind='stable')
+            pos = np.searchsorted(sorted_keys,tail[o])
+            prev = (inode,n,np.insert(sorted_keys,pos,tail[o]),np.insert(order,pos,o+n_prev))
+        self.index[fp] = prev
+        return prev[2],prev[3]
+
+    def get(self,fp,keys):
+        #(outputs, found) with outputs of rows not found left as zeros
+        with self.lock(exclusive=False):
+            records,inode = self._open(fp)
+            if records is not None:
+                os.utime(self._files(fp)[1])
+        if records is None:
+            self.misses += len(keys)
+            return None,np.zeros(len(keys),dtype=bool)
+
+        sorted_keys,order = self._sorted_index(fp,records,inode)
+        pos = np.minimum(np.searchsorted(sorted_keys,keys),len(sorted_keys)-1)
+        found = sorted_keys[pos] == keys
+        out = np.zeros((len(keys),)+records.dtype['value'].shape,dtype=records.dtype['value'].base)
+        out[found] = records['value'][order[pos[found]]]
+        self.hits += int(np.sum(found))
+        self.misses += int(np.sum(~found))
+        return out,found
+
+    def put(self,fp,keys,values):
+        if len(keys) == 0:
+            return
+        records_file,meta_file = self._files(fp)
+        values = np.asarray(values,dtype=np.float32)
+        with self.lock(exclusive=True):
+            if not os.path.exists(meta_file):
+                os.makedirs(os.path.dirname(meta_file),exist_ok=True)
+                with open(meta_file,'wb') as f:
+                    pickle.dump({'shape':list(values.shape[1:]),'dtype':'float32'},f)
+            with open(meta_file,'rb') as f:
+                dtype = self._dtype(pickle.load(f))
+            records = np.empty(len(keys),dtype=dtype)
+            records['key'] = keys
+            records['value'] = values
+            #every key is written with its output in one append; a partial record left by an interrupted
+            #writer is cut off first so records stay aligned
+            with open(records_file,'ab') as f:
+                size = f.tell()
+                if size % dtype.itemsize:
+                    f.truncate(size - size % dtype.itemsize)
+                f.write(records.tobytes())
+            self.evict(keep=fp)
+
+    def size(self,fp):
+        return sum([os.path.getsize(f) for f in self._files(fp) if os.path.exists(f)])
+
+    def stores(self):
+        return [d for d in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory,d))]
+
+    def evict(self,keep=None):
+        #called with the exclusive lock held; files are replaced rather than rewritten so
+        #readers that have them mapped keep a consistent copy
+        if self.budget_mb is None:
+            return
+        budget = self.budget_mb*2**20
+        #least recently used first, the store just written to last
+        stores = sorted(self.stores(),key=lambda fp: (fp == keep,os.path.getmtime(self._files(fp)[1])
+                        if os.path.exists(self._files(fp)[1]) else 0))
+        total = sum([self.size(fp) for fp in stores])
+        while total > budget and len(stores) > 1:
+            fp = stores.pop(0)
+            total -= self.size(fp)
+            self._remove(fp)
+        if total > budget and stores:
+            #keep the newest rows of the remaining store within half the budget
+            fp = stores[0]
+            records,_ = self._open(fp)
+            if records is None:
+                return
+            n_keep = int((budget//2)//records.dtype.itemsize)
+            records_file = self._files(fp)[0]
+            with open(records_file+'.tmp','wb') as f:
+                f.write(records[len(records)-n_keep:].tobytes())
+            del records
+            os.replace(records_file+'.tmp',records_file)
+            self.index.pop(fp,None)
+
+    def _remove(self,fp):
+        shutil.rmtree(os.path.join(self.directory,fp),ignore_errors=True)
+        self.index.pop(fp,None)
+
+    def clear(self,fp=None):
+        with self.lock(exclusive=True):
+            for fp in ([fp] if fp is not None else self.stores()):
+                self._remove(fp)
+
+    def stats(self,reset=False):
+        with self.lock(exclusive=False):
+            entries = 0
+            for fp in self.stores():
+                records,_ = self._open(fp)
+                entries += 0 if records is None else len(records)
+            stats = {'hits':self.hits,'misses':self.misses,
+                     'hit_rate':self.hits/(self.hits+self.misses) if (self.hits+self.misses) > 0 else 0.0,
+                     'entries':entries,'size_mb':sum([self.size(fp) for fp in self.stores()])/2**20}
+        if reset is True:
+            self.hits = 0
+            self.misses = 0
+        return stats
 
 class data_object(object):
     def __init__(self):
         self.init=0
 
-def inference_method_ss(get,alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,v_alpha,j_alpha,hla,p,batch_size,self,models):
+def Subset_Data(data,rows):
+    #inference inputs of the selected rows only
+    sub = data_object()
+    sub.__dict__.update(data.__dict__)
+    for name in ['X_Seq_alpha','X_Seq_beta','v_beta_num','d_beta_num','j_beta_num','v_alpha_num','j_alpha_num',
+                 'hla_data_seq_num']:
+        setattr(sub,name,getattr(data,name)[rows])
+    return sub
+
+def inference_method_ss(get,alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,v_alpha,j_alpha,hla,p,batch_size,self,models,ensemble=False):
 
     inputs = [alpha_sequences, beta_sequences, v_beta, d_beta, j_beta, v_alpha, j_alpha,hla]
     for i in inputs:
@@ -1079,24 +1735,15 @@ def inference_method_ss(get,alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,
             len_input = len(i)
             break
 
-    if p is None:
-        p = Pool(40)
-
     if alpha_sequences is not None:
-        args = list(
-            zip(alpha_sequences, [self.aa_idx] * len(alpha_sequences), [self.max_length] * len(alpha_sequences)))
-        result = p.starmap(Embed_Seq_Num, args)
-        sequences_num = np.vstack(result)
+        sequences_num = Embed_Seq_Num_Batch(alpha_sequences, self.aa_idx, self.max_length)
         X_Seq_alpha = np.expand_dims(sequences_num, 1)
     else:
         X_Seq_alpha = np.zeros(shape=[len_input])
         alpha_sequences = np.asarray([None] * len_input)
 
     if beta_sequences is not None:
-        args = list(
-            zip(beta_sequences, [self.aa_idx] * len(beta_sequences), [self.max_length] * len(beta_sequences)))
-        result = p.starmap(Embed_Seq_Num, args)
-        sequences_num = np.vstack(result)
+        sequences_num = Embed_Seq_Num_Batch(beta_sequences, self.aa_idx, self.max_length)
         X_Seq_beta = np.expand_dims(sequences_num, 1)
     else:
         X_Seq_beta = np.zeros(shape=[len_input])
@@ -1154,20 +1801,23 @@ def inference_method_ss(get,alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,
     else:
         hla_data_seq_num = np.zeros(shape=[len_input])
 
-    if p is None:
-        p.close()
-        p.join()
+    #only run the network on unique input rows
+    idx_u,inv = Unique_Rows([X_Seq_alpha,X_Seq_beta,v_beta_num,d_beta_num,j_beta_num,v_alpha_num,j_alpha_num,hla_data_seq_num])
+    #keep sequences of similar length together so batches can be trimmed by graphs that allow it
+    lengths = [Seq_Lengths(x[idx_u]) for x,s in [(X_Seq_alpha,alpha_sequences),(X_Seq_beta,beta_sequences)] if s[0] is not None]
+    if lengths:
+        idx_u,inv = Reorder_Unique(idx_u,inv,np.lexsort(lengths[::-1]))
 
     data = data_object()
     data.self = self
-    data.X_Seq_alpha = X_Seq_alpha
-    data.X_Seq_beta = X_Seq_beta
-    data.v_beta_num = v_beta_num
-    data.d_beta_num = d_beta_num
-    data.j_beta_num = j_beta_num
-    data.v_alpha_num = v_alpha_num
-    data.j_alpha_num = j_alpha_num
-    data.hla_data_seq_num = hla_data_seq_num
+    data.X_Seq_alpha = X_Seq_alpha[idx_u]
+    data.X_Seq_beta = X_Seq_beta[idx_u]
+    data.v_beta_num = v_beta_num[idx_u]
+    data.d_beta_num = d_beta_num[idx_u]
+    data.j_beta_num = j_beta_num[idx_u]
+    data.v_alpha_num = v_alpha_num[idx_u]
+    data.j_alpha_num = j_alpha_num[idx_u]
+    data.hla_data_seq_num = hla_data_seq_num[idx_u]
     data.batch_size = batch_size
     data.get = get
 
@@ -1176,14 +1826,41 @@ def inference_method_ss(get,alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,
         models = [d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d))]
         models = [f for f in models if not f.startswith('.')]
 
+    cache = self.prediction_cache
+    if cache is not None:
+        #rows found for every model skip the network; the rest are run for all models and stored
+        keys = cache.row_keys([data.X_Seq_alpha,data.X_Seq_beta,data.v_beta_num,data.d_beta_num,data.j_beta_num,
+                               data.v_alpha_num,data.j_alpha_num,data.hla_data_seq_num])
+        fps = [cache.fingerprint(os.path.join(self.Name,'models',m),get) for m in models]
+        cached = [cache.get(fp,keys) for fp in fps]
+        miss = np.where(np.any([~found for _,found in cached],0))[0]
+        data = Subset_Data(data,miss)
+
     predicted = []
-    for m in models:
-        pred = _inf_ss(data, model=m)
-        predicted.append(pred)
+    if cache is not None and len(miss) == 0:
+        pass
+    elif ensemble is True:
+        predicted = list(_inf_ss(data, model=list(models)))
+    else:
+        for m in models:
+            pred = _inf_ss(data, model=m)
+            predicted.append(pred)
+
+    if cache is not None:
+        outputs = []
+        for ii,(fp,(out,found)) in enumerate(zip(fps,cached)):
+            if len(miss) > 0:
+                if out is None:
+                    out = np.zeros((len(keys),)+predicted[ii].shape[1:],dtype=np.float32)
+                out[miss] = predicted[ii]
+                new = ~found[miss]
+                cache.put(fp,keys[miss][new],predicted[ii][new])
+            outputs.append(out)
+        predicted = outputs
 
     predicted_dist = []
     for p in predicted:
-        predicted_dist.append(np.expand_dims(p, 0))
+        predicted_dist.append(np.expand_dims(p[inv], 0))
     predicted_dist = np.vstack(predicted_dist)
 
     out,out_dist = np.mean(predicted_dist,0), predicted_dist
@@ -1194,6 +1871,94 @@ def inference_method_ss(get,alpha_sequences,beta_sequences,v_beta,d_beta,j_beta,
 
     return out, out_dist
 
+def Export_Model_NumPy(self,model_dir):
+    #weights of the layers recorded in arch.pkl plus everything the forward pass needs to encode raw inputs
+    arch_file = os.path.join(model_dir,'arch.pkl')
+    if not os.path.exists(arch_file):
+        raise Exception('{} has no layer layout (arch.pkl); retrain the model to export it.'.format(model_dir))
+    with open(arch_file,'rb') as f:
+        arch = pickle.load(f)
+
+    reader = tf.train.load_checkpoint(tf.train.latest_checkpoint(model_dir))
+    weights = {}
+    variables = {}
+    for block,names in arch['variables'].items():
+        variables[block] = []
+        for ii,name in enumerate(names):
+            key = block+'_'+str(ii)
+            weights[key] = reader.get_tensor(name.split(':')[0])
+            variables[block].append(key)
+    arch = dict(arch)
+    arch['variables'] = variables
+
+    hla_supertypes = None
+    if self.use_hla_sup:
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        df_supertypes = pd.read_csv(os.path.join(dir_path,'Supertype_Data_Dict.csv'))
+        df_supertypes = df_supertypes[~df_supertypes['Supertype_2'].isin(['AU', 'BU'])]
+        hla_supertypes = dict(zip(df_supertypes['Allele'], df_supertypes['Supertype_2']))
+
+    classes = {}
+    for name,lb in [('v_beta',self.lb_v_beta),('d_beta',self.lb_d_beta),('j_beta',self.lb_j_beta),
+                    ('v_alpha',self.lb_v_alpha),('j_alpha',self.lb_j_alpha),('hla',self.lb_hla),('label',self.lb)]:
+        classes[name] = [str(c) for c in lb.classes_] if hasattr(lb,'classes_') else None
+
+    config = {'arch':arch,'max_length':int(self.max_length),'aa_idx':{k:int(v) for k,v in self.aa_idx.items()},
+              'classes':classes,'hla_supertypes':hla_supertypes,
+              'keep_non_supertype_alleles':bool(self.keep_non_supertype_alleles),
+              'ind':None if self.ind is None else [int(i) for i in self.ind],
+              'regression':bool(self.regression)}
+    for name in ['alpha','beta','v_beta','d_beta','j_beta','v_alpha','j_alpha','hla']:
+        config['use_'+name] = bool(getattr(self,'use_'+name))
+
+    filename = os.path.join(model_dir,'model.npz')
+    np.savez(filename,config=np.array(json.dumps(config)),**weights)
+    return filename
+
+def Check_NumPy_Parity(self,model,filename,n,tol=1e-4):
+    #run the first n rows of the loaded data through the tensorflow model and its NumPy export
+    model_type,get = load_model_data(self)
+    np_model = numpy_inference.NumPy_Model(filename)
+    n = min(n,len(self.v_beta_num))
+    Vars = [self.X_Seq_alpha,self.X_Seq_beta,self.v_beta_num,self.d_beta_num,self.j_beta_num,
+            self.v_alpha_num,self.j_alpha_num,self.hla_data_seq_num]
+    Vars = [np.asarray(v[:n]) for v in Vars]
+    X = {}
+    for name,use,v in zip(['alpha','beta','v_beta','d_beta','j_beta','v_alpha','j_alpha','hla'],
+                          [self.use_alpha,self.use_beta,self.use_v_beta,self.use_d_beta,self.use_j_beta,
+                           self.use_v_alpha,self.use_j_alpha,self.use_hla],Vars):
+        if use is True:
+            X[name] = v[:,0].astype(np.int64) if name in ['alpha','beta'] else v
+
+    data = data_object()
+    data.self = self
+    data.X_Seq_alpha,data.X_Seq_beta,data.v_beta_num,data.d_beta_num,data.j_beta_num, \
+    data.v_alpha_num,data.j_alpha_num,data.hla_data_seq_num = Vars
+    data.batch_size = 1000
+    data.get = get
+
+    if model_type == 'WF':
+        sample_labels = np.asarray(self.sample_id[:n])
+        data.sample_labels = sample_labels
+        data.sample_index = group_index(sample_labels)
+        data.freq = np.asarray(self.freq[:n])
+        data.counts = np.asarray(self.counts[:n])
+        data.batch_size = 10
+        _,out_tf = self._inf(data,model=model)
+        seg = data.sample_index.codes
+        out_np = np_model.sample_forward(X,seg,len(data.sample_index.groups),
+                                         data.freq.astype(np.float32),data.counts.astype(np.float32))
+    else:
+        out_tf = _inf_ss(data,model=model)
+        if self.ind is not None:
+            out_tf = out_tf[:,self.ind]
+        out_np = np_model.sequence_forward(X)
+
+    diff = np.max(np.abs(out_tf-out_np)) if out_np.size else 0.0
+    if diff > tol:
+        raise Exception('NumPy export of {} differs from the tensorflow model by {:.2e} (tolerance {:.0e})!'.format(model,diff,tol))
+    return diff
+
 def stop_check(loss,stop_criterion,stop_criterion_window):
     w = loss[-stop_criterion_window:]
     return (w[0]-w[-1])/w[0] < stop_criterion
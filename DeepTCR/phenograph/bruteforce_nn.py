@@ -1,6 +1,6 @@
 """
 Compute k-nearest neighbors using brute force search in parallel
-via scipy.spatial.distance.cdist and multiprocessing.Pool
+via scipy.spatial.distance.cdist and the shared DeepTCR worker pool
 
 psutil is used to evaluate available memory and minimize the number
 of parallel jobs for the available resources
@@ -8,8 +8,7 @@ of parallel jobs for the available resources
 
 import numpy as np
 from scipy.spatial.distance import cdist
-from multiprocessing import Pool
-from contextlib import closing
+from DeepTCR.functions.pool_manager import Pool_Map
 from functools import partial
 import psutil
 
@@ -75,8 +74,7 @@ def knnsearch(data, k, metric):
 
     if n_chunks > 2:
 
-        with closing(Pool()) as pool:
-            result = pool.map(f, np.array_split(data, n_chunks))
+        result = Pool_Map(f, np.array_split(data, n_chunks))
 
         d, idx = zip(*result)
 
@@ -1,7 +1,6 @@
 import numpy as np
 from sklearn.neighbors import NearestNeighbors
-from multiprocessing import Pool
-from contextlib import closing
+from DeepTCR.functions.pool_manager import Pool_Starmap
 from itertools import repeat
 from scipy import sparse as sp
 import subprocess
@@ -132,8 +131,7 @@ def parallel_jaccard_kernel(idx):
     :return (i, j, s): row indices, column indices, and nonzero values for a sparse adjacency matrix
     """
     n = len(idx)
-    with closing(Pool()) as pool:
-        jaccard_values = pool.starmap(calc_jaccard, zip(range(n), repeat(idx)))
+    jaccard_values = Pool_Starmap(calc_jaccard, zip(range(n), repeat(idx)))
 
     graph = sp.lil_matrix((n, n), dtype=float)
     for i, tup in enumerate(jaccard_values):
@@ -0,0 +1,22 @@
+import json
+import numpy as np
+from DeepTCR.functions.numpy_inference import NumPy_Model
+
+def Write_Model(path,classes):
+    #only the config is needed to encode inputs
+    config = {'arch':{'variables':{}},'max_length':5,'aa_idx':{c:i+1 for i,c in enumerate('ACDEFGHIKLMNPQRSTVWY')},
+              'classes':classes,'hla_supertypes':None,'keep_non_supertype_alleles':False}
+    filename = str(path/'model.npz')
+    np.savez(filename,config=json.dumps(config))
+    return NumPy_Model(filename)
+
+def test_encode_unknown_genes(tmp_path):
+    classes = {'v_beta':['TCRBV19-01','TCRBV05-01'],'d_beta':None,'j_beta':None,'v_alpha':None,'j_alpha':None,'hla':None}
+    m = Write_Model(tmp_path,classes)
+    #input names shorter than the known genes they are replaced with
+    X = m.encode(beta_sequences=['CAS','CASS'],v_beta=['X1','X2'])
+    assert np.all(np.isin(X['v_beta'],[0,1]))
+    assert np.array_equal(X['beta'][0],[2,1,16,0,0])
+
+    X = m.encode(beta_sequences=['CAS'],v_beta=['TCRBV05-01'])
+    assert X['v_beta'][0] == 1